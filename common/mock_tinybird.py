@@ -0,0 +1,451 @@
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+DEFAULT_PORT = 8001
+DEFAULT_CITIES = 50
+DEFAULT_REPORT_INTERVAL = 60
+DEFAULT_MAX_ROWS = 100000
+
+# Rows written to a streamed (ndjson/csv) response at a time.
+STREAM_CHUNK_ROWS = 1000
+
+CLOUDS = ['clear', 'few clouds', 'scattered clouds', 'broken clouds', 'overcast clouds']
+COLUMNS = [('timestamp', 'DateTime'), ('site_name', 'String'), ('temp_f', 'Float32'), ('clouds', 'String'),
+           ('description', 'String'), ('humidity', 'Float32'), ('precip', 'Float32'), ('pressure', 'Float32'),
+           ('wind_dir', 'Float32'), ('wind_speed', 'Float32')]
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('T', ' ').rstrip('Z'))
+
+
+def to_seconds(moment):
+    """Seconds since the epoch for a naive UTC datetime."""
+    return (moment - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class SyntheticReports:
+    """Weather reports for `cities` sites, one per site every `interval` seconds.
+
+    Values are worked out from the site and timestamp, so the same request always returns
+    the same rows and nothing has to be stored.
+    """
+
+    def __init__(self, cities=DEFAULT_CITIES, interval=DEFAULT_REPORT_INTERVAL):
+        self.sites = [f"City {i:03d}" for i in range(cities)]
+        self.interval = interval
+
+    def report(self, site_index, moment):
+        hours = to_seconds(moment) / 3600
+        clouds = CLOUDS[(site_index + int(hours)) % len(CLOUDS)]
+        return {
+            'timestamp': moment.strftime(TIME_FORMAT),
+            'site_name': self.sites[site_index],
+            'temp_f': round(55 + site_index % 30 + 15 * math.sin(2 * math.pi * hours / 24), 1),
+            'clouds': clouds,
+            'description': clouds,
+            'humidity': round(50 + 40 * math.sin(2 * math.pi * (hours / 24 + site_index / 7)), 1),
+            'precip': 0.0 if clouds != 'overcast clouds' else 0.1,
+            'pressure': round(1013 + 10 * math.sin(2 * math.pi * hours / 72), 1),
+            'wind_dir': float((site_index * 37 + int(hours) * 11) % 360),
+            'wind_speed': round(5 + 5 * abs(math.sin(2 * math.pi * (hours / 6 + site_index / 13))), 1),
+        }
+
+    def timestamps(self, start_time, end_time):
+        """Report times in (start_time, end_time], aligned to the interval."""
+        step = self.interval
+        seconds = math.floor(to_seconds(start_time) / step) * step + step
+        end = to_seconds(end_time)
+        while seconds <= end:
+            yield from_seconds(seconds)
+            seconds += step
+
+    def reports(self, start_time, end_time, site=None, limit=None):
+        """Yields reports in timestamp order, for every site or just `site`."""
+        indexes = range(len(self.sites)) if site is None else [self.sites.index(site)]
+        count = 0
+        for moment in self.timestamps(start_time, end_time):
+            for index in indexes:
+                if limit is not None and count >= limit:
+                    return
+                yield self.report(index, moment)
+                count += 1
+
+    def latest(self, site_index):
+        now = to_seconds(datetime.utcnow())
+        return self.report(site_index, from_seconds(math.floor(now / self.interval) * self.interval))
+
+
+class MockTinybird:
+    """Settings, injected faults and counters for one mock server."""
+
+    def __init__(self, reports=None, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit=0,
+                 max_rows=DEFAULT_MAX_ROWS, token=None):
+        self.reports = reports or SyntheticReports()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_rows = max_rows
+        self.token = token
+
+        self.lock = threading.Lock()
+        self.window_start = 0
+        self.window_requests = 0
+        self.newest_event = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.requests = Counter()  # (endpoint, status) -> count
+            self.rows_served = Counter()  # pipe -> rows
+            self.rows_received = Counter()  # data source -> rows
+            self.bytes_received = Counter()  # data source -> bytes on the wire
+
+    def count_request(self, endpoint, status):
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+
+    def take_rate_limit(self):
+        """Counts a request against the one-second window. Returns the headers and whether it is allowed."""
+        if not self.rate_limit:
+            return {}, True
+        now = time.time()
+        with self.lock:
+            if now - self.window_start >= 1.0:
+                self.window_start = math.floor(now)
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(0, self.rate_limit - self.window_requests)
+            allowed = self.window_requests <= self.rate_limit
+            reset = max(0.0, self.window_start + 1.0 - now)
+        headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': f"{reset:.3f}"}
+        if not allowed:
+            headers['Retry-After'] = f"{reset:.3f}"
+        return headers, allowed
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            received = sum(self.rows_received.values())
+            return {
+                'elapsed_seconds': round(elapsed, 3),
+                'requests': [{'endpoint': endpoint, 'status': status, 'count': count}
+                             for (endpoint, status), count in sorted(self.requests.items())],
+                'rows_served': dict(self.rows_served),
+                'rows_received': dict(self.rows_received),
+                'bytes_received': dict(self.bytes_received),
+                'rows_received_per_second': round(received / elapsed, 1) if elapsed else 0.0,
+            }
+
+
+def endpoint_name(request):
+    if request.path.startswith('/v0/pipes/'):
+        return request.match_info.get('pipe', request.path)
+    return request.path
+
+
+@web.middleware
+async def inject_faults(request, handler):
+    """Adds the configured latency, auth check, rate limit and random errors to API requests."""
+    mock = request.app['mock']
+    if not request.path.startswith('/v0/'):
+        return await handler(request)
+
+    endpoint = endpoint_name(request)
+    if mock.latency_ms or mock.jitter_ms:
+        delay = mock.latency_ms + random.uniform(-mock.jitter_ms, mock.jitter_ms)
+        await asyncio.sleep(max(0.0, delay) / 1000)
+
+    if mock.token and request.headers.get('Authorization') != f"Bearer {mock.token}":
+        mock.count_request(endpoint, 403)
+        return web.json_response({'error': 'Invalid token'}, status=403)
+
+    headers, allowed = mock.take_rate_limit()
+    request['rate_limit_headers'] = headers
+    if not allowed:
+        mock.count_request(endpoint, 429)
+        return web.json_response({'error': 'Too many requests'}, status=429)
+
+    if mock.error_rate and random.random() < mock.error_rate:
+        mock.count_request(endpoint, 500)
+        return web.json_response({'error': 'Injected error'}, status=500)
+
+    response = await handler(request)
+    mock.count_request(endpoint, response.status)
+    return response
+
+
+def time_window(request, default_hours=1):
+    end_time = parse_time(request.query['end_time']) if 'end_time' in request.query else datetime.utcnow()
+    if 'start_time' in request.query:
+        start_time = parse_time(request.query['start_time'])
+    else:
+        start_time = end_time - timedelta(hours=default_hours)
+    return start_time, end_time
+
+
+async def send_rows(request, pipe, fmt, rows, meta=COLUMNS):
+    """Sends rows as Tinybird does for .json, and streams them for .ndjson and .csv."""
+    mock = request.app['mock']
+    started = time.perf_counter()
+
+    if fmt == 'json':
+        data = list(rows)
+        with mock.lock:
+            mock.rows_served[pipe] += len(data)
+        return web.json_response({
+            'meta': [{'name': name, 'type': kind} for name, kind in meta],
+            'data': data,
+            'rows': len(data),
+            'statistics': {'elapsed': time.perf_counter() - started, 'rows_read': len(data), 'bytes_read': 0},
+        })
+
+    if fmt not in ('ndjson', 'csv'):
+        raise web.HTTPNotFound(text=f"Unknown format: {fmt}")
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv; charset=utf-8'})
+    await response.prepare(request)
+
+    names = [name for name, _ in meta]
+    count = 0
+    chunk = []
+
+    async def write_chunk():
+        if fmt == 'ndjson':
+            body = ''.join(json.dumps(row) + '\n' for row in chunk)
+        else:
+            buffer = io.StringIO()
+            csv.DictWriter(buffer, fieldnames=names, lineterminator='\n').writerows(chunk)
+            body = buffer.getvalue()
+        await response.write(body.encode('utf-8'))
+
+    if fmt == 'csv':
+        await response.write((','.join(names) + '\n').encode('utf-8'))
+    for row in rows:
+        chunk.append(row)
+        count += 1
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            await write_chunk()
+            chunk = []
+    if chunk:
+        await write_chunk()
+    await response.write_eof()
+
+    with mock.lock:
+        mock.rows_served[pipe] += count
+    return response
+
+
+def row_limit(request, mock):
+    """The `limit` parameter capped at --max-rows, or None for no limit."""
+    limit = int(request.query['limit']) if 'limit' in request.query else None
+    if mock.max_rows:
+        limit = mock.max_rows if limit is None else min(limit, mock.max_rows)
+    return limit
+
+
+async def pipe(request):
+    mock = request.app['mock']
+    reports = mock.reports
+    name = request.match_info['pipe']
+    fmt = request.match_info['format']
+
+    if name == 'reportsv2':
+        start_time, end_time = time_window(request)
+        rows = reports.reports(start_time, end_time, limit=row_limit(request, mock))
+    elif name == 'reports':
+        city = request.query.get('city')
+        if city is not None and city not in reports.sites:
+            return await send_rows(request, name, fmt, [])
+        start_time, end_time = time_window(request, default_hours=24)
+        rows = reports.reports(start_time, end_time, site=city, limit=row_limit(request, mock))
+    elif name == 'api_cities':
+        rows = [{'site_name': site} for site in reports.sites]
+        return await send_rows(request, name, fmt, rows, meta=[('site_name', 'String')])
+    elif name == 'current_conditions':
+        city = request.query.get('city')
+        indexes = range(len(reports.sites)) if city is None else \
+            [reports.sites.index(city)] if city in reports.sites else []
+        rows = [reports.latest(index) for index in indexes]
+    elif name == 'most_recent':
+        # The newest report posted to the Events API, or the newest synthetic one before any arrive.
+        newest = mock.newest_event or reports.latest(0)['timestamp']
+        return await send_rows(request, name, fmt, [{'timestamp': newest}], meta=[('timestamp', 'DateTime')])
+    else:
+        raise web.HTTPNotFound(text=f"Unknown pipe: {name}")
+
+    return await send_rows(request, name, fmt, rows)
+
+
+async def events(request):
+    """Takes an NDJSON (optionally gzipped) Events API post and counts its rows."""
+    mock = request.app['mock']
+    name = request.query.get('name')
+    if not name:
+        return web.json_response({'error': 'The name parameter is required'}, status=400)
+
+    body = await request.read()
+    wire_bytes = request.content_length or len(body)
+    # aiohttp already undoes Content-Encoding; this catches gzip bodies sent without the header.
+    if body[:2] == b'\x1f\x8b':
+        try:
+            body = gzip.decompress(body)
+        except (OSError, zlib.error) as e:
+            return web.json_response({'error': f"Bad gzip body: {e}"}, status=400)
+
+    successful = quarantined = 0
+    newest = None
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            quarantined += 1
+            continue
+        successful += 1
+        timestamp = row.get('timestamp') if isinstance(row, dict) else None
+        if isinstance(timestamp, str) and (newest is None or timestamp > newest):
+            newest = timestamp
+
+    with mock.lock:
+        mock.rows_received[name] += successful + quarantined
+        mock.bytes_received[name] += wire_bytes
+        if newest and (mock.newest_event is None or newest > mock.newest_event):
+            mock.newest_event = newest
+    return web.json_response({'successful_rows': successful, 'quarantined_rows': quarantined}, status=202)
+
+
+async def get_stats(request):
+    return web.json_response(request.app['mock'].stats())
+
+
+async def reset_stats(request):
+    request.app['mock'].reset()
+    return web.json_response({'reset': True})
+
+
+async def add_rate_limit_headers(request, response):
+    # Runs as headers are sent, so streamed responses get them too.
+    response.headers.update(request.get('rate_limit_headers', {}))
+
+
+def create_app(mock):
+    app = web.Application(middlewares=[inject_faults], client_max_size=64 * 1024 * 1024)
+    app['mock'] = mock
+    app.on_response_prepare.append(add_rate_limit_headers)
+    app.router.add_get(r'/v0/pipes/{pipe}.{format:json|ndjson|csv}', pipe)
+    app.router.add_post('/v0/events', events)
+    app.router.add_get('/stats', get_stats)
+    app.router.add_delete('/stats', reset_stats)
+    return app
+
+
+def print_summary(mock):
+    stats = mock.stats()
+    requests = sum(entry['count'] for entry in stats['requests'])
+    errors = sum(entry['count'] for entry in stats['requests'] if entry['status'] >= 400)
+    print(f"INFO: {requests} requests ({errors} errors), "
+          f"{sum(stats['rows_served'].values())} rows served, "
+          f"{sum(stats['rows_received'].values())} rows received "
+          f"({stats['rows_received_per_second']:.0f} rows/sec) in {stats['elapsed_seconds']:.0f}s.")
+
+
+async def log_summaries(mock, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print_summary(mock)
+
+
+async def start_server(mock, host, port):
+    """Starts serving on host:port. Returns the runner and the port it is listening on."""
+    runner = web.AppRunner(create_app(mock), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, runner.addresses[0][1]
+
+
+async def serve(mock, host, port, log_interval=0):
+    runner, port = await start_server(mock, host, port)
+    print(f"INFO: Mock Tinybird API listening on http://{host}:{port}")
+    try:
+        if log_interval:
+            await log_summaries(mock, log_interval)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def serve_in_thread(mock, host='127.0.0.1', port=0):
+    """Starts a mock server on a daemon thread. Returns its base URL once it is listening.
+
+    With port 0 the OS picks a free port, which is handy for benchmarks that start their
+    own server.
+    """
+    started = threading.Event()
+    address = {}
+
+    async def run():
+        _, address['port'] = await start_server(mock, host, port)
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(run(),), name='mock-tinybird', daemon=True).start()
+    started.wait()
+    return f"http://{host}:{address['port']}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Tinybird API.')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--cities', type=int, default=DEFAULT_CITIES, help='Number of synthetic sites')
+    parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL,
+                        help='Seconds between synthetic reports for each site')
+    parser.add_argument('--max-rows', type=int, default=DEFAULT_MAX_ROWS,
+                        help='Most rows a pipe returns per request (0 for no limit)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Added latency for every API request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random +/- variation on the added latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API requests that return a 500')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='API requests allowed per second before returning 429 (0 for no limit)')
+    parser.add_argument('--token', help='Only accept this Bearer token (default: accept any)')
+    parser.add_argument('--log-interval', type=float, default=10.0,
+                        help='Seconds between summary lines (0 to turn them off)')
+    args = parser.parse_args()
+
+    mock = MockTinybird(SyntheticReports(args.cities, args.report_interval), latency_ms=args.latency_ms,
+                        jitter_ms=args.jitter_ms, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                        max_rows=args.max_rows, token=args.token)
+    try:
+        asyncio.run(serve(mock, args.host, args.port, args.log_interval))
+    except KeyboardInterrupt:
+        pass
+    print_summary(mock)
@@ -0,0 +1,89 @@
+import os
+from contextlib import asynccontextmanager, contextmanager
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 10
+# Connections are closed and replaced after this many seconds, and after sitting idle this long.
+DEFAULT_MAX_LIFETIME = 3600.0
+DEFAULT_MAX_IDLE = 600.0
+# How long a caller waits for a free connection before giving up.
+DEFAULT_TIMEOUT = 30.0
+
+
+def pool_settings(**overrides):
+    """Pool sizes and lifetimes from the POSTGRES_POOL_* environment settings."""
+    settings = {
+        'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', DEFAULT_MIN_SIZE)),
+        'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', DEFAULT_MAX_SIZE)),
+        'max_lifetime': float(os.getenv('POSTGRES_POOL_MAX_LIFETIME', DEFAULT_MAX_LIFETIME)),
+        'max_idle': float(os.getenv('POSTGRES_POOL_MAX_IDLE', DEFAULT_MAX_IDLE)),
+        'timeout': float(os.getenv('POSTGRES_POOL_TIMEOUT', DEFAULT_TIMEOUT)),
+    }
+    settings.update(overrides)
+    settings['max_size'] = max(settings['min_size'], settings['max_size'])
+    return settings
+
+
+def open_pool(conninfo='', connect_kwargs=None, name=None, **settings):
+    """Opens a psycopg_pool ConnectionPool.
+
+    Connections are health-checked with a quick round trip when they are handed out, so a
+    connection dropped by the server or a proxy is replaced instead of failing the caller.
+    Use it as `with pool.connection() as conn:`, which commits on success and rolls back
+    on an error.
+    """
+    settings = pool_settings(**settings)
+    pool = ConnectionPool(conninfo, kwargs=connect_kwargs or {}, name=name, open=False,
+                          check=ConnectionPool.check_connection, **settings)
+    pool.open()
+    return pool
+
+
+async def open_async_pool(conninfo='', connect_kwargs=None, name=None, **settings):
+    """Opens a psycopg_pool AsyncConnectionPool, the asyncio version of open_pool.
+
+    The pool belongs to the event loop it was opened in.
+    """
+    settings = pool_settings(**settings)
+    pool = AsyncConnectionPool(conninfo, kwargs=connect_kwargs or {}, name=name, open=False,
+                               check=AsyncConnectionPool.check_connection, **settings)
+    await pool.open()
+    return pool
+
+
+class DirectConnections:
+    """Opens a new connection for every `connection()`, with the same interface as a pool.
+
+    For comparing pooled and per-request connections.
+    """
+
+    def __init__(self, conninfo='', connect_kwargs=None):
+        self.conninfo = conninfo
+        self.connect_kwargs = connect_kwargs or {}
+
+    @contextmanager
+    def connection(self):
+        with psycopg.connect(self.conninfo, **self.connect_kwargs) as conn:
+            yield conn
+
+    def close(self):
+        pass
+
+
+class AsyncDirectConnections:
+    """The asyncio version of DirectConnections."""
+
+    def __init__(self, conninfo='', connect_kwargs=None):
+        self.conninfo = conninfo
+        self.connect_kwargs = connect_kwargs or {}
+
+    @asynccontextmanager
+    async def connection(self):
+        async with await psycopg.AsyncConnection.connect(self.conninfo, **self.connect_kwargs) as conn:
+            yield conn
+
+    async def close(self):
+        pass
@@ -0,0 +1,195 @@
+import asyncio
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses worth retrying after a pause: rate limited, or briefly unavailable.
+RETRY_STATUSES = (429, 503)
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_TIMEOUT = 30
+MAX_BACKOFF_SECONDS = 30.0
+
+
+def encode_ndjson(rows):
+    """Encodes rows as a newline-delimited JSON body."""
+    return b''.join(json.dumps(row).encode('utf-8') + b'\n' for row in rows)
+
+
+def api_host_url(url, api_host):
+    """Returns `url` with its scheme and host replaced by `api_host` (if one is given)."""
+    if not api_host:
+        return url
+    parts = urlsplit(url)
+    return api_host.rstrip('/') + url[len(f"{parts.scheme}://{parts.netloc}"):]
+
+
+def retry_delay(headers, attempt):
+    """Seconds to wait before retrying, from Retry-After or the rate-limit reset if Tinybird sent one."""
+    for header in ('Retry-After', 'X-RateLimit-Reset'):
+        value = headers.get(header)
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+    return min(MAX_BACKOFF_SECONDS, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class RateLimitTracker:
+    """Remembers when Tinybird said the rate limit window is used up, so callers can wait it out."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pause_until = 0.0
+
+    def note(self, headers):
+        if headers.get('X-RateLimit-Remaining') == '0':
+            with self.lock:
+                self.pause_until = max(self.pause_until, time.monotonic() + retry_delay(headers, 0))
+
+    def pause(self, seconds):
+        with self.lock:
+            self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    def wait_time(self):
+        return max(0.0, self.pause_until - time.monotonic())
+
+
+class TinybirdClient:
+    """A pooled, keep-alive requests session for Tinybird API calls.
+
+    One client can be shared by many threads. Requests that get a 429 or 503 are retried
+    after the Retry-After (or X-RateLimit-Reset) delay, and when X-RateLimit-Remaining hits
+    zero, later requests wait for the window to reset instead of being rejected.
+
+    If `api_host` (or the TINYBIRD_API_HOST setting) is set, every request goes to that host
+    instead of the one in its URL, e.g. http://127.0.0.1:8001 for mock_tinybird.py.
+    """
+
+    def __init__(self, token, pool_size=10, max_retries=DEFAULT_MAX_RETRIES, timeout=DEFAULT_TIMEOUT,
+                 api_host=None):
+        self.api_host = api_host or os.getenv('TINYBIRD_API_HOST')
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limit = RateLimitTracker()
+
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        url = api_host_url(url, self.api_host)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            delay = self.rate_limit.wait_time()
+            if delay:
+                time.sleep(delay)
+
+            response = self.session.request(method, url, **kwargs)
+            self.rate_limit.note(response.headers)
+
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+
+            delay = retry_delay(response.headers, attempt)
+            self.rate_limit.pause(delay)
+            print(f"WARNING: Tinybird returned {response.status_code}, retrying in {delay:.1f}s.")
+            response.close()
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post_events(self, url, body, compress=True, **kwargs):
+        """Posts an NDJSON body (bytes, or a list of rows) to the Events API, gzipped by default."""
+        if not isinstance(body, bytes):
+            body = encode_ndjson(body)
+        headers = {}
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        return self.request('POST', url, data=body, headers=headers, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncTinybirdClient:
+    """The asyncio version of TinybirdClient, built on one aiohttp session and connection pool.
+
+    `request`, `get` and `post_events` return aiohttp responses, so use them with
+    `async with` to release the connection back to the pool.
+    """
+
+    def __init__(self, token, limit=100, limit_per_host=0, keepalive_timeout=30,
+                 max_retries=DEFAULT_MAX_RETRIES, timeout=DEFAULT_TIMEOUT, api_host=None):
+        self.token = token
+        self.api_host = api_host or os.getenv('TINYBIRD_API_HOST')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limit = RateLimitTracker()
+        self.session = None
+
+    async def open(self):
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout)
+        self.session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self.token}"},
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=self.timeout)
+        )
+        return self
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, method, url, **kwargs):
+        url = api_host_url(url, self.api_host)
+        for attempt in range(self.max_retries + 1):
+            delay = self.rate_limit.wait_time()
+            if delay:
+                await asyncio.sleep(delay)
+
+            response = await self.session.request(method, url, **kwargs)
+            self.rate_limit.note(response.headers)
+
+            if response.status not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+
+            delay = retry_delay(response.headers, attempt)
+            self.rate_limit.pause(delay)
+            print(f"WARNING: Tinybird returned {response.status}, retrying in {delay:.1f}s.")
+            response.release()
+
+    async def get(self, url, params=None, **kwargs):
+        return await self.request('GET', url, params=params, **kwargs)
+
+    async def post_events(self, url, body, compress=True, **kwargs):
+        """Posts an NDJSON body (bytes, or a list of rows) to the Events API, gzipped by default."""
+        if not isinstance(body, bytes):
+            body = encode_ndjson(body)
+        headers = {}
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        return await self.request('POST', url, data=body, headers=headers, **kwargs)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
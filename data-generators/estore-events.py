@@ -3,11 +3,15 @@ import time
 import datetime
 import requests
 import os
+import sys
 import psycopg
 import yaml
 from pathlib import Path
 from dotenv import load_dotenv
 
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import TinybirdClient
+
 # Load environment variables from .env.local
 script_dir = Path(__file__).parent
 env_path = script_dir / '.env.local'
@@ -46,6 +50,9 @@ DUPLICATE_DATA_PERCENTAGE = options["duplicate_data_percentage"]
 DB_UPDATE_INTERVAL_MINUTES = options["db_update_interval_minutes"] # Convert minutes to seconds
 EVENT_TYPE_WEIGHTS = options["event_type_weights"]
 
+# One pooled keep-alive client for every event post.
+tinybird_client = TinybirdClient(TINYBIRD_TARGET_TOKEN)
+
 # Database setup (conditional)
 if options.get("write_to_postgres", False):  # Check if write_to_postgres is True
     conn = psycopg.connect(
@@ -147,8 +154,7 @@ def generate_event():
 def send_event_to_tinybird(event):
     """Sends an event to the Tinybird API endpoint with authentication."""
     try:
-        headers = {"Authorization": f"Bearer {TINYBIRD_TARGET_TOKEN}"}
-        response = requests.post(TINYBIRD_API_ENDPOINT, json=event, headers=headers)
+        response = tinybird_client.post_events(TINYBIRD_API_ENDPOINT, [event])
         response.raise_for_status() 
         print(f"Event sent to Tinybird: {event}")
     except requests.exceptions.RequestException as e:
@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+from dotenv import load_dotenv
+
+from checkpoint import open_checkpoint
+from dedup import open_dedup
+import metrics
+from poller import poller_from_env
+from reports_source import pipe_url
+from schema_registry import get_schema
+from spool import spool_from_env
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import AsyncTinybirdClient
+
+# Get the directory of the current script
+script_dir = Path(__file__).parent
+
+# Construct the path to .env.local within the script's directory
+env_path = script_dir / '.env.local'
+load_dotenv(dotenv_path=env_path)
+
+SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 5000))
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH')
+
+# Used when the sink has no checkpoint yet.
+DEFAULT_START_TIME = '2024-09-01 00:00:00'
+
+# Queue sizes between stages. A full queue makes the stage before it wait, so at most this
+# many batches sit in memory between any two stages.
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_WRITERS = 4
+
+END_OF_STREAM = None
+
+
+class AsyncEventsSink:
+    """Posts batches to the Tinybird Events API as gzipped NDJSON bodies on a pooled client.
+
+    Like the other sinks, write() returns the rows that did not go in. Each body is posted
+    on its own, so only the rows of the bodies that failed are returned; the Events API only
+    appends, so the ones it took must not be posted again.
+    """
+
+    name = 'tinybird'
+    checkpoint_name = 'tb_to_tb'
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.url = os.getenv('EVENTS_API_URL', "https://api.us-west-2.aws.tinybird.co/v0/events?name=weather_data_json")
+        self.client = AsyncTinybirdClient(os.getenv('TINYBIRD_TARGET_TOKEN'))
+        self.max_bytes = max_bytes
+        self.encode = get_schema().converter('events')
+
+    async def open(self, writers):
+        self.client.limit = writers
+        await self.client.open()
+
+    def transform(self, rows):
+        """Encodes a batch into NDJSON bodies of at most `max_bytes` each.
+
+        Returns (start, end, body) for each body, where rows[start:end] are the rows in it.
+        """
+        bodies = []
+        lines = []
+        size = 0
+        start = 0
+        for index, line in enumerate(self.encode(rows)):
+            if lines and size + len(line) > self.max_bytes:
+                bodies.append((start, index, b''.join(lines)))
+                lines, size, start = [], 0, index
+            lines.append(line)
+            size += len(line)
+        if lines:
+            bodies.append((start, len(rows), b''.join(lines)))
+        return bodies
+
+    async def write(self, rows, bodies, writer_id):
+        failed = []
+        for start, end, body in bodies:
+            if not await self.post(body, end - start):
+                failed += rows[start:end]
+        return failed
+
+    async def post(self, body, num_rows):
+        """Posts one body and returns True if the Events API took it."""
+        try:
+            async with await self.client.post_events(self.url, body) as response:
+                if response.status not in (200, 202):
+                    print(f"ERROR: Events API batch of {num_rows} rows failed with status code: "
+                          f"{response.status} - {await response.text()}")
+                    return False
+                try:
+                    result = await response.json(content_type=None)
+                except ValueError:
+                    # The rows were accepted; only the summary of them is missing.
+                    print(f"WARNING: Events API took a batch of {num_rows} rows but its response was not JSON.")
+                    return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"ERROR: Events API request error for batch of {num_rows} rows: {e}")
+            return False
+
+        quarantined = result.get('quarantined_rows', 0)
+        if quarantined:
+            metrics.rows_quarantined.inc(quarantined)
+            print(f"WARNING: Events API quarantined {quarantined} of {num_rows} rows in a batch.")
+        return True
+
+    async def commit_watermark(self, timestamp):
+        pass
+
+    async def close(self):
+        await self.client.close()
+
+
+class AsyncPostgresSink:
+    """Upserts batches with COPY into a staging table and one merge, one connection per writer."""
+
+    name = 'postgres'
+    checkpoint_name = 'tb_to_postgres'
+
+    def __init__(self):
+        self.conninfo = {
+            'dbname': os.getenv("POSTGRES_DATABASE_NAME"),
+            'user': os.getenv("POSTGRES_DATABASE_USER"),
+            'password': os.getenv("POSTGRES_DATABASE_PASSWORD"),
+            'host': os.getenv("POSTGRES_DATABASE_HOST"),
+            'port': os.getenv("POSTGRES_DATABASE_PORT")
+        }
+        self.connections = []
+
+    async def open(self, writers):
+        import psycopg
+        import postgres_sink
+
+        self.psycopg = psycopg
+        self.sql = postgres_sink
+        self.connections = [await self.connect() for _ in range(writers)]
+
+    async def connect(self):
+        """Opens a writer's connection and creates its staging table, which lasts as long as the connection."""
+        conn = await self.psycopg.AsyncConnection.connect(**self.conninfo)
+        async with conn.cursor() as cur:
+            await cur.execute(self.sql.CREATE_STAGING_SQL)
+        await conn.commit()
+        return conn
+
+    async def discard(self, writer_id):
+        """Drops a writer's connection, so its next batch opens a new one."""
+        conn, self.connections[writer_id] = self.connections[writer_id], None
+        if conn is not None:
+            try:
+                await conn.close()
+            except self.psycopg.Error:
+                pass
+
+    def transform(self, rows):
+        return get_schema().converter('postgres')(rows)
+
+    async def write(self, rows, batch, writer_id):
+        # Each writer has its own connection, and so its own staging table. One that was
+        # dropped is reopened here.
+        try:
+            conn = self.connections[writer_id]
+            if conn is None or conn.closed:
+                await self.discard(writer_id)
+                conn = self.connections[writer_id] = await self.connect()
+            async with conn.cursor() as cur:
+                async with cur.copy(self.sql.COPY_STAGING_SQL) as copy:
+                    for values in batch:
+                        await copy.write_row(values)
+                await cur.execute(self.sql.MERGE_STAGING_SQL)
+            await conn.commit()
+        except self.psycopg.OperationalError as e:
+            print(f"ERROR: Database connection error while inserting/updating data: {e}")
+            await self.discard(writer_id)
+            return rows
+        except self.psycopg.Error as e:
+            print(f"ERROR: Database error while inserting/updating data: {e}")
+            try:
+                if self.connections[writer_id] is not None:
+                    await self.connections[writer_id].rollback()
+            except self.psycopg.Error:
+                await self.discard(writer_id)
+            return rows
+        return []
+
+    async def commit_watermark(self, timestamp):
+        pass
+
+    async def close(self):
+        for writer_id in range(len(self.connections)):
+            await self.discard(writer_id)
+
+
+class AsyncMongoSink:
+    """Sends batches as unordered bulk upserts through pymongo's async client (or motor)."""
+
+    name = 'mongodb'
+    checkpoint_name = 'tb_to_mongodb'
+
+    def __init__(self):
+        self.client = None
+        self.collection = None
+
+    async def open(self, writers):
+        try:
+            from pymongo import AsyncMongoClient
+        except ImportError:
+            from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+        from pymongo.errors import BulkWriteError
+        from mongodb_sink import failed_writes, upsert_ops
+
+        self.BulkWriteError = BulkWriteError
+        self.failed_writes = failed_writes
+        self.upsert_ops = upsert_ops
+        self.client = AsyncMongoClient(os.getenv("MONGODB_CONNECTION_STRING"), maxPoolSize=writers)
+        self.collection = self.client[os.getenv("MONGODB_DATABASE_NAME")][os.getenv("MONGODB_COLLECTION_NAME")]
+
+    def transform(self, rows):
+        return self.upsert_ops(rows)
+
+    async def write(self, rows, ops, writer_id):
+        try:
+            await self.collection.bulk_write(ops, ordered=False)
+        except self.BulkWriteError as e:
+            # The upserts are keyed, so writing the whole batch again is harmless.
+            self.failed_writes(e.details, len(ops))
+            return rows
+        return []
+
+    async def commit_watermark(self, timestamp):
+        pass
+
+    async def close(self):
+        if self.client:
+            result = self.client.close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class AsyncDynamoSink:
+    """Runs the boto3-based DynamoSink in worker threads, since there is no asyncio DynamoDB driver here."""
+
+    name = 'dynamodb'
+    checkpoint_name = 'tb_to_dynamodb'
+
+    def __init__(self):
+        self.sink = None
+
+    async def open(self, writers):
+        from botocore.exceptions import ClientError
+        from dynamodb_sink import DynamoSink
+
+        self.ClientError = ClientError
+        self.sink = DynamoSink(os.getenv("DYNAMODB_TABLE_NAME"), region_name=os.getenv("DYNAMODB_AWS_REGION"),
+                               endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None,
+                               segment_size=int(os.getenv('DYNAMODB_SEGMENT_SIZE', 500)))
+
+    def transform(self, rows):
+        return rows
+
+    async def write(self, rows, payload, writer_id):
+        written = await asyncio.to_thread(self.sink.write, payload)
+        return [] if written == len(rows) else rows
+
+    async def commit_watermark(self, timestamp):
+        """Moves the table's watermark item too, as tb_to_dynamodb.py does."""
+        try:
+            await asyncio.to_thread(self.sink.commit_watermark, timestamp)
+        except self.ClientError as e:
+            print(f"WARNING: Could not move the watermark item in {self.sink.table_name}: {e}")
+
+    async def close(self):
+        pass
+
+
+# Drivers are imported in each sink's open(), so only the chosen target's driver is needed.
+SINKS = {
+    'tinybird': AsyncEventsSink,
+    'postgres': AsyncPostgresSink,
+    'mongodb': AsyncMongoSink,
+    'dynamodb': AsyncDynamoSink,
+}
+
+
+async def fetch_stage(client, params, out_queue, batch_size, dedup):
+    """Streams the pipe as NDJSON and puts row batches on `out_queue` as they arrive.
+
+    Rows the dedup index says were already delivered are dropped before they are queued.
+    """
+    newest = None
+    rows_fetched = 0
+    batch = []
+
+    started = time.perf_counter()
+    async with await client.get(pipe_url('ndjson'), params=params) as response:
+        metrics.fetch_seconds.observe(time.perf_counter() - started)
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            batch.append(row)
+            if newest is None or row['timestamp'] > newest:
+                newest = row['timestamp']
+            if len(batch) >= batch_size:
+                metrics.rows_fetched.inc(len(batch))
+                rows_fetched += len(batch)
+                await out_queue.put(list(dedup.fresh(batch)))  # Waits here while the next stage is busy.
+                batch = []
+
+    if batch:
+        metrics.rows_fetched.inc(len(batch))
+        rows_fetched += len(batch)
+        await out_queue.put(list(dedup.fresh(batch)))
+
+    return rows_fetched, newest
+
+
+async def spool_failed(spool, rows, failed, results, dedup):
+    """Spools the rows a batch could not write. Records the batch's rows in the dedup index if
+    they are all written or spooled; otherwise only the written ones, and counts the rest as failed."""
+    if failed and not await asyncio.to_thread(spool.add, failed):
+        failed_ids = {id(row) for row in failed}
+        dedup.add([row for row in rows if id(row) not in failed_ids])
+        results['failed'] += len(failed)
+        return
+    dedup.add(rows)
+    results['spooled'] += len(failed)
+
+
+async def write_rows(sink, rows, writer_id):
+    """Transforms and writes one batch. Returns the rows that did not go in."""
+    return await sink.write(rows, sink.transform(rows), writer_id)
+
+
+async def transform_stage(sink, in_queue, out_queue, results, spool, dedup):
+    """Converts row batches into whatever the sink writes, off the fetch and write paths."""
+    while True:
+        batch = await in_queue.get()
+        if batch is END_OF_STREAM:
+            return
+        if not batch:
+            continue
+        try:
+            payload = sink.transform(batch)
+        except Exception as e:
+            # Keep taking batches, otherwise the fetch stage could wait forever.
+            print(f"ERROR: Transforming a batch of {len(batch)} rows failed: {e}")
+            metrics.write_failures.inc(sink=sink.name)
+            await spool_failed(spool, batch, batch, results, dedup)
+            continue
+        await out_queue.put((batch, payload))
+
+
+async def write_stage(sink, in_queue, writer_id, results, spool, dedup):
+    while True:
+        item = await in_queue.get()
+        if item is END_OF_STREAM:
+            return
+        rows, payload = item
+        num_rows = len(rows)
+        started = time.perf_counter()
+        try:
+            failed = await sink.write(rows, payload, writer_id)
+        except Exception as e:
+            # Keep the writer alive, otherwise the stages before it could wait forever.
+            print(f"ERROR: Writer {writer_id} failed: {e}")
+            failed = rows
+        metrics.write_seconds.observe(time.perf_counter() - started, sink=sink.name)
+        metrics.batch_rows.observe(num_rows, sink=sink.name)
+        metrics.rows_written.inc(num_rows - len(failed), sink=sink.name)
+        if failed:
+            metrics.write_failures.inc(sink=sink.name)
+        results['written'] += num_rows - len(failed)
+        # Recorded even if the window fails elsewhere, so its refetch skips these rows.
+        await spool_failed(spool, rows, failed, results, dedup)
+
+
+async def run_window(client, sink, writers, queue_size, params, spool, dedup):
+    """Moves one window through fetch -> transform -> write and returns (ok, rows, newest).
+
+    Batches that cannot be written are spooled, so the window is ok unless the fetch failed
+    or a batch could be neither written nor spooled.
+    """
+    fetched = asyncio.Queue(maxsize=queue_size)
+    transformed = asyncio.Queue(maxsize=queue_size)
+    results = {'written': 0, 'spooled': 0, 'failed': 0}
+
+    transformer = asyncio.create_task(transform_stage(sink, fetched, transformed, results, spool, dedup))
+    write_tasks = [asyncio.create_task(write_stage(sink, transformed, i, results, spool, dedup))
+                   for i in range(writers)]
+
+    try:
+        rows_fetched, newest = await fetch_stage(client, params, fetched, STREAM_BATCH_SIZE, dedup)
+    except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+        print(f"ERROR: API request error: {e}")
+        rows_fetched, newest = None, None
+
+    await fetched.put(END_OF_STREAM)
+    await transformer
+    for _ in write_tasks:
+        await transformed.put(END_OF_STREAM)
+    await asyncio.gather(*write_tasks)
+
+    ok = rows_fetched is not None and results['failed'] == 0
+    return ok, results['written'], newest
+
+
+async def main(args):
+    sink = SINKS[args.sink]()
+    checkpoint = open_checkpoint(sink.checkpoint_name, CHECKPOINT_PATH)
+    # Shared with the sink's own tb_to_* script, like the checkpoint.
+    dedup = open_dedup(sink.checkpoint_name)
+    # One more writer than the pipeline uses, for the spool's retries.
+    await sink.open(args.writers + 1)
+    poller = poller_from_env(max_interval=args.interval)
+
+    # Batches that fail are spooled to disk and retried in the background, in the same spool
+    # as the sink's own tb_to_* script. Retries run on this event loop, from the spool's thread.
+    loop = asyncio.get_running_loop()
+    spool = spool_from_env(sink.checkpoint_name, lambda rows: not asyncio.run_coroutine_threadsafe(
+        write_rows(sink, rows, args.writers), loop).result())
+    spool.start()
+
+    async with AsyncTinybirdClient(SOURCE_KEY, timeout=60) as client:
+        try:
+            while True:
+                started = time.monotonic()
+                # Start a little before the watermark, so rows that share its second or arrive
+                # late are fetched; the dedup index drops the ones already written.
+                watermark = checkpoint.load()
+                params = {'start_time': dedup.overlap_start(watermark) if watermark else DEFAULT_START_TIME,
+                          'end_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+
+                ok, written, newest = await run_window(client, sink, args.writers, args.queue_size, params, spool, dedup)
+
+                elapsed = time.monotonic() - started
+                if not written and ok:
+                    print("INFO: No new data found.")
+                else:
+                    print(f"INFO: Wrote {written} rows in {elapsed:.1f}s ({written / max(elapsed, 0.001):.0f} rows/sec).")
+
+                # Batches finish out of order across writers, so only commit a window once
+                # every batch in it is written or spooled.
+                if ok and newest:
+                    # Save the index first: after a crash it may list rows past the watermark, never fewer.
+                    dedup.save(newest)
+                    await sink.commit_watermark(newest)
+                    checkpoint.commit(newest)
+                    metrics.watermark_committed(newest, args.sink)
+
+                # Straight on to the next window while there is a backlog, longer waits while quiet.
+                delay = poller.next_delay((written, newest) if ok else None, started)
+                await asyncio.sleep(max(0, delay - (time.monotonic() - started)))
+        finally:
+            await sink.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy weather reports from Tinybird to a target with an asyncio pipeline.')
+    parser.add_argument('--sink', choices=list(SINKS), required=True, help='Target to write to')
+    parser.add_argument('--writers', type=int, default=DEFAULT_WRITERS, help='Batches written concurrently')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='Batches buffered between stages')
+    parser.add_argument('--interval', type=float, default=60, help='Longest wait between polls, in seconds')
+    args = parser.parse_args()
+
+    # Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+    metrics.start('async_transfer')
+
+    asyncio.run(main(args))
@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from mock_tinybird import SyntheticReports
+
+# Get the directory of the current script
+script_dir = Path(__file__).parent
+
+# Construct the path to .env.local within the script's directory
+env_path = script_dir / '.env.local'
+load_dotenv(dotenv_path=env_path)
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_BATCH_SIZE = 5000
+
+# Per-row modes make one request per row, so by default they are only run up to this size.
+DEFAULT_ROW_MODE_MAX_ROWS = 100000
+
+# Every run writes the same reports: 50 sites, one report a minute, from this time on.
+DATASET_START = datetime(2024, 1, 1)
+DATASET_END = datetime(2100, 1, 1)
+
+# The modes each sink is measured in; the first one is the old one-row-at-a-time behavior.
+SINK_MODES = {
+    'tinybird': ('row', 'batch'),
+    'postgres': ('row', 'copy'),
+    'mongodb': ('row', 'bulk'),
+    'dynamodb': ('row', 'batch'),
+}
+
+BENCH_TABLE = 'weather_reports'
+BENCH_DYNAMODB_TABLE = 'weather_reports_benchmark'
+
+
+def dataset(rows, batch_size):
+    """Yields the fixed benchmark dataset as lists of `batch_size` reports, built as they are needed."""
+    reports = SyntheticReports().reports(DATASET_START, DATASET_END, limit=rows)
+    while True:
+        batch = list(islice(reports, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# --- Sink setup, run in the benchmark process for each case ---
+
+def open_tinybird(mode, settings):
+    from events_sink import EventsApiSink
+    from tinybird_client import TinybirdClient
+
+    client = TinybirdClient('benchmark', api_host=settings['events_host'], max_retries=0)
+    url = f"{settings['events_host']}/v0/events?name=weather_reports_benchmark"
+    # In batch mode each write is posted as one request, like tb_to_tb.py with the default settings.
+    sink = EventsApiSink(url, client, max_rows=1 if mode == 'row' else settings['batch_size'],
+                         max_wait=float('inf'))
+
+    def posted(action):
+        """Wraps write or flush to return the number of rows posted, like the other sinks."""
+        def run(*args):
+            before = sink.totals['rows'] - sink.totals['failed_rows']
+            action(*args)
+            return sink.totals['rows'] - sink.totals['failed_rows'] - before
+        return run
+    return posted(sink.write), posted(sink.flush), client.close
+
+
+def open_postgres(mode, settings):
+    import psycopg
+    from postgres_sink import COLUMNS, KEY_COLUMNS, PostgresSink
+
+    with open(script_dir / 'schema.json', 'r') as f:
+        schema = json.load(f)[BENCH_TABLE]
+    column_types = {column['name']: column['type'] for column in schema['columns']}
+
+    conn = psycopg.connect(settings['postgres'])
+    with conn.cursor() as cur:
+        columns = ', '.join(f'"{column}" {column_types[column]}' for column in COLUMNS)
+        keys = ', '.join(f'"{column}"' for column in KEY_COLUMNS)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {BENCH_TABLE} ({columns}, PRIMARY KEY ({keys}))")
+        cur.execute(f"TRUNCATE {BENCH_TABLE}")
+    conn.commit()
+
+    sink = PostgresSink(conn, mode=mode, batch_size=settings['batch_size'])
+    return sink.write, lambda: 0, conn.close
+
+
+def open_mongodb(mode, settings):
+    from pymongo import MongoClient
+    from mongodb_sink import MongoSink
+
+    client = MongoClient(settings['mongodb'])
+    collection = client['benchmark'][BENCH_TABLE]
+    collection.drop()
+
+    sink = MongoSink(collection, mode=mode, batch_size=settings['batch_size'])
+    if mode == 'bulk':
+        sink.create_index()
+    return sink.write, lambda: 0, client.close
+
+
+def open_dynamodb(mode, settings):
+    import boto3
+    from dynamodb_sink import DynamoSink
+
+    endpoint_url = settings['dynamodb']
+    stop = lambda: None
+    if not endpoint_url:
+        # No DynamoDB Local given, so stand in with moto's in-memory DynamoDB.
+        from moto import mock_aws
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'benchmark')
+        mocked = mock_aws()
+        mocked.start()
+        stop = mocked.stop
+
+    region = os.getenv('DYNAMODB_AWS_REGION') or 'us-east-1'
+    dynamodb = boto3.resource('dynamodb', region_name=region, endpoint_url=endpoint_url)
+    table = dynamodb.Table(BENCH_DYNAMODB_TABLE)
+    if BENCH_DYNAMODB_TABLE in [existing.name for existing in dynamodb.tables.all()]:
+        table.delete()
+        table.wait_until_not_exists()
+    dynamodb.create_table(TableName=BENCH_DYNAMODB_TABLE, BillingMode='PAY_PER_REQUEST',
+                          KeySchema=[{'AttributeName': 'site_name', 'KeyType': 'HASH'},
+                                     {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+                          AttributeDefinitions=[{'AttributeName': 'site_name', 'AttributeType': 'S'},
+                                                {'AttributeName': 'timestamp', 'AttributeType': 'S'}]
+                          ).wait_until_exists()
+
+    sink = DynamoSink(BENCH_DYNAMODB_TABLE, region_name=region, endpoint_url=endpoint_url, mode=mode,
+                      workers=int(os.getenv('DYNAMODB_WRITERS', 1)))
+    return sink.write, lambda: 0, stop
+
+
+OPENERS = {'tinybird': open_tinybird, 'postgres': open_postgres, 'mongodb': open_mongodb, 'dynamodb': open_dynamodb}
+
+
+def run_case(sink_name, mode, rows, settings):
+    """Writes `rows` reports through one sink and mode and returns the measurements.
+
+    Runs in a fresh process, so peak RSS belongs to this case alone. Only the sink calls are
+    timed; building the synthetic batches is not.
+    """
+    write, flush, close = OPENERS[sink_name](mode, settings)
+    baseline_rss = peak_rss_mb()
+
+    latencies = []
+    written = 0
+    try:
+        for batch in dataset(rows, settings['batch_size']):
+            started = time.perf_counter()
+            written += write(batch)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        written += flush()
+        if latencies:
+            latencies[-1] += time.perf_counter() - started
+    finally:
+        close()
+
+    seconds = sum(latencies)
+    return {
+        'sink': sink_name,
+        'mode': mode,
+        'rows': rows,
+        'batch_size': settings['batch_size'],
+        'rows_written': written,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(written / seconds, 1) if seconds else None,
+        'batches': len(latencies),
+        'batch_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'batch_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+# --- Harness ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_mock_events_api():
+    """Starts common/mock_tinybird.py in its own process and returns (process, base URL)."""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, str(script_dir.parent / 'common' / 'mock_tinybird.py'),
+                                '--port', str(port), '--log-interval', '0'], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The mock Events API did not start.")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Prints the rows/sec change for every case that is also in the baseline report."""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    previous = {(r['sink'], r['mode'], r['rows']): r for r in baseline['results'] if r.get('rows_per_second')}
+    print(f"INFO: Compared with {baseline_path} (commit {baseline.get('commit')}):")
+    for result in results:
+        before = previous.get((result['sink'], result['mode'], result['rows']))
+        if before and result.get('rows_per_second'):
+            change = (result['rows_per_second'] / before['rows_per_second'] - 1) * 100
+            print(f"  {result['sink']:<9} {result['mode']:<6} {result['rows']:>8} rows: "
+                  f"{before['rows_per_second']:>10.0f} -> {result['rows_per_second']:>10.0f} rows/sec ({change:+.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure write throughput of the data-transfer sinks.')
+    parser.add_argument('--sinks', default=','.join(SINK_MODES), help='Comma-separated sinks to measure')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma-separated dataset sizes, in rows')
+    parser.add_argument('--modes', help='Comma-separated modes to run (default: every mode of each sink)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows handed to the sink per write')
+    parser.add_argument('--row-mode-max-rows', type=int, default=DEFAULT_ROW_MODE_MAX_ROWS,
+                        help='Skip per-row modes for datasets larger than this (0 for no limit)')
+    parser.add_argument('--events-host', help='Events API host to post to (default: start common/mock_tinybird.py)')
+    parser.add_argument('--postgres', default=os.getenv('BENCH_POSTGRES_URL'),
+                        help='Postgres conninfo for a scratch database; its weather_reports table is truncated')
+    parser.add_argument('--mongodb', default=os.getenv('BENCH_MONGODB_URL'),
+                        help='MongoDB connection string; the benchmark.weather_reports collection is dropped')
+    parser.add_argument('--dynamodb', default=os.getenv('BENCH_DYNAMODB_ENDPOINT'),
+                        help='DynamoDB Local endpoint URL (default: moto in memory)')
+    parser.add_argument('--output', help='Write the JSON report here as well as printing it')
+    parser.add_argument('--baseline', help='An earlier JSON report to compare rows/sec with')
+    args = parser.parse_args()
+
+    sinks = args.sinks.split(',')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    modes = args.modes.split(',') if args.modes else None
+
+    settings = {'batch_size': args.batch_size, 'events_host': args.events_host, 'postgres': args.postgres,
+                'mongodb': args.mongodb, 'dynamodb': args.dynamodb}
+    mock = None
+    if 'tinybird' in sinks and not args.events_host:
+        mock, settings['events_host'] = start_mock_events_api()
+        print(f"INFO: Started the mock Events API on {settings['events_host']}.")
+
+    results = []
+    try:
+        for sink_name in sinks:
+            if sink_name not in SINK_MODES:
+                print(f"ERROR: Unknown sink {sink_name}, skipping it.")
+                continue
+            if sink_name in ('postgres', 'mongodb') and not settings[sink_name]:
+                print(f"WARNING: Skipping {sink_name}: set --{sink_name} (or BENCH_{sink_name.upper()}_URL) to a scratch database.")
+                continue
+
+            for mode in SINK_MODES[sink_name]:
+                if modes and mode not in modes:
+                    continue
+                for rows in sizes:
+                    if mode == 'row' and args.row_mode_max_rows and rows > args.row_mode_max_rows:
+                        print(f"INFO: Skipping {sink_name} {mode} mode at {rows} rows (over --row-mode-max-rows).")
+                        continue
+
+                    print(f"INFO: Writing {rows} rows to {sink_name} in {mode} mode...")
+                    # One process per case, so peak RSS is not carried over from earlier cases.
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                        try:
+                            result = executor.submit(run_case, sink_name, mode, rows, settings).result()
+                        except Exception as e:
+                            print(f"ERROR: {sink_name} {mode} mode at {rows} rows failed: {e}")
+                            result = {'sink': sink_name, 'mode': mode, 'rows': rows, 'error': str(e)}
+                    results.append(result)
+                    if 'error' not in result:
+                        print(f"INFO: {result['rows_per_second']:.0f} rows/sec, batch p50/p99 "
+                              f"{result['batch_p50_ms']}/{result['batch_p99_ms']} ms, peak RSS {result['peak_rss_mb']} MB.")
+    finally:
+        if mock:
+            mock.terminate()
+            mock.wait()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'batch_size': args.batch_size,
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"INFO: Report written to {args.output}.")
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# Default store, shared by all the transfer scripts in this folder.
+DEFAULT_CHECKPOINT_PATH = Path(__file__).parent / 'checkpoints.db'
+
+
+class SqliteCheckpoint:
+    """Keeps the watermark for `name` in a SQLite database.
+
+    Several scripts can share one database file, each under its own name. Every commit is
+    its own transaction, so a crash leaves either the old or the new watermark in place.
+    One instance can be shared between threads.
+    """
+
+    def __init__(self, path, name):
+        self.path = str(path)
+        self.name = name
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, last_timestamp TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+
+    def load(self):
+        """Returns the last committed timestamp, or None if nothing has been committed yet."""
+        with self.lock:
+            row = self.conn.execute("SELECT last_timestamp FROM checkpoints WHERE name = ?", (self.name,)).fetchone()
+        return row[0] if row else None
+
+    def commit(self, timestamp):
+        """Records `timestamp` as the watermark. It is never moved backwards."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO checkpoints (name, last_timestamp, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET last_timestamp = excluded.last_timestamp, updated_at = excluded.updated_at
+                WHERE excluded.last_timestamp > checkpoints.last_timestamp
+                """,
+                (self.name, timestamp, datetime.utcnow().isoformat())
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class FileCheckpoint:
+    """Keeps watermarks in a small JSON file, keyed by name.
+
+    Commits write a temporary file and rename it over the old one, so readers never see a
+    half-written file. Unlike SqliteCheckpoint, this is not safe for several processes
+    committing to the same file at once.
+    """
+
+    def __init__(self, path, name):
+        self.path = Path(path)
+        self.name = name
+
+    def _read_all(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def load(self):
+        """Returns the last committed timestamp, or None if nothing has been committed yet."""
+        entry = self._read_all().get(self.name)
+        return entry['last_timestamp'] if entry else None
+
+    def commit(self, timestamp):
+        """Records `timestamp` as the watermark. It is never moved backwards."""
+        checkpoints = self._read_all()
+        entry = checkpoints.get(self.name)
+        if entry and entry['last_timestamp'] >= timestamp:
+            return
+
+        checkpoints[self.name] = {'last_timestamp': timestamp, 'updated_at': datetime.utcnow().isoformat()}
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(checkpoints, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        pass
+
+
+def open_checkpoint(name, path=None):
+    """Opens the checkpoint store at `path`, using a JSON file for *.json paths and SQLite otherwise."""
+    path = Path(path) if path else DEFAULT_CHECKPOINT_PATH
+    if path.suffix == '.json':
+        return FileCheckpoint(path, name)
+    return SqliteCheckpoint(path, name)
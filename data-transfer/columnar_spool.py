@@ -0,0 +1,128 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import requests
+
+import metrics
+from reports_source import (DEFAULT_MAX_SHARD_ROWS, DEFAULT_SHARD, DEFAULT_STREAM_BATCH_SIZE, DEFAULT_TIMEOUT,
+                            TIME_FORMAT, ShardTooLarge, backfill, pipe_url)
+from schema_registry import get_schema
+
+FILE_TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def arrow_schema(schema):
+    """The Arrow schema for a TableSchema. Timestamps stay text, exactly as the pipe returns them."""
+    return pa.schema([(column, pa.float64() if schema.types[column] == 'FLOAT' else pa.string())
+                      for column in schema.columns])
+
+
+def fetch_table(client, start_time, end_time, timeout=DEFAULT_TIMEOUT, max_rows=None):
+    """Fetches reports between start_time and end_time as CSV, parsed straight into an Arrow table.
+
+    Columns are converted a whole column at a time by the Arrow CSV reader, and no Python
+    objects are made per row. Raises ShardTooLarge like fetch_reports.
+    """
+    params = {'start_time': start_time.strftime(TIME_FORMAT), 'end_time': end_time.strftime(TIME_FORMAT)}
+    started = time.perf_counter()
+    try:
+        response = client.get(pipe_url('csv'), params=params, timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise ShardTooLarge(f"{params['start_time']} - {params['end_time']} timed out")
+    metrics.fetch_seconds.observe(time.perf_counter() - started)
+    response.raise_for_status()
+
+    schema = arrow_schema(get_schema())
+    table = pacsv.read_csv(pa.py_buffer(response.content),
+                           convert_options=pacsv.ConvertOptions(column_types=schema, include_columns=schema.names))
+    if max_rows and table.num_rows >= max_rows:
+        raise ShardTooLarge(f"{params['start_time']} - {params['end_time']} returned {table.num_rows} rows")
+    metrics.rows_fetched.inc(table.num_rows)
+    return table
+
+
+def concat(first, second):
+    return pa.concat_tables([first, second])
+
+
+class ColumnarSpool:
+    """A folder of Parquet files, one per backfill shard, that targets are loaded from.
+
+    Rows are kept as compressed columns instead of Python dicts, so a large backfill can be
+    landed once and then loaded into one or more targets, or loaded again later (say, after
+    truncating weather_reports), without calling the pipe again. Files are named after their
+    shard's time range, so they load in timestamp order.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, shard_start, shard_end):
+        return self.directory / f"{shard_start:{FILE_TIME_FORMAT}}_{shard_end:{FILE_TIME_FORMAT}}.parquet"
+
+    def land(self, shard_start, shard_end, table):
+        """Writes one shard to a temporary file and renames it into place."""
+        path = self.path(shard_start, shard_end)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=path.name, suffix='.tmp')
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp_path, compression='zstd')
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def files(self):
+        return sorted(self.directory.glob('*.parquet'))
+
+    def load(self, write_reports, batch_size=DEFAULT_STREAM_BATCH_SIZE):
+        """Hands every landed row to `write_reports(rows)` in batches of `batch_size`, oldest file first.
+
+        Only one batch is turned into Python dicts at a time. Stops at the first batch that
+        could not be written, like run_backfill, and returns False. The files are kept, so
+        the load can be run again.
+        """
+        started = time.monotonic()
+        total = 0
+        for path in self.files():
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+                rows = batch.to_pylist()
+                if rows and not write_reports(rows):
+                    print(f"ERROR: Loading stopped in {path.name}.")
+                    return False
+                total += len(rows)
+            print(f"INFO: Loaded {path.name}.")
+
+        elapsed = time.monotonic() - started
+        print(f"INFO: Loaded {total} rows from {self.directory} in {elapsed:.1f}s ({total / max(elapsed, 0.001):.0f} rows/sec).")
+        return True
+
+
+def land_backfill(client, start_time, end_time, spool, shard=DEFAULT_SHARD, workers=4, adaptive=True,
+                  max_rows=DEFAULT_MAX_SHARD_ROWS):
+    """Fetches start_time..end_time shard by shard, like backfill(), and lands each shard in `spool`.
+
+    Returns False, having landed the shards before it, if a shard could not be fetched.
+    """
+    started = time.monotonic()
+    total = 0
+    for shard_start, shard_end, table in backfill(client, start_time, end_time, shard,
+                                                  workers, adaptive, max_rows=max_rows, fetch=fetch_table,
+                                                  join=concat):
+        if table is None:
+            print(f"ERROR: Landing stopped at shard {shard_start} - {shard_end}, which could not be fetched.")
+            return False
+        path = spool.land(shard_start, shard_end, table)
+        total += table.num_rows
+        print(f"INFO: Landed shard {shard_start} - {shard_end}: {table.num_rows} rows in {path.name}.")
+
+    elapsed = time.monotonic() - started
+    print(f"INFO: Landed {total} rows in {elapsed:.1f}s ({total / max(elapsed, 0.001):.0f} rows/sec).")
+    return True
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import tempfile
+from datetime import timedelta, timezone
+from pathlib import Path
+
+from reports_source import TIME_FORMAT, parse_time
+
+# Default location for the saved indexes, one file per script.
+DEFAULT_DEDUP_DIR = Path(__file__).parent / 'dedup'
+
+DEFAULT_WINDOW_SECONDS = 60
+
+
+def site_key(site_name):
+    """A stable 64-bit hash of a site name (Python's own hash() changes between runs)."""
+    return int.from_bytes(hashlib.blake2b(site_name.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def to_utc(value):
+    moment = parse_time(str(value))
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+class DedupIndex:
+    """Remembers which (timestamp, site_name) reports were delivered in the last `window_seconds`.
+
+    Polls start `window_seconds` before the watermark (see overlap_start), so rows that share
+    the watermark's second, or arrive a little late, are fetched again. fresh() drops the
+    ones already delivered before they reach the sink, and add() records rows once they are
+    written (or spooled). Keys are grouped by timestamp and each site is kept as a 64-bit hash.
+    save(watermark) is called as the watermark is committed: it drops timestamps more than the
+    window behind that watermark, so the index stays small, and writes it atomically. Keys
+    past the committed watermark are always kept, so a window that is fetched again after a
+    failure still finds the rows it had already delivered. The index is loaded on startup.
+    """
+
+    def __init__(self, path, window_seconds=DEFAULT_WINDOW_SECONDS):
+        self.path = Path(path)
+        self.window = timedelta(seconds=window_seconds)
+        self.buckets = {}  # timestamp string -> set of site hashes
+        self.times = {}  # timestamp string -> parsed UTC datetime
+        self.load()
+
+    def __len__(self):
+        return sum(len(sites) for sites in self.buckets.values())
+
+    def fresh(self, rows):
+        """Yields the rows that have not been delivered yet. Works on a stream of rows."""
+        for row in rows:
+            if site_key(row['site_name']) not in self.buckets.get(str(row['timestamp']), ()):
+                yield row
+
+    def add(self, rows):
+        """Records rows as delivered. Nothing is dropped until the watermark is committed."""
+        for row in rows:
+            timestamp = str(row['timestamp'])
+            sites = self.buckets.get(timestamp)
+            if sites is None:
+                sites = self.buckets[timestamp] = set()
+                self.times[timestamp] = to_utc(timestamp)
+            sites.add(site_key(row['site_name']))
+
+    def evict(self, watermark):
+        """Drops timestamps more than the window behind the committed `watermark`."""
+        cutoff = to_utc(watermark) - self.window
+        for timestamp in [t for t, moment in self.times.items() if moment < cutoff]:
+            del self.buckets[timestamp]
+            del self.times[timestamp]
+
+    def overlap_start(self, watermark):
+        """The start time for a poll: `window_seconds` before the watermark.
+
+        With an empty index (say, the first run after an upgrade) there is nothing to drop
+        repeats with, so the poll starts at the watermark itself.
+        """
+        if not self.buckets:
+            return watermark
+        return (to_utc(watermark) - self.window).strftime(TIME_FORMAT)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            print(f"WARNING: Ignoring unreadable dedup index {self.path}: {e}")
+            return
+        for timestamp, sites in saved['keys'].items():
+            self.buckets[timestamp] = set(sites)
+            self.times[timestamp] = to_utc(timestamp)
+
+    def save(self, watermark=None):
+        """Drops the keys the committed `watermark` has left behind, then writes the index to a
+        temporary file and renames it over the old one."""
+        if watermark:
+            self.evict(watermark)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        saved = {'window_seconds': self.window.total_seconds(),
+                 'keys': {timestamp: sorted(sites) for timestamp, sites in self.buckets.items()}}
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def open_dedup(name):
+    """Opens the dedup index for script `name` with DEDUP_* settings from the environment."""
+    directory = Path(os.getenv('DEDUP_DIR') or DEFAULT_DEDUP_DIR)
+    return DedupIndex(directory / f"{name}.json",
+                      window_seconds=float(os.getenv('DEDUP_WINDOW_SECONDS', DEFAULT_WINDOW_SECONDS)))
@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from schema_registry import get_schema
+
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+DEFAULT_SEGMENT_SIZE = 500
+DEFAULT_MAX_RETRIES = 8
+
+# Bounds for the delay shared by all writers while the table is throttling us.
+MIN_BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 20.0
+
+# Key value of the item that holds the transfer watermark, used for every key attribute. The
+# item lives in the data table itself, so anything that scans or exports the table should
+# skip items whose keys are '__watermark__'.
+WATERMARK_KEY = '__watermark__'
+
+# Let botocore pace its own retries too; it backs off on throttling before we ever see it.
+BOTO_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10})
+
+
+class DynamoSink:
+    """Writes weather reports to a DynamoDB table.
+
+    In 'batch' mode rows are cut into segments, and each segment goes through a
+    `batch_writer`, which sends 25-item BatchWriteItem requests and resends unprocessed
+    items. With `workers` > 1 the segments are written in parallel, each thread using its
+    own boto3 resource. When the table throttles, a segment is retried after a delay that
+    is shared by all writers, grows while throttling continues and shrinks again on success.
+    'row' mode calls put_item per report, which is how the script used to work.
+
+    The transfer watermark is kept in the same table, as one item whose key attributes are
+    all WATERMARK_KEY and whose only other attribute is `last_timestamp`.
+    """
+
+    def __init__(self, table_name, region_name=None, endpoint_url=None, mode='batch', workers=1,
+                 segment_size=DEFAULT_SEGMENT_SIZE, max_retries=DEFAULT_MAX_RETRIES):
+        if mode not in ('batch', 'row'):
+            raise ValueError(f"Unknown DynamoDB write mode: {mode}")
+
+        self.table_name = table_name
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url  # Point at DynamoDB Local or another stand-in.
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.segment_size = segment_size
+        self.max_retries = max_retries
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.backoff = 0.0
+        self.key_attributes = None
+        # Reports to items, with the FLOAT columns as the Decimals boto3 needs for numbers.
+        self.to_items = get_schema().converter('dynamodb')
+
+    def table(self):
+        """Returns this thread's Table resource, creating it on first use."""
+        if not hasattr(self.local, 'table'):
+            session = boto3.session.Session()
+            dynamodb = session.resource('dynamodb', region_name=self.region_name,
+                                        endpoint_url=self.endpoint_url, config=BOTO_CONFIG)
+            self.local.table = dynamodb.Table(self.table_name)
+        return self.local.table
+
+    def keys(self):
+        """Returns the names of the table's key attributes."""
+        if self.key_attributes is None:
+            self.key_attributes = [key['AttributeName'] for key in self.table().key_schema]
+        return self.key_attributes
+
+    def watermark_key(self):
+        return {attribute: WATERMARK_KEY for attribute in self.keys()}
+
+    def read_watermark(self):
+        """Returns the last committed timestamp, or None if no watermark has been written.
+
+        This is a single consistent GetItem, so it costs the same however big the table gets.
+        """
+        response = self.table().get_item(Key=self.watermark_key(), ConsistentRead=True)
+        item = response.get('Item')
+        return item['last_timestamp'] if item else None
+
+    def commit_watermark(self, timestamp):
+        """Moves the watermark forward to `timestamp`. It is never moved backwards."""
+        try:
+            self.table().update_item(
+                Key=self.watermark_key(),
+                UpdateExpression='SET last_timestamp = :ts',
+                ConditionExpression='attribute_not_exists(last_timestamp) OR last_timestamp < :ts',
+                ExpressionAttributeValues={':ts': timestamp}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def write(self, rows):
+        """Writes rows to the table and returns the number of rows written."""
+        if self.mode == 'row':
+            return self._put_rows(rows)
+
+        # batch_writer needs the key names to drop duplicate keys within a request.
+        self.keys()
+
+        items = self.to_items(list(rows))
+        segments = [items[i:i + self.segment_size] for i in range(0, len(items), self.segment_size)]
+
+        if self.workers == 1:
+            return sum(self._write_segment(segment) for segment in segments)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return sum(executor.map(self._write_segment, segments))
+
+    def _write_segment(self, segment):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_backoff()
+            try:
+                with self.table().batch_writer(overwrite_by_pkeys=self.keys()) as batch:
+                    for item in segment:
+                        batch.put_item(Item=item)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    print(f"ERROR: Failed to write segment of {len(segment)} items: {e}")
+                    return 0
+                self._throttled()
+                print(f"WARNING: Throttled writing segment of {len(segment)} items (attempt {attempt + 1}), backing off {self.backoff:.2f}s.")
+                continue
+
+            self._succeeded()
+            return len(segment)
+
+        print(f"ERROR: Gave up on segment of {len(segment)} items after {self.max_retries + 1} throttled attempts.")
+        return 0
+
+    def _wait_for_backoff(self):
+        delay = self.backoff
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _throttled(self):
+        with self.lock:
+            self.backoff = min(MAX_BACKOFF_SECONDS, max(MIN_BACKOFF_SECONDS, self.backoff * 2))
+
+    def _succeeded(self):
+        with self.lock:
+            self.backoff = self.backoff / 2 if self.backoff > MIN_BACKOFF_SECONDS else 0.0
+
+    def _put_rows(self, rows):
+        written = 0
+        for item in self.to_items(list(rows)):
+            try:
+                self.table().put_item(Item=item)
+                written += 1
+            except ClientError as e:
+                print(f"ERROR: Failed to insert item with timestamp {item['timestamp']}: {e}")
+            except Exception as e:
+                print(f"ERROR: An unexpected error occurred while inserting item: {e}")
+        return written
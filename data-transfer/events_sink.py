@@ -0,0 +1,129 @@
+import time
+
+import requests
+
+import metrics
+from schema_registry import get_schema
+
+# Tinybird rejects Events API requests over 10 MB, so stay under that by default.
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_ROWS = 10000
+DEFAULT_MAX_WAIT_SECONDS = 5.0
+
+
+class EventsApiSink:
+    """Buffers rows and posts them to the Tinybird Events API as NDJSON batches.
+
+    A batch is flushed when it reaches `max_rows` rows or `max_bytes` bytes, or when
+    `max_wait` seconds have passed since its first row was buffered. Setting `max_rows=1`
+    gives the old one-request-per-row behavior. Batches go out through the shared
+    TinybirdClient, gzipped unless `compress` is False; `max_bytes` caps the uncompressed size.
+    """
+
+    def __init__(self, url, client, max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_wait=DEFAULT_MAX_WAIT_SECONDS, compress=True):
+        self.url = url
+        self.client = client
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.compress = compress
+        self.encode = get_schema().converter('events')
+
+        self.buffer = []
+        self.buffer_rows = []  # the rows behind the encoded lines in `buffer`
+        self.buffer_bytes = 0
+        self.first_row_at = None
+        self.last_result = None
+
+        # Running totals across all batches posted by this sink.
+        self.totals = {'batches': 0, 'rows': 0, 'successful_rows': 0, 'quarantined_rows': 0, 'failed_rows': 0}
+
+    def write(self, rows):
+        """Adds rows to the current batch, flushing whenever a size or time limit is hit.
+
+        Returns the rows of any flushes this call triggered that the Events API did not take,
+        so the caller can spool just those; the batches that went through must not be posted
+        again, as the Events API only appends. Rows still waiting in the buffer are not
+        returned until they are flushed.
+        """
+        failed = []
+        for row, line in zip(rows, self.encode(rows)):
+            # Flush first if this row would push the body over the size cap.
+            if self.buffer and self.buffer_bytes + len(line) > self.max_bytes:
+                failed += self.flush()
+
+            if not self.buffer:
+                self.first_row_at = time.monotonic()
+            self.buffer.append(line)
+            self.buffer_rows.append(row)
+            self.buffer_bytes += len(line)
+
+            if len(self.buffer) >= self.max_rows:
+                failed += self.flush()
+
+        return failed + self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flushes the current batch if it has been waiting longer than `max_wait` seconds."""
+        if self.buffer and time.monotonic() - self.first_row_at >= self.max_wait:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Posts the buffered rows as one NDJSON body.
+
+        Returns the batch's rows if the request failed, or an empty list if the Events API
+        took it (or there was nothing to send). The accepted and quarantined counts from the
+        response are kept in `last_result`.
+        """
+        if not self.buffer:
+            return []
+
+        body = b''.join(self.buffer)
+        rows = self.buffer_rows
+        num_rows = len(rows)
+        self.buffer = []
+        self.buffer_rows = []
+        self.buffer_bytes = 0
+        self.first_row_at = None
+
+        self.totals['batches'] += 1
+        self.totals['rows'] += num_rows
+
+        try:
+            response = self.client.post_events(self.url, body, compress=self.compress)
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR: Events API request error for batch of {num_rows} rows: {e}")
+            self.totals['failed_rows'] += num_rows
+            return rows
+
+        if response.status_code not in (200, 202):
+            print(f"ERROR: Events API batch of {num_rows} rows failed with status code: {response.status_code}")
+            print(f"Response: {response.text}")
+            self.totals['failed_rows'] += num_rows
+            return rows
+
+        try:
+            result = response.json()
+        except ValueError:
+            # The rows were accepted; only the summary of them is missing.
+            print(f"WARNING: Events API took a batch of {num_rows} rows but its response was not JSON.")
+            self.totals['successful_rows'] += num_rows
+            self.last_result = None
+            return []
+
+        successful = result.get('successful_rows', 0)
+        quarantined = result.get('quarantined_rows', 0)
+        self.totals['successful_rows'] += successful
+        self.totals['quarantined_rows'] += quarantined
+
+        if quarantined:
+            metrics.rows_quarantined.inc(quarantined)
+            print(f"WARNING: Events API quarantined {quarantined} of {num_rows} rows in a batch.")
+        self.last_result = result
+        return []
+
+    def close(self):
+        """Flushes anything left in the buffer."""
+        self.flush()
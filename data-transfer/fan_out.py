@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+from dotenv import load_dotenv
+
+from checkpoint import open_checkpoint
+from dedup import open_dedup, to_utc
+import metrics
+from poller import poller_from_env
+from reports_source import deliver, stream_reports
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import TinybirdClient
+
+# Get the directory of the current script
+script_dir = Path(__file__).parent
+
+# Construct the path to .env.local within the script's directory
+env_path = script_dir / '.env.local'
+load_dotenv(dotenv_path=env_path)
+
+SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'ndjson')
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 5000))
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH')
+
+# One pooled client for the shared fetch and every lane's catch-up requests.
+source_client = TinybirdClient(SOURCE_KEY)
+
+# Used when a sink has no checkpoint yet and its target has no reports either.
+DEFAULT_START_TIME = '2024-09-01 00:00:00'
+
+# Batches a sink may have waiting before it is considered behind.
+DEFAULT_QUEUE_SIZE = 20
+
+# The tinybird lane asks this pipe for the newest report in the target, like tb_to_tb.py.
+MOST_RECENT_URL = "https://api.us-west-2.aws.tinybird.co/v0/pipes/most_recent.json"
+
+
+class SinkLane(threading.Thread):
+    """Feeds one sink from its own bounded queue, so a slow sink cannot hold back the others.
+
+    Each lane keeps its own checkpoint, under the same name the single-target script uses,
+    so a sink can move between fan_out.py and its own script without losing its place. The
+    same goes for its dedup index, which drops rows the sink already has before writing. If
+    the lane's queue fills up, or a write fails, the lane stops taking shared batches. Once
+    its queue has drained, it fetches the range it missed on its own, then rejoins at the
+    start of the next shared window that its catch-up reached. The watermark moves after
+    every written batch, so a failure only costs the batches after it. With no checkpoint
+    yet, the lane starts from the newest report `probe()` finds in the target.
+    """
+
+    def __init__(self, name, sink, write_batch, on_commit=None, probe=None, queue_size=DEFAULT_QUEUE_SIZE):
+        super().__init__(name=name, daemon=True)
+        self.sink = sink
+        self.write_batch = metrics.timed_write(sink)(write_batch)
+        self.on_commit = on_commit
+        self.probe = probe
+        self.checkpoint = open_checkpoint(name, CHECKPOINT_PATH)
+        self.dedup = open_dedup(name)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.behind = threading.Event()
+        # Set after a catch-up, until the lane sees a window start it can rejoin at.
+        self.rejoining = False
+
+    def watermark(self):
+        return self.checkpoint.load()
+
+    def start_time(self):
+        """Where this lane's fetches start: a little before its watermark or, with no checkpoint
+        yet, before the newest report its target already has, as the lane's own script does."""
+        watermark = self.watermark()
+        if not watermark and self.probe:
+            try:
+                watermark = self.probe()
+            except Exception as e:
+                print(f"ERROR: {self.name} could not find the most recent report in its target: {e}")
+            if not watermark:
+                print(f"WARNING: {self.name} has no checkpoint and its target has no reports. Using default start time.")
+        return self.dedup.overlap_start(watermark) if watermark else DEFAULT_START_TIME
+
+    def offer(self, item):
+        """Queues a batch (or a window start or end marker) unless the lane is behind."""
+        if self.behind.is_set():
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            print(f"WARNING: {self.name} is falling behind; it will catch up on its own.")
+            self.behind.set()
+
+    def commit(self, timestamp):
+        """Moves the watermark to `timestamp`, unless it is already there or past it."""
+        watermark = self.watermark()
+        if watermark and to_utc(timestamp) <= to_utc(watermark):
+            return
+        self.dedup.save(timestamp)
+        self.checkpoint.commit(timestamp)
+        metrics.watermark_committed(timestamp, self.sink)
+        if self.on_commit:
+            self.on_commit(timestamp)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                if self.behind.is_set():
+                    self.guarded(self.catch_up)
+                continue
+
+            if self.behind.is_set():
+                # Anything still queued is covered by the catch-up once the queue is empty.
+                continue
+            self.guarded(self.handle, item)
+
+    def guarded(self, step, *args):
+        """Runs one step of the lane, so an unexpected error sends the lane back to its
+        checkpoint instead of ending its thread."""
+        try:
+            step(*args)
+        except Exception as e:
+            print(f"ERROR: {self.name} failed: {e!r}; it will refetch from its checkpoint.")
+            self.behind.set()
+            time.sleep(10)
+
+    def handle(self, item):
+        if self.rejoining:
+            self.rejoin(item)
+            return
+
+        if isinstance(item, tuple):
+            kind, timestamp = item
+            # End of a window, so every batch in it was written. A window that could not
+            # be fetched completely ends with None and is not committed.
+            if kind == 'end' and timestamp:
+                self.commit(timestamp)
+            return
+
+        if not self.write_and_commit(item):
+            print(f"ERROR: {self.name} failed to write a batch; it will refetch from its checkpoint.")
+            self.behind.set()
+
+    def rejoin(self, item):
+        """After a catch-up, drops shared items until a window starts no later than this lane's watermark.
+
+        A window already under way when the lane rejoined is missing batches for this lane,
+        so neither its rows nor its end marker are used. A window that starts after the
+        watermark would leave a gap, so the lane catches up again instead.
+        """
+        if not (isinstance(item, tuple) and item[0] == 'start'):
+            return
+        watermark = self.watermark()
+        if watermark and to_utc(item[1]) > to_utc(watermark):
+            self.behind.set()
+            return
+        self.rejoining = False
+        print(f"INFO: {self.name} rejoined the shared fetch at {item[1]}.")
+
+    def write_and_commit(self, batch):
+        """Writes the rows of a batch this sink does not have yet, records them in the dedup
+        index and commits the batch's newest timestamp. The pipe returns rows in timestamp
+        order, so everything up to there is in."""
+        rows = list(self.dedup.fresh(batch))
+        if rows and not self.write_batch(rows):
+            return False
+        self.dedup.add(rows)
+        if batch:
+            self.commit(max(row['timestamp'] for row in batch))
+        return True
+
+    def catch_up(self):
+        """Fetches and writes everything since this lane's own checkpoint, then rejoins."""
+        params = {'start_time': self.start_time(), 'end_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+        print(f"INFO: {self.name} catching up from {params['start_time']}.")
+        try:
+            ok, written, newest = deliver(stream_reports(source_client, params, SOURCE_FORMAT), self.write_and_commit, STREAM_BATCH_SIZE)
+        except (requests.exceptions.RequestException, json.JSONDecodeError, KeyError) as e:
+            print(f"ERROR: {self.name} catch-up request failed: {e}")
+            time.sleep(10)
+            return
+
+        if ok:
+            print(f"INFO: {self.name} caught up with {written} rows.")
+            self.rejoining = True
+            self.behind.clear()
+        else:
+            time.sleep(10)
+
+
+def make_tinybird_lane(queue_size=DEFAULT_QUEUE_SIZE):
+    from events_sink import EventsApiSink
+
+    target_client = TinybirdClient(os.getenv('TINYBIRD_TARGET_TOKEN'))
+    sink = EventsApiSink(os.getenv('EVENTS_API_URL', "https://api.us-west-2.aws.tinybird.co/v0/events?name=weather_data_json"),
+                         target_client,
+                         max_rows=int(os.getenv('EVENTS_BATCH_MAX_ROWS', 10000)),
+                         max_bytes=int(os.getenv('EVENTS_BATCH_MAX_BYTES', 8 * 1024 * 1024)))
+
+    def write_batch(rows):
+        failed = sink.write(rows) + sink.flush()
+        if failed:
+            # The lane refetches from its checkpoint, so record the batches that did go
+            # through: the Events API only appends, and they must not be posted again.
+            failed_ids = set(map(id, failed))
+            lane.dedup.add([row for row in rows if id(row) not in failed_ids])
+        return not failed
+
+    def probe():
+        response = target_client.get(MOST_RECENT_URL, timeout=5)
+        response.raise_for_status()
+        data = response.json()['data']
+        return data[0]['timestamp'] if data else None
+
+    lane = SinkLane('tb_to_tb', 'tinybird', write_batch, probe=probe, queue_size=queue_size)
+    return lane
+
+
+def make_postgres_lane(queue_size=DEFAULT_QUEUE_SIZE):
+    import psycopg
+    from postgres_sink import PostgresSink
+
+    params = {
+        'dbname': os.getenv("POSTGRES_DATABASE_NAME"),
+        'user': os.getenv("POSTGRES_DATABASE_USER"),
+        'password': os.getenv("POSTGRES_DATABASE_PASSWORD"),
+        'host': os.getenv("POSTGRES_DATABASE_HOST"),
+        'port': os.getenv("POSTGRES_DATABASE_PORT")
+    }
+    state = {'conn': None, 'sink': None}
+
+    def connect():
+        # The connection is kept for the life of the lane and reopened if it drops.
+        if state['conn'] is None or state['conn'].closed:
+            state['conn'] = psycopg.connect(**params)
+            state['sink'] = PostgresSink(state['conn'], mode=os.getenv('POSTGRES_WRITE_MODE', 'copy'),
+                                         batch_size=int(os.getenv('POSTGRES_BATCH_SIZE', 5000)))
+        return state['conn']
+
+    def write_batch(rows):
+        try:
+            connect()
+            state['sink'].write(rows)
+        except psycopg.Error as e:
+            print(f"ERROR: Database error while inserting/updating data: {e}")
+            return False
+        return True
+
+    def probe():
+        with connect().cursor() as cur:
+            cur.execute("SELECT timestamp FROM weather_reports ORDER BY timestamp DESC LIMIT 1;")
+            result = cur.fetchone()
+        state['conn'].commit()
+        return result[0].strftime('%Y-%m-%d %H:%M:%S') if result else None
+
+    return SinkLane('tb_to_postgres', 'postgres', write_batch, probe=probe, queue_size=queue_size)
+
+
+def make_mongodb_lane(queue_size=DEFAULT_QUEUE_SIZE):
+    from pymongo import MongoClient
+    from mongodb_sink import MongoSink
+
+    client = MongoClient(os.getenv("MONGODB_CONNECTION_STRING"))
+    collection = client[os.getenv("MONGODB_DATABASE_NAME")][os.getenv("MONGODB_COLLECTION_NAME")]
+    sink = MongoSink(collection, mode=os.getenv('MONGODB_WRITE_MODE', 'bulk'),
+                     batch_size=int(os.getenv('MONGODB_BATCH_SIZE', 1000)))
+    if os.getenv('MONGODB_CREATE_INDEX', 'false').lower() == 'true':
+        sink.create_index()
+
+    def write_batch(rows):
+        return sink.write(rows) == len(rows)
+
+    def probe():
+        # Like tb_to_mongodb.py, only look at the last day, so the sort stays cheap without an index.
+        looking_back = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+        document = collection.find_one(filter={"timestamp": {"$gt": looking_back}}, sort=[("timestamp", -1)])
+        return document['timestamp'] if document else None
+
+    return SinkLane('tb_to_mongodb', 'mongodb', write_batch, probe=probe, queue_size=queue_size)
+
+
+def make_dynamodb_lane(queue_size=DEFAULT_QUEUE_SIZE):
+    from dynamodb_sink import DynamoSink
+
+    sink = DynamoSink(os.getenv("DYNAMODB_TABLE_NAME"), region_name=os.getenv("DYNAMODB_AWS_REGION"),
+                      endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None,
+                      mode=os.getenv('DYNAMODB_WRITE_MODE', 'batch'),
+                      workers=int(os.getenv('DYNAMODB_WRITERS', 1)),
+                      segment_size=int(os.getenv('DYNAMODB_SEGMENT_SIZE', 500)))
+
+    def write_batch(rows):
+        return sink.write(rows) == len(rows)
+
+    # Keep the table's own watermark item current too, for tb_to_dynamodb.py.
+    return SinkLane('tb_to_dynamodb', 'dynamodb', write_batch, on_commit=sink.commit_watermark,
+                    probe=sink.read_watermark, queue_size=queue_size)
+
+
+LANE_FACTORIES = {
+    'tinybird': make_tinybird_lane,
+    'postgres': make_postgres_lane,
+    'mongodb': make_mongodb_lane,
+    'dynamodb': make_dynamodb_lane,
+}
+
+
+def overlap_start(lanes, watermark):
+    """Where the shared fetch starts: the earliest of the lanes' dedup overlaps before `watermark`."""
+    return min((lane.dedup.overlap_start(watermark) for lane in lanes), key=to_utc)
+
+
+def fetch_window(lanes, state):
+    """Fetches everything since the last window once and offers each batch to every lane."""
+    params = {'start_time': state['next_start'],
+              'end_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+    for lane in lanes:
+        lane.offer(('start', params['start_time']))
+
+    def fan_out(batch):
+        for lane in lanes:
+            lane.offer(batch)
+        return True
+
+    try:
+        _, rows_fetched, newest = deliver(stream_reports(source_client, params, SOURCE_FORMAT), fan_out, STREAM_BATCH_SIZE)
+    except (requests.exceptions.RequestException, json.JSONDecodeError, KeyError) as e:
+        print(f"ERROR: API request error: {e}")
+        # Tell the lanes this window is incomplete so none of them commits past it.
+        for lane in lanes:
+            lane.offer(('end', None))
+        return None
+
+    for lane in lanes:
+        lane.offer(('end', newest))
+
+    if newest:
+        # Start the next window a little before the newest row, so rows that arrive late
+        # are fetched; each lane's dedup index drops the ones it already has.
+        state['next_start'] = overlap_start(lanes, newest)
+        print(f"INFO: Fanned out {rows_fetched} rows to {len(lanes)} sinks.")
+    else:
+        print("INFO: No new data found.")
+    return rows_fetched, newest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch weather reports once and write them to several targets.')
+    parser.add_argument('--sinks', default='tinybird,postgres,mongodb,dynamodb',
+                        help='Comma-separated targets: ' + ', '.join(LANE_FACTORIES))
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Batches a sink may have waiting before it catches up on its own')
+    args = parser.parse_args()
+
+    lanes = [LANE_FACTORIES[name.strip()](args.queue_size) for name in args.sinks.split(',')]
+
+    # Start the shared fetch from the furthest-behind sink; the others just see some rows again.
+    # A sink with no checkpoint starts where its target's newest report is, or at the default.
+    state = {'next_start': min((lane.start_time() for lane in lanes), key=to_utc)}
+
+    for lane in lanes:
+        lane.start()
+
+    # Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+    metrics.start('fan_out')
+
+    # Poll straight away while there is a backlog, and less often while the source is quiet.
+    poller_from_env().run_forever(lambda: fetch_window(lanes, state))
@@ -0,0 +1,240 @@
+import functools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from poller import lag_seconds
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9108
+DEFAULT_LOG_INTERVAL = 60.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 100, 500, 1000, 2500, 5000, 10000, 50000, 100000)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}  # sorted label items -> value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """A Prometheus-style histogram with fixed bucket bounds, one series per label set."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}  # sorted label items -> [per-bucket counts..., +Inf count], sum
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.bounds) + 1), 0.0))
+            counts[index] += 1
+            self.series[key] = (counts, total + value)
+
+    def snapshot(self):
+        """Bucket counts summed over every label set, for interval summaries."""
+        merged = [0] * (len(self.bounds) + 1)
+        with self.lock:
+            for counts, _ in self.series.values():
+                merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def quantile(self, counts, q):
+        """Upper bound of the bucket holding quantile `q` of `counts` (None if empty)."""
+        total = sum(counts)
+        if not total:
+            return None
+        running = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            running += count
+            if running >= q * total:
+                return bound
+
+    def samples(self):
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        samples = []
+        for labels, counts, total in series:
+            running = 0
+            for bound, count in zip(self.bounds + (float('inf'),), counts):
+                running += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((self.name + '_bucket', labels + (('le', le),), running))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, running))
+        return samples
+
+
+fetch_seconds = Histogram('transfer_fetch_seconds', 'Time from sending a pipe request to its response headers.')
+rows_fetched = Counter('transfer_rows_fetched_total', 'Rows read from the source pipe.')
+write_seconds = Histogram('transfer_write_seconds', 'Time to write one batch to a sink.')
+batch_rows = Histogram('transfer_batch_rows', 'Rows per batch handed to a sink.', SIZE_BUCKETS)
+rows_written = Counter('transfer_rows_written_total', 'Rows a sink took, or spooled for retry.')
+write_failures = Counter('transfer_write_failures_total', 'Batches a sink did not take.')
+rows_quarantined = Counter('transfer_rows_quarantined_total', 'Rows the Events API took but quarantined.')
+spooled_batches = Counter('transfer_spooled_batches_total', 'Failed batches saved to the retry spool.')
+retries = Counter('transfer_retries_total', 'Spooled batch retries, by result.')
+rows_per_second = Gauge('transfer_rows_per_second', 'Rows written per second over the last summary interval.')
+watermark_lag = Gauge('transfer_watermark_lag_seconds', 'Seconds between the last committed watermark and now.')
+
+REGISTRY = [fetch_seconds, rows_fetched, write_seconds, batch_rows, rows_written, write_failures,
+            rows_quarantined, spooled_batches, retries, rows_per_second, watermark_lag]
+
+# Last committed watermark per sink; the lag is worked out when it is read.
+watermarks = {}
+
+
+def watermark_committed(timestamp, sink):
+    watermarks[sink] = timestamp
+
+
+def update_lag():
+    for sink, timestamp in list(watermarks.items()):
+        watermark_lag.set(lag_seconds(timestamp), sink=sink)
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    update_lag()
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def timed_write(sink):
+    """Decorates a write_batch(..., rows) -> bool function so every call is measured under `sink`."""
+    def decorate(write_batch):
+        @functools.wraps(write_batch)
+        def write(*args):
+            rows = args[-1]
+            started = time.perf_counter()
+            ok = write_batch(*args)
+            write_seconds.observe(time.perf_counter() - started, sink=sink)
+            batch_rows.observe(len(rows), sink=sink)
+            if ok:
+                rows_written.inc(len(rows), sink=sink)
+            else:
+                write_failures.inc(sink=sink)
+            return ok
+        return write
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the script's output.
+
+
+def format_seconds(value):
+    return '-' if value is None else f"{value:g}s"
+
+
+def log_summaries(name, interval):
+    """Prints one line per interval with the rates and latencies seen in that interval."""
+    previous = {'fetched': 0, 'written': 0, 'failures': 0, 'spooled': 0, 'retries': 0,
+                'writes': write_seconds.snapshot(), 'fetches': fetch_seconds.snapshot()}
+    while True:
+        time.sleep(interval)
+        current = {'fetched': rows_fetched.total(), 'written': rows_written.total(),
+                   'failures': write_failures.total(), 'spooled': spooled_batches.total(),
+                   'retries': retries.total(),
+                   'writes': write_seconds.snapshot(), 'fetches': fetch_seconds.snapshot()}
+        writes = [a - b for a, b in zip(current['writes'], previous['writes'])]
+        fetches = [a - b for a, b in zip(current['fetches'], previous['fetches'])]
+        written = current['written'] - previous['written']
+        batches = sum(writes)
+        rate = written / interval
+        rows_per_second.set(rate)
+        update_lag()
+        lag = max((value for _, _, value in watermark_lag.samples()), default=None)
+
+        print(f"INFO: [{name}] last {interval:g}s: {current['fetched'] - previous['fetched']} rows fetched, "
+              f"{written} written ({rate:.0f} rows/sec) in {batches} batches "
+              f"(avg {written / batches if batches else 0:.0f} rows), "
+              f"write p50/p99 {format_seconds(write_seconds.quantile(writes, 0.5))}/"
+              f"{format_seconds(write_seconds.quantile(writes, 0.99))}, "
+              f"fetch p50 {format_seconds(fetch_seconds.quantile(fetches, 0.5))}, "
+              f"{current['failures'] - previous['failures']} failed writes, "
+              f"{current['spooled'] - previous['spooled']} spooled, "
+              f"{current['retries'] - previous['retries']} retries, "
+              f"watermark lag {'-' if lag is None else f'{lag:.0f}s'}.")
+        previous = current
+
+
+def start(name):
+    """Serves /metrics on METRICS_HOST:METRICS_PORT and starts the periodic summary line.
+
+    Set METRICS_PORT to 0 to turn the endpoint off, or METRICS_LOG_INTERVAL to 0 to turn
+    the summary off.
+    """
+    port = int(os.getenv('METRICS_PORT', DEFAULT_METRICS_PORT))
+    if port:
+        host = os.getenv('METRICS_HOST', DEFAULT_METRICS_HOST)
+        try:
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            # Most likely another transfer script already has the port.
+            print(f"WARNING: Could not serve metrics on {host}:{port}: {e}")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+            print(f"INFO: Serving metrics on http://{host}:{port}/metrics")
+
+    interval = float(os.getenv('METRICS_LOG_INTERVAL', DEFAULT_LOG_INTERVAL))
+    if interval:
+        threading.Thread(target=log_summaries, args=(name, interval), name='metrics-log', daemon=True).start()
@@ -0,0 +1,94 @@
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from schema_registry import get_schema
+
+DEFAULT_BATCH_SIZE = 1000
+
+# MongoDB servers accept at most this many operations in one bulk write command.
+MAX_WRITE_BATCH_SIZE = 100000
+
+INDEX_NAME = 'timestamp_site_name'
+
+
+def upsert_ops(rows):
+    """Returns the UpdateOnes that upsert reports keyed on (timestamp, site_name)."""
+    return [UpdateOne(key, {'$set': row}, upsert=True) for key, row in get_schema().converter('mongodb')(rows)]
+
+
+def failed_writes(details, count):
+    """Logs a BulkWriteError's details and returns how many of its `count` writes failed.
+
+    Write-concern errors mean the writes were not acknowledged as asked, so when there are
+    any the whole batch counts as failed.
+    """
+    write_errors = details.get('writeErrors', [])
+    concern_errors = details.get('writeConcernErrors', [])
+    if write_errors:
+        print(f"ERROR: {len(write_errors)} of {count} writes failed, first error: {write_errors[0]['errmsg']}")
+    if concern_errors:
+        print(f"ERROR: Write concern not met for {count} writes: {concern_errors[0].get('errmsg')}")
+        return count
+    return len(write_errors)
+
+
+class MongoSink:
+    """Writes weather reports to a MongoDB collection.
+
+    In 'bulk' mode each batch is sent as one unordered bulk_write of UpdateOne upserts keyed
+    on (timestamp, site_name), so re-running a window updates documents instead of
+    duplicating them. 'row' mode calls insert_one per report, which is how the script used
+    to work.
+    """
+
+    def __init__(self, collection, mode='bulk', batch_size=DEFAULT_BATCH_SIZE):
+        if mode not in ('bulk', 'row'):
+            raise ValueError(f"Unknown MongoDB write mode: {mode}")
+
+        self.collection = collection
+        self.mode = mode
+        self.batch_size = min(batch_size, MAX_WRITE_BATCH_SIZE)
+
+    def create_index(self):
+        """Creates the unique (timestamp, site_name) index that backs the upserts."""
+        try:
+            self.collection.create_index(
+                [('timestamp', ASCENDING), ('site_name', ASCENDING)],
+                unique=True,
+                name=INDEX_NAME
+            )
+            print(f"INFO: Index {INDEX_NAME} is in place.")
+        except OperationFailure as e:
+            # Usually means the collection already holds duplicates from earlier insert_one runs.
+            print(f"WARNING: Could not create index {INDEX_NAME}: {e}")
+
+    def write(self, rows):
+        """Writes rows in batches of `batch_size` and returns the number of rows written."""
+        if self.mode == 'row':
+            return self._insert_rows(rows)
+
+        ops = upsert_ops(list(rows))
+        written = 0
+        for start in range(0, len(ops), self.batch_size):
+            written += self._write_batch(ops[start:start + self.batch_size])
+        return written
+
+    def _write_batch(self, batch):
+        try:
+            self.collection.bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            # With ordered=False the rest of the batch is still applied, so report and move on.
+            return len(batch) - failed_writes(e.details, len(batch))
+        return len(batch)
+
+    def _insert_rows(self, rows):
+        written = 0
+        for report in rows:
+            try:
+                # insert_one adds an _id to the dict it is given, so it gets a copy and the
+                # row can still be spooled as JSON.
+                self.collection.insert_one(dict(report))
+                written += 1
+            except Exception as e:
+                print(f"ERROR: An unexpected error occurred while inserting document: {e}")
+        return written
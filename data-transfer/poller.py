@@ -0,0 +1,101 @@
+import os
+import time
+from datetime import datetime, timezone
+
+DEFAULT_MIN_INTERVAL = 5.0
+DEFAULT_MAX_INTERVAL = 60.0
+DEFAULT_TARGET_LAG = 60.0
+
+# A poll that writes at least this many rows probably left more behind, so poll again at once.
+DEFAULT_BACKLOG_ROWS = 5000
+
+# Weight of the newest row rate in the running estimate.
+RATE_SMOOTHING = 0.3
+
+
+def lag_seconds(timestamp):
+    """Seconds between a report timestamp (UTC) and now."""
+    newest = datetime.fromisoformat(str(timestamp))
+    if newest.tzinfo:
+        newest = newest.astimezone(timezone.utc).replace(tzinfo=None)
+    return max(0.0, (datetime.utcnow() - newest).total_seconds())
+
+
+class AdaptivePoller:
+    """Runs a poll job in a loop, choosing the wait before each run from what the last one saw.
+
+    The job passed to run_forever() returns (rows_written, newest_timestamp) when it
+    completes, with (0, None) if there was nothing new, or None if it failed. Runs happen one
+    after another in a single loop, so a run that overruns delays the next one instead of
+    overlapping it.
+
+    - A run that wrote `backlog_rows` or more is followed by another run straight away.
+    - Otherwise the wait is sized from the smoothed row rate, so each poll picks up about
+      `backlog_rows` rows, and kept within [`min_interval`, `max_interval`].
+    - If the newest row is more than `target_lag` seconds old, the wait drops to `min_interval`.
+    - Empty runs double the wait, up to `max_interval`, and so do failed runs.
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 target_lag=DEFAULT_TARGET_LAG, backlog_rows=DEFAULT_BACKLOG_ROWS):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.target_lag = target_lag
+        self.backlog_rows = backlog_rows
+
+        self.interval = self.min_interval
+        self.rows_per_second = None
+        self.last_started = None
+
+    def next_delay(self, result, started):
+        """Returns the seconds to wait after a run that started at `started` (monotonic) and returned `result`."""
+        since_last = started - self.last_started if self.last_started is not None else None
+        self.last_started = started
+
+        if result is None:
+            self.interval = min(self.max_interval, self.interval * 2)
+            print(f"WARNING: Poll failed, retrying in {self.interval:.0f}s.")
+            return self.interval
+
+        rows, newest = result
+        if since_last:
+            # Rows picked up by this run arrived since the previous run started.
+            rate = rows / since_last
+            if self.rows_per_second is None:
+                self.rows_per_second = rate
+            else:
+                self.rows_per_second += RATE_SMOOTHING * (rate - self.rows_per_second)
+
+        if rows >= self.backlog_rows:
+            print(f"INFO: Wrote {rows} rows, polling again right away to work through the backlog.")
+            self.interval = self.min_interval
+            return 0
+
+        if not rows:
+            self.interval = min(self.max_interval, self.interval * 2)
+        elif self.rows_per_second:
+            self.interval = min(self.max_interval, max(self.min_interval, self.backlog_rows / self.rows_per_second))
+
+        if newest and lag_seconds(newest) > self.target_lag:
+            self.interval = self.min_interval
+
+        return self.interval
+
+    def run_forever(self, job):
+        while True:
+            started = time.monotonic()
+            delay = self.next_delay(job(), started)
+            # The wait counts from the start of the run, so a slow run shortens it.
+            time.sleep(max(0.0, delay - (time.monotonic() - started)))
+
+
+def poller_from_env(**overrides):
+    """Builds an AdaptivePoller with POLL_* settings from the environment."""
+    settings = {
+        'min_interval': float(os.getenv('POLL_MIN_INTERVAL', DEFAULT_MIN_INTERVAL)),
+        'max_interval': float(os.getenv('POLL_MAX_INTERVAL', DEFAULT_MAX_INTERVAL)),
+        'target_lag': float(os.getenv('POLL_TARGET_LAG', DEFAULT_TARGET_LAG)),
+        'backlog_rows': int(os.getenv('POLL_BACKLOG_ROWS', DEFAULT_BACKLOG_ROWS)),
+    }
+    settings.update(overrides)
+    return AdaptivePoller(**settings)
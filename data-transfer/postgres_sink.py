@@ -0,0 +1,95 @@
+import psycopg
+
+from schema_registry import get_schema
+
+# Columns of the weather_reports table, in the order they are written.
+COLUMNS = get_schema().columns
+KEY_COLUMNS = get_schema().key_columns
+
+DEFAULT_BATCH_SIZE = 5000
+
+_column_list = ', '.join(f'"{column}"' for column in COLUMNS)
+_update_list = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in COLUMNS if column not in KEY_COLUMNS)
+_key_list = ', '.join(f'"{column}"' for column in KEY_COLUMNS)
+
+UPSERT_ROW_SQL = f"""
+    INSERT INTO weather_reports ({_column_list})
+    VALUES ({', '.join(['%s'] * len(COLUMNS))})
+    ON CONFLICT ({_key_list}) DO UPDATE
+    SET {_update_list};
+"""
+
+# The staging table lives for the whole session and is emptied on every commit. The _seq
+# column records arrival order so the last copy of a duplicated key wins, like the row path.
+CREATE_STAGING_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS weather_reports_staging
+    (LIKE weather_reports INCLUDING DEFAULTS, _seq BIGSERIAL)
+    ON COMMIT DELETE ROWS;
+"""
+
+COPY_STAGING_SQL = f"COPY weather_reports_staging ({_column_list}) FROM STDIN"
+
+MERGE_STAGING_SQL = f"""
+    INSERT INTO weather_reports ({_column_list})
+    SELECT DISTINCT ON ({_key_list}) {_column_list}
+    FROM weather_reports_staging
+    ORDER BY {_key_list}, _seq DESC
+    ON CONFLICT ({_key_list}) DO UPDATE
+    SET {_update_list};
+"""
+
+
+class PostgresSink:
+    """Upserts weather reports into the weather_reports table.
+
+    In 'copy' mode each batch is streamed into a temporary staging table with COPY and merged
+    into weather_reports with a single INSERT ... SELECT ... ON CONFLICT statement. In 'row'
+    mode every report is its own INSERT ... ON CONFLICT, which is how the script used to work.
+    Either way, each batch is committed on its own.
+    """
+
+    def __init__(self, conn, mode='copy', batch_size=DEFAULT_BATCH_SIZE):
+        if mode not in ('copy', 'row'):
+            raise ValueError(f"Unknown Postgres write mode: {mode}")
+
+        self.conn = conn
+        self.mode = mode
+        self.batch_size = batch_size
+        self.staging_ready = False
+        self.to_values = get_schema().converter('postgres')
+
+    def write(self, rows):
+        """Writes rows in batches of `batch_size` and returns the number of rows written."""
+        values = self.to_values(list(rows))
+        written = 0
+        for start in range(0, len(values), self.batch_size):
+            written += self._write_batch(values[start:start + self.batch_size])
+        return written
+
+    def _write_batch(self, batch):
+        try:
+            with self.conn.cursor() as cur:
+                if self.mode == 'copy':
+                    self._copy_and_merge(cur, batch)
+                else:
+                    for values in batch:
+                        cur.execute(UPSERT_ROW_SQL, values, prepare=False)
+            self.conn.commit()
+        except psycopg.Error:
+            # A rollback also undoes a staging table created in this transaction.
+            self.conn.rollback()
+            self.staging_ready = False
+            raise
+
+        return len(batch)
+
+    def _copy_and_merge(self, cur, batch):
+        if not self.staging_ready:
+            cur.execute(CREATE_STAGING_SQL)
+            self.staging_ready = True
+
+        with cur.copy(COPY_STAGING_SQL) as copy:
+            for values in batch:
+                copy.write_row(values)
+
+        cur.execute(MERGE_STAGING_SQL)
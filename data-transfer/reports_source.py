@@ -0,0 +1,301 @@
+import csv
+import json
+import operator
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+import metrics
+from schema_registry import get_schema
+
+DATA_SOURCE_URL = "https://api.tinybird.co/v0/pipes/reportsv2.json"
+
+# Rows handed to the sink at a time when streaming. Peak memory is bounded by this, not the window.
+DEFAULT_STREAM_BATCH_SIZE = 5000
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+DEFAULT_SHARD = timedelta(hours=6)
+MIN_SHARD = timedelta(minutes=1)
+
+# A shard that returns this many rows (or times out) is considered too large and is split in two.
+DEFAULT_MAX_SHARD_ROWS = 100000
+DEFAULT_TIMEOUT = 30
+
+# A shard whose request fails (a 5xx, a dropped connection) is retried this many times, after
+# SHARD_RETRY_DELAY seconds and then twice as long each time, before the backfill stops.
+DEFAULT_SHARD_RETRIES = 3
+SHARD_RETRY_DELAY = 2
+
+
+class ShardTooLarge(Exception):
+    pass
+
+
+def parse_time(value):
+    """Accepts a datetime or a 'YYYY-MM-DD HH:MM:SS' / ISO string."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def pipe_url(fmt):
+    """Returns the reportsv2 URL for an output format: 'json', 'ndjson' or 'csv'."""
+    return DATA_SOURCE_URL.rsplit('.', 1)[0] + '.' + fmt
+
+
+def stream_reports(client, params, fmt='ndjson', timeout=DEFAULT_TIMEOUT):
+    """Yields reports from the reportsv2 pipe as the response arrives.
+
+    'ndjson' and 'csv' are read line by line, so rows reach the caller while the download is
+    still running and the whole body is never held in memory. CSV values arrive as text and
+    are converted to floats for the FLOAT columns in schema.json. 'json' falls back to
+    parsing the whole body at once.
+    """
+    started = time.perf_counter()
+    with client.get(pipe_url(fmt), params=params, timeout=timeout, stream=True) as response:
+        metrics.fetch_seconds.observe(time.perf_counter() - started)
+        response.raise_for_status()
+
+        if fmt == 'json':
+            yield from response.json()['data']
+        elif fmt == 'ndjson':
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        elif fmt == 'csv':
+            float_columns = get_schema().float_columns
+            response.encoding = response.encoding or 'utf-8'
+            for row in csv.DictReader(response.iter_lines(decode_unicode=True)):
+                for column in float_columns:
+                    if column in row:
+                        row[column] = float(row[column]) if row[column] != '' else None
+                yield row
+        else:
+            raise ValueError(f"Unknown source format: {fmt}")
+
+
+def deliver(rows, write_batch, batch_size=DEFAULT_STREAM_BATCH_SIZE):
+    """Hands rows to `write_batch(batch)` in lists of `batch_size` as they arrive.
+
+    `write_batch` returns True once a batch is written. Stops at the first batch that fails.
+    Returns (ok, rows_written, newest_timestamp), so the caller can move its watermark only
+    when everything was written.
+    """
+    written = 0
+    newest = None
+    batch = []
+
+    def write(batch):
+        nonlocal written, newest
+        if not write_batch(batch):
+            return False
+        written += len(batch)
+        batch_newest = max(row['timestamp'] for row in batch)
+        newest = batch_newest if newest is None else max(newest, batch_newest)
+        return True
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            metrics.rows_fetched.inc(len(batch))
+            if not write(batch):
+                return False, written, newest
+            batch = []
+
+    metrics.rows_fetched.inc(len(batch))
+    if batch and not write(batch):
+        return False, written, newest
+    return True, written, newest
+
+
+def fetch_reports(client, start_time, end_time, timeout=DEFAULT_TIMEOUT, max_rows=None):
+    """Fetches reports between start_time and end_time from the reportsv2 pipe.
+
+    Raises ShardTooLarge if the request times out or returns `max_rows` rows or more.
+    """
+    params = {'start_time': start_time.strftime(TIME_FORMAT), 'end_time': end_time.strftime(TIME_FORMAT)}
+    started = time.perf_counter()
+    try:
+        response = client.get(DATA_SOURCE_URL, params=params, timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise ShardTooLarge(f"{params['start_time']} - {params['end_time']} timed out")
+    metrics.fetch_seconds.observe(time.perf_counter() - started)
+    response.raise_for_status()
+
+    data = response.json()['data']
+    if max_rows and len(data) >= max_rows:
+        raise ShardTooLarge(f"{params['start_time']} - {params['end_time']} returned {len(data)} rows")
+    metrics.rows_fetched.inc(len(data))
+    return data
+
+
+def fetch_retrying(fetch, client, start_time, end_time, timeout, max_rows=None, retries=DEFAULT_SHARD_RETRIES):
+    """Calls `fetch`, retrying failed requests up to `retries` times with a growing delay.
+
+    ShardTooLarge is raised straight away, and the last request error is raised once the
+    retries run out.
+    """
+    for attempt in range(retries):
+        try:
+            return fetch(client, start_time, end_time, timeout, max_rows)
+        except requests.exceptions.RequestException as e:
+            delay = SHARD_RETRY_DELAY * 2 ** attempt
+            print(f"WARNING: Shard {start_time} - {end_time} request failed: {e}. Retrying in {delay}s.")
+            time.sleep(delay)
+    return fetch(client, start_time, end_time, timeout, max_rows)
+
+
+def fetch_shard(client, start_time, end_time, timeout=DEFAULT_TIMEOUT, max_rows=DEFAULT_MAX_SHARD_ROWS,
+                fetch=fetch_reports, join=operator.add, retries=DEFAULT_SHARD_RETRIES):
+    """Fetches one shard, splitting it in half (recursively) while it is too large.
+
+    Returns (rows, splits) where rows are in time order of the sub-shards, or None if part
+    of the shard could not be fetched even at the minimum size, or its requests kept failing
+    after `retries` retries. `fetch` and `join` can be swapped to fetch shards as something
+    other than lists of rows.
+    """
+    try:
+        return fetch_retrying(fetch, client, start_time, end_time, timeout, max_rows, retries), 0
+    except requests.exceptions.RequestException as e:
+        print(f"ERROR: Shard {start_time} - {end_time} failed after {retries} retries: {e}")
+        return None, 0
+    except ShardTooLarge as e:
+        if end_time - start_time <= MIN_SHARD:
+            # Can't split any further, so take whatever a plain request gives us.
+            print(f"WARNING: Shard {e} but is already at the minimum size.")
+            try:
+                return fetch_retrying(fetch, client, start_time, end_time, timeout * 4, retries=retries), 0
+            except ShardTooLarge as e:
+                print(f"ERROR: Shard {e} even with a longer timeout, so it cannot be fetched.")
+                return None, 0
+            except requests.exceptions.RequestException as e:
+                print(f"ERROR: Shard {start_time} - {end_time} failed after {retries} retries: {e}")
+                return None, 0
+
+        print(f"INFO: Shard {e}, splitting it in two.")
+        middle = start_time + (end_time - start_time) / 2
+        first, first_splits = fetch_shard(client, start_time, middle, timeout, max_rows, fetch, join, retries)
+        if first is None:
+            return None, 1 + first_splits
+        second, second_splits = fetch_shard(client, middle, end_time, timeout, max_rows, fetch, join, retries)
+        if second is None:
+            return None, 1 + first_splits + second_splits
+        return join(first, second), 1 + first_splits + second_splits
+
+
+def backfill(client, start_time, end_time, shard=DEFAULT_SHARD, workers=4, adaptive=True,
+             timeout=DEFAULT_TIMEOUT, max_rows=DEFAULT_MAX_SHARD_ROWS, fetch=fetch_reports, join=operator.add):
+    """Fetches start_time..end_time as time shards on a pool of `workers` threads.
+
+    Yields (shard_start, shard_end, rows) in timestamp order, no matter which shard finishes
+    first. If a shard cannot be fetched, because it is too large even at the minimum size or
+    its requests keep failing, its rows are None and it is the last one yielded. Shards share
+    their boundary timestamps, so a row exactly on a boundary can be fetched twice. Sinks that
+    upsert (Postgres, MongoDB, DynamoDB) just write it again; sinks that append, like the
+    Events API, must drop the repeats themselves (tb_to_tb does so with its dedup index). At
+    most `2 * workers` shards are
+    in flight, so memory stays bounded. With `adaptive`, the shard size halves for new
+    shards whenever one had to be split, and doubles (up to the starting size) when shards
+    come back well under `max_rows`.
+    """
+    start_time = parse_time(start_time)
+    end_time = parse_time(end_time)
+
+    shard_size = shard
+    next_start = start_time
+    pending = deque()
+
+    def submit(executor):
+        nonlocal next_start
+        shard_end = min(next_start + shard_size, end_time)
+        future = executor.submit(fetch_shard, client, next_start, shard_end, timeout, max_rows, fetch, join)
+        pending.append((next_start, shard_end, future))
+        next_start = shard_end
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while next_start < end_time and len(pending) < 2 * workers:
+            submit(executor)
+
+        while pending:
+            shard_start, shard_end, future = pending.popleft()
+            rows, splits = future.result()
+            if rows is None:
+                yield shard_start, shard_end, None
+                return
+
+            if adaptive:
+                if splits:
+                    shard_size = max(MIN_SHARD, shard_size / 2)
+                elif len(rows) < max_rows / 4:
+                    shard_size = min(shard, shard_size * 2)
+
+            while next_start < end_time and len(pending) < 2 * workers:
+                submit(executor)
+
+            yield shard_start, shard_end, rows
+    finally:
+        # If the caller stops early, drop the shards that have not started yet.
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def run_backfill(client, start_time, end_time, write_reports, shard=DEFAULT_SHARD, workers=4, adaptive=True):
+    """Runs a backfill and hands each shard to `write_reports(rows)` in timestamp order.
+
+    `write_reports` should return True once the rows are safely written. The backfill stops
+    at the first shard that could not be written, so the watermark never skips a gap.
+    """
+    started = time.monotonic()
+    total = 0
+    for shard_start, shard_end, rows in backfill(client, start_time, end_time, shard, workers, adaptive):
+        if rows is None:
+            print(f"ERROR: Backfill stopped at shard {shard_start} - {shard_end}, which could not be fetched.")
+            return False
+        print(f"INFO: Backfill shard {shard_start} - {shard_end}: {len(rows)} rows.")
+        if rows and not write_reports(rows):
+            print(f"ERROR: Backfill stopped at shard {shard_start} - {shard_end}.")
+            return False
+        total += len(rows)
+
+    elapsed = time.monotonic() - started
+    print(f"INFO: Backfill complete: {total} rows in {elapsed:.1f}s ({total / max(elapsed, 0.001):.0f} rows/sec).")
+    return True
+
+
+def add_backfill_arguments(parser):
+    """Adds the backfill options shared by the transfer scripts to an argparse parser."""
+    parser.add_argument('--backfill-start', help='Backfill from this time before polling, e.g. "2024-08-01 00:00:00"')
+    parser.add_argument('--backfill-end', help='End of the backfill (default: now, UTC)')
+    parser.add_argument('--shard-hours', type=float, default=6, help='Starting shard size in hours')
+    parser.add_argument('--backfill-workers', type=int, default=4, help='Number of shards fetched at once')
+    parser.add_argument('--fixed-shards', action='store_true', help='Keep the shard size fixed instead of adapting it')
+    parser.add_argument('--backfill-spool', metavar='DIR',
+                        help='Land backfill shards as Parquet files in DIR, then load the target from them')
+    parser.add_argument('--load-backfill-spool', metavar='DIR',
+                        help='Load the target from Parquet files landed earlier, without calling the pipe')
+    parser.add_argument('--backfill-batch-size', type=int, default=DEFAULT_STREAM_BATCH_SIZE,
+                        help='Rows per write when loading from a backfill spool')
+
+
+def backfill_from_args(args, client, write_reports):
+    """Runs the backfill described by `add_backfill_arguments` options, if one was asked for."""
+    if args.load_backfill_spool:
+        from columnar_spool import ColumnarSpool
+        return ColumnarSpool(args.load_backfill_spool).load(write_reports, args.backfill_batch_size)
+    if not args.backfill_start:
+        return True
+    end_time = args.backfill_end or datetime.utcnow()
+    if args.backfill_spool:
+        from columnar_spool import ColumnarSpool, land_backfill
+        spool = ColumnarSpool(args.backfill_spool)
+        if not land_backfill(client, args.backfill_start, end_time, spool, shard=timedelta(hours=args.shard_hours),
+                             workers=args.backfill_workers, adaptive=not args.fixed_shards):
+            return False
+        return spool.load(write_reports, args.backfill_batch_size)
+    return run_backfill(client, args.backfill_start, end_time, write_reports,
+                        shard=timedelta(hours=args.shard_hours), workers=args.backfill_workers,
+                        adaptive=not args.fixed_shards)
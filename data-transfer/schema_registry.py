@@ -0,0 +1,107 @@
+import json
+from decimal import Decimal
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SCHEMA_PATH = Path(__file__).parent / 'schema.json'
+
+# Converter builders by sink name, filled in by @converter below.
+BUILDERS = {}
+
+
+if orjson is not None:
+    def ndjson_line(row):
+        return orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+else:
+    def ndjson_line(row):
+        return json.dumps(row).encode('utf-8') + b'\n'
+
+
+def tuple_getter(columns):
+    """Like itemgetter(*columns), but always returns a tuple, even for one column."""
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda row: (row[column],)
+    return itemgetter(*columns)
+
+
+@lru_cache(maxsize=65536, typed=True)
+def to_decimal(value):
+    """Decimal(str(value)), cached: report values repeat a lot, and Decimal parsing is slow."""
+    return None if value is None else Decimal(str(value))
+
+
+class TableSchema:
+    """Column names and types for one table in schema.json, and the converters built from them."""
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.columns = tuple(column['name'] for column in definition['columns'])
+        self.types = {column['name']: column['type'] for column in definition['columns']}
+        self.key_columns = tuple(definition['primary_keys'])
+        self.float_columns = tuple(name for name in self.columns if self.types[name] == 'FLOAT')
+        self.converters = {}
+
+    def converter(self, sink):
+        """Returns the converter for `sink`, built on first use. It takes a list of rows."""
+        if sink not in self.converters:
+            self.converters[sink] = BUILDERS[sink](self)
+        return self.converters[sink]
+
+
+def converter(sink):
+    """Registers a function that builds the batch converter for `sink` from a TableSchema."""
+    def register(build):
+        BUILDERS[sink] = build
+        return build
+    return register
+
+
+@converter('postgres')
+def build_postgres(schema):
+    """Rows to value tuples in column order, for COPY and the per-row upserts."""
+    values = tuple_getter(schema.columns)
+    return lambda rows: list(map(values, rows))
+
+
+@converter('events')
+def build_events(schema):
+    """Rows to encoded NDJSON lines, with orjson when it is installed."""
+    return lambda rows: list(map(ndjson_line, rows))
+
+
+@converter('dynamodb')
+def build_dynamodb(schema):
+    """Rows to DynamoDB items, with the FLOAT columns as Decimals (the only number type boto3 takes)."""
+    numbers = schema.float_columns
+
+    def convert(rows):
+        items = []
+        for row in rows:
+            item = dict(row)
+            for column in numbers:
+                item[column] = to_decimal(item[column])
+            items.append(item)
+        return items
+    return convert
+
+
+@converter('mongodb')
+def build_mongodb(schema):
+    """Rows to (key filter, row) pairs for upserts keyed on the primary key columns."""
+    keys = schema.key_columns
+    key_values = tuple_getter(keys)
+    return lambda rows: [(dict(zip(keys, key_values(row))), row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def get_schema(name='weather_reports'):
+    """Returns the TableSchema for `name`, read from schema.json once."""
+    with open(SCHEMA_PATH, 'r') as f:
+        return TableSchema(name, json.load(f)[name])
@@ -0,0 +1,232 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import metrics
+
+# Default spool location, with one folder per script.
+DEFAULT_SPOOL_DIR = Path(__file__).parent / 'spool'
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 5.0
+DEFAULT_MAX_DELAY = 600.0
+DEFAULT_REPLAY_BATCH_SIZE = 5000
+
+# How long the retry thread sleeps when nothing is waiting.
+IDLE_WAIT_SECONDS = 60.0
+
+
+class SegmentLog:
+    """A folder of append-only NDJSON segment files, read back oldest first.
+
+    New records go to the active segment. seal() closes it, so the next append starts a new
+    one, and sealed segments can then be read and removed as a whole.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.active = None
+        self.active_path = None
+
+    def append(self, record):
+        """Appends one record and fsyncs it, so it survives a crash once this returns."""
+        if self.active is None:
+            self.active_path = self.directory / f"{time.time_ns():020d}.ndjson"
+            self.active = open(self.active_path, 'a')
+        self.active.write(json.dumps(record) + '\n')
+        self.active.flush()
+        os.fsync(self.active.fileno())
+
+    def seal(self):
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+            self.active_path = None
+
+    def sealed_segments(self):
+        return sorted(path for path in self.directory.glob('*.ndjson') if path != self.active_path)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash part way through an append leaves a partial last line.
+                    print(f"WARNING: Skipping unreadable record {path.name}:{line_number}.")
+
+    def remove(self, path):
+        path.unlink()
+
+
+class Spool:
+    """Keeps batches a sink could not write on disk and retries them in the background.
+
+    add() appends the batch to a pending segment and returns once it is on disk, so the
+    caller can move its watermark past it. A background thread retries pending batches with
+    exponential backoff. A batch that still fails after `max_attempts` tries is moved to the
+    dead-letter segments, where it stays until replay() is run. Batches are written again as
+    a whole, so a retried batch may repeat rows that had made it in the first time.
+    """
+
+    def __init__(self, directory, write_rows, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.write_rows = write_rows
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.pending = SegmentLog(Path(directory) / 'pending')
+        self.dead = SegmentLog(Path(directory) / 'dead')
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.next_due = 0.0  # Anything already on disk is due at startup.
+
+    def backoff(self, attempts):
+        return min(self.max_delay, self.base_delay * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+    def add(self, rows):
+        """Spools a failed batch for retry. Returns False if it could not be saved."""
+        record = {'rows': rows, 'attempts': 1, 'next_attempt': time.time() + self.backoff(0),
+                  'first_failed_at': datetime.utcnow().isoformat()}
+        try:
+            with self.lock:
+                self.pending.append(record)
+                self.next_due = min(self.next_due, record['next_attempt'])
+        except OSError as e:
+            print(f"ERROR: Could not spool {len(rows)} rows for retry: {e}")
+            return False
+        metrics.spooled_batches.inc()
+        print(f"WARNING: Spooled {len(rows)} rows for retry.")
+        self.wake.set()
+        return True
+
+    def _try_write(self, rows):
+        try:
+            return self.write_rows(rows)
+        except Exception as e:
+            print(f"ERROR: Retry failed: {e}")
+            return False
+
+    def retry_due(self):
+        """Retries the pending batches that are due. Others are carried into the active segment."""
+        with self.lock:
+            self.pending.seal()
+            segments = self.pending.sealed_segments()
+            self.next_due = float('inf')
+
+        retried = dead = 0
+        for path in segments:
+            for record in self.pending.read(path):
+                if record['next_attempt'] <= time.time():
+                    retried += 1
+                    if self._try_write(record['rows']):
+                        metrics.retries.inc(result='ok')
+                        continue
+                    record['attempts'] += 1
+                    if record['attempts'] >= self.max_attempts:
+                        self.dead.append(record)
+                        dead += 1
+                        metrics.retries.inc(result='dead')
+                        print(f"ERROR: Giving up on {len(record['rows'])} rows after {record['attempts']} attempts; "
+                              f"moved them to the dead-letter queue.")
+                        continue
+                    metrics.retries.inc(result='failed')
+                    record['next_attempt'] = time.time() + self.backoff(record['attempts'] - 1)
+
+                with self.lock:
+                    self.pending.append(record)
+                    self.next_due = min(self.next_due, record['next_attempt'])
+
+            # Every record in the segment is now written, re-spooled or dead, so drop it.
+            self.pending.remove(path)
+
+        self.dead.seal()
+        if retried:
+            print(f"INFO: Retried {retried} spooled batches, {dead} moved to the dead-letter queue.")
+
+    def run(self):
+        while True:
+            with self.lock:
+                wait = self.next_due - time.time()
+            if wait > 0:
+                self.wake.wait(min(wait, IDLE_WAIT_SECONDS))
+                self.wake.clear()
+                continue
+            self.retry_due()
+
+    def start(self):
+        """Starts the background retry thread."""
+        threading.Thread(target=self.run, name='spool-retry', daemon=True).start()
+
+    def replay(self, batch_size=DEFAULT_REPLAY_BATCH_SIZE):
+        """Writes every dead-lettered batch to the target straight away, without any backoff.
+
+        Rows are regrouped into batches of `batch_size`. Batches that still fail go back to
+        the dead-letter queue. Run it while the script that owns the spool is stopped.
+        Returns (rows_written, rows_failed).
+        """
+        written = failed = 0
+        batch = []
+        done = []
+        for path in self.dead.sealed_segments():
+            for record in self.dead.read(path):
+                batch.extend(record['rows'])
+                while len(batch) >= batch_size:
+                    chunk, batch = batch[:batch_size], batch[batch_size:]
+                    written, failed = self._replay_chunk(chunk, written, failed)
+            done.append(path)
+
+            # Segments are only removed once all of their rows are written or dead again.
+            if not batch:
+                self._remove_replayed(done, written, failed)
+                done = []
+
+        if batch:
+            written, failed = self._replay_chunk(batch, written, failed)
+        self._remove_replayed(done, written, failed)
+        self.dead.seal()
+        return written, failed
+
+    def _remove_replayed(self, paths, written, failed):
+        for path in paths:
+            self.dead.remove(path)
+        if paths:
+            print(f"INFO: Replayed {len(paths)} dead-letter segments: {written} rows written, {failed} failed so far.")
+
+    def _replay_chunk(self, rows, written, failed):
+        if self._try_write(rows):
+            return written + len(rows), failed
+        self.dead.append({'rows': rows, 'attempts': self.max_attempts, 'next_attempt': 0,
+                          'first_failed_at': datetime.utcnow().isoformat()})
+        return written, failed + len(rows)
+
+
+def spool_from_env(name, write_rows):
+    """Opens the spool for script `name` with SPOOL_* settings from the environment."""
+    directory = Path(os.getenv('SPOOL_DIR') or DEFAULT_SPOOL_DIR) / name
+    return Spool(directory, write_rows,
+                 max_attempts=int(os.getenv('SPOOL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)),
+                 base_delay=float(os.getenv('SPOOL_BASE_DELAY', DEFAULT_BASE_DELAY)),
+                 max_delay=float(os.getenv('SPOOL_MAX_DELAY', DEFAULT_MAX_DELAY)))
+
+
+def add_spool_arguments(parser):
+    parser.add_argument('--replay-dead-letters', action='store_true',
+                        help='Write every dead-lettered batch to the target at full speed, then exit')
+    parser.add_argument('--replay-batch-size', type=int, default=DEFAULT_REPLAY_BATCH_SIZE,
+                        help='Rows per write when replaying')
+
+
+def replay_from_args(args, spool):
+    """Runs the dead-letter replay if it was asked for. Returns True if it ran."""
+    if not args.replay_dead_letters:
+        return False
+    written, failed = spool.replay(args.replay_batch_size)
+    print(f"INFO: Replay finished: {written} rows written, {failed} rows still in the dead-letter queue.")
+    return True
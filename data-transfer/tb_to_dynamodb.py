@@ -1,17 +1,25 @@
+import argparse
 import requests
-import time
-from datetime import datetime, timedelta
-import schedule
+from datetime import datetime
 import os
 import json
-import boto3
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
-from boto3.dynamodb.conditions import Key, Attr
-from decimal import Decimal  # Import Decimal class
 
 from botocore.exceptions import ClientError
 
+from checkpoint import open_checkpoint
+from dedup import open_dedup
+import metrics
+from dynamodb_sink import DynamoSink
+from poller import poller_from_env
+from reports_source import add_backfill_arguments, backfill_from_args, deliver, stream_reports
+from spool import add_spool_arguments, replay_from_args, spool_from_env
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import TinybirdClient
+
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
 
@@ -22,60 +30,97 @@ load_dotenv(dotenv_path=env_path)
 # API and Database configuration
 DYNAMODB_TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME")
 DYNAMODB_AWS_REGION = os.getenv("DYNAMODB_AWS_REGION")
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None  # e.g. http://localhost:8000 for DynamoDB Local
+
+# 'batch' uses batch_writer segments (optionally across several threads), 'row' calls put_item per report.
+DYNAMODB_WRITE_MODE = os.getenv('DYNAMODB_WRITE_MODE', 'batch')
+DYNAMODB_WRITERS = int(os.getenv('DYNAMODB_WRITERS', 1))
+DYNAMODB_SEGMENT_SIZE = int(os.getenv('DYNAMODB_SEGMENT_SIZE', 500))
 
 SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
 
-DATA_SOURCE_URL = "https://api.tinybird.co/v0/pipes/reportsv2.json"
+# Pooled keep-alive client, reused by every poll instead of opening a connection per request.
+source_client = TinybirdClient(SOURCE_KEY)
+
+# How reports are read from the pipe: 'ndjson' and 'csv' stream, 'json' loads the whole body.
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'ndjson')
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 5000))
+
+# Initialize DynamoDB sink
+sink = DynamoSink(DYNAMODB_TABLE_NAME, region_name=DYNAMODB_AWS_REGION, endpoint_url=DYNAMODB_ENDPOINT_URL,
+                  mode=DYNAMODB_WRITE_MODE, workers=DYNAMODB_WRITERS, segment_size=DYNAMODB_SEGMENT_SIZE)
 
-# Initialize DynamoDB resource
-dynamodb = boto3.resource('dynamodb', region_name=DYNAMODB_AWS_REGION)
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+# Batches that fail are spooled to disk and retried in the background.
+spool = spool_from_env('tb_to_dynamodb', lambda rows: sink.write(rows) == len(rows))
+
+# Watermark store shared by the transfer scripts (SQLite by default, or a *.json file).
+checkpoint = open_checkpoint('tb_to_dynamodb', os.getenv('CHECKPOINT_PATH'))
+
+# Keys of the reports delivered near the watermark, so polls can refetch a small overlap
+# without writing anything twice.
+dedup = open_dedup('tb_to_dynamodb')
 
 # Some initial values... 
 end_time = datetime.now()
 start_time = '2024-09-04 16:55:10'  # TODO: change this... set to a week ago?
-last_timestamp = None
+last_timestamp = checkpoint.load()  # Resume where the last run left off, if it committed anything.
+
+@metrics.timed_write('dynamodb')
+def write_batch(rows):
+    """Writes reports to the table and returns True if all of them are in, or spooled."""
+    try:
+        written = sink.write(rows)
+    except ClientError as e:
+        # e.g. the table's key schema could not be read; the batch is spooled like any failed write.
+        print(f"ERROR: DynamoDB request failed: {e}")
+        written = 0
+    if written == len(rows) or spool.add(rows):
+        dedup.add(rows)
+        return True
+    return False
+
+def commit_watermark(timestamp):
+    global last_timestamp
+    last_timestamp = timestamp
+    metrics.watermark_committed(timestamp, 'dynamodb')
+    # Save the index first: after a crash it may list rows past the watermark, never fewer.
+    dedup.save(timestamp)
+    try:
+        sink.commit_watermark(timestamp)
+    except ClientError as e:
+        # The local checkpoint is what runs resume from; the watermark item only seeds a run
+        # that has none, and it catches up on the next commit.
+        print(f"WARNING: Could not move the watermark item in {DYNAMODB_TABLE_NAME}: {e}")
+    checkpoint.commit(timestamp)
+
+def write_reports(data):
+    """Writes reports to the table and moves the watermark once all of them are in."""
+    if not write_batch(data):
+        return False
+    commit_watermark(max(entry['timestamp'] for entry in data))
+    return True
 
 def fetch_and_post_data():
     global last_timestamp
 
     # Go see what the most recent timestamp already in the database.
     try:
-        headers_source = {"Authorization": f"Bearer {SOURCE_KEY}", "Content-Type": "application/json"}
-
         if not last_timestamp:
-            # Calculate the timestamp for one month ago
-            looking_back = datetime.now() - timedelta(days=7)
-            looking_back_str = looking_back.strftime('%Y-%m-%d %H:%M:%S')
-
-            # Scan the table with a filter to get items from the last month
-            response = table.scan(
-                FilterExpression=Attr('timestamp').gt(looking_back_str)
-            )
-
-            # Find the most recent timestamp
-            if response['Items']:
-                most_recent_item = max(response['Items'], key=lambda x: x['timestamp'])
-                last_timestamp = most_recent_item['timestamp']
+            # No local checkpoint yet. The sink keeps a watermark item in the table, so this is one GetItem rather than a Scan.
+            last_timestamp = sink.read_watermark()
+            if last_timestamp:
                 print(f"Most recent timestamp: {last_timestamp}")
             else:
-                print("WARNING: No rows found in the database. Using default start time.")
-
-            #items = response.get('Items', [])
-            #if items:
-            #    last_timestamp = items[0]['timestamp']
-            #else:
-            #    print("WARNING: No rows found in the database. Using default start time.")
+                print("WARNING: No watermark found in the database. Using default start time.")
 
         params = {}
         end_time = datetime.utcnow()
         params['end_time'] = end_time.strftime('%Y-%m-%d %H:%M:%S')
-        params['start_time'] = last_timestamp if last_timestamp else start_time
+        params['start_time'] = dedup.overlap_start(last_timestamp) if last_timestamp else start_time
 
+        # Batches are written while the pipe response is still streaming in.
         try:
-            response = requests.get(DATA_SOURCE_URL, params=params, headers=headers_source, timeout=5)
-            response.raise_for_status()
-            data = response.json()['data']
+            ok, written, newest = deliver(dedup.fresh(stream_reports(source_client, params, SOURCE_FORMAT)), write_batch, STREAM_BATCH_SIZE)
         except requests.exceptions.RequestException as e:
             print(f"ERROR: API request error: {e}")
             return
@@ -83,45 +128,39 @@ def fetch_and_post_data():
             print(f"ERROR: Error parsing API response: {e}")
             return
 
-        if data:
-            last_timestamp = max(entry['timestamp'] for entry in data)
-
-            for report in data:
-                try:
-                    table.put_item(
-                        Item={
-                            'timestamp': report['timestamp'],
-                            'site_name': report['site_name'],
-                            'temp_f': Decimal(str(report['temp_f'])),  # Convert to Decimal
-                            'clouds': report['clouds'],
-                            'description': report['description'],
-                            'humidity': Decimal(str(report['humidity'])),  # Convert to Decimal
-                            'precip': Decimal(str(report['precip'])),  # Convert to Decimal
-                            'pressure': Decimal(str(report['pressure'])),  # Convert to Decimal
-                            'wind_dir': Decimal(str(report['wind_dir'])),  # Convert to Decimal
-                            'wind_speed': Decimal(str(report['wind_speed']))  # Convert to Decimal
-                        }
-                    )
-                    print(f"SUCCESS: Item with timestamp {report['timestamp']} for {report['site_name']} added to DynamoDB.")
-                except ClientError as e:
-                    print(f"ERROR: Failed to insert item with timestamp {report['timestamp']}: {e}")
-                except Exception as e:
-                    print(f"ERROR: An unexpected error occurred while inserting item: {e}")
-       
-        else:
+        if not written and ok:
             print("INFO: No new data found.")
+            return 0, None
+
+        # Only move the watermark once every report is in, or spooled.
+        if not ok:
+            return
+        commit_watermark(newest)
 
         print("All data processed...")
+        return written, newest
 
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}")
 
-# Schedule the task to run every minute
-schedule.every(1).minutes.do(fetch_and_post_data)
+parser = argparse.ArgumentParser(description='Copy weather reports from Tinybird to DynamoDB.')
+add_backfill_arguments(parser)
+add_spool_arguments(parser)
+args = parser.parse_args()
+
+# Drain the dead-letter queue at full speed and exit, if asked to.
+if replay_from_args(args, spool):
+    sys.exit(0)
+
+# Retry spooled batches in the background while polling.
+spool.start()
+
+# Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+metrics.start('tb_to_dynamodb')
 
-# Run any pending tasks now
-schedule.run_all()
+# Catch up on a long range with parallel, time-sharded requests before polling.
+backfill_from_args(args, source_client, write_reports)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+# Poll straight away while there is a backlog, and less often while the source is quiet.
+# Runs never overlap: a slow run just delays the next one.
+poller_from_env().run_forever(fetch_and_post_data)
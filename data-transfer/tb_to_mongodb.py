@@ -1,9 +1,9 @@
+import argparse
 import requests
-import time
 from datetime import datetime, timedelta
-import schedule
 import os
 import json
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -11,6 +11,17 @@ from dotenv import load_dotenv
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 
+from checkpoint import open_checkpoint
+from dedup import open_dedup
+import metrics
+from mongodb_sink import MongoSink
+from poller import poller_from_env
+from reports_source import add_backfill_arguments, backfill_from_args, deliver, stream_reports
+from spool import add_spool_arguments, replay_from_args, spool_from_env
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import TinybirdClient
+
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
 
@@ -25,9 +36,19 @@ MONGODB_CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING")
 MONGODB_DATABASE_NAME = os.getenv("MONGODB_DATABASE_NAME")
 MONGODB_COLLECTION_NAME = os.getenv("MONGODB_COLLECTION_NAME") 
 
+# 'bulk' upserts batches keyed on (timestamp, site_name), 'row' calls insert_one per report.
+MONGODB_WRITE_MODE = os.getenv('MONGODB_WRITE_MODE', 'bulk')
+MONGODB_BATCH_SIZE = int(os.getenv('MONGODB_BATCH_SIZE', 1000))
+MONGODB_CREATE_INDEX = os.getenv('MONGODB_CREATE_INDEX', 'false').lower() == 'true'
+
 SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
 
-DATA_SOURCE_URL = "https://api.tinybird.co/v0/pipes/reportsv2.json"
+# Pooled keep-alive client, reused by every poll instead of opening a connection per request.
+source_client = TinybirdClient(SOURCE_KEY)
+
+# How reports are read from the pipe: 'ndjson' and 'csv' stream, 'json' loads the whole body.
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'ndjson')
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 5000))
 
 # Initialize MongoDB client
 client = MongoClient(MONGODB_CONNECTION_STRING)
@@ -43,20 +64,56 @@ except ConnectionFailure:
 db = client[MONGODB_DATABASE_NAME]
 collection = db[MONGODB_COLLECTION_NAME]
 
+sink = MongoSink(collection, mode=MONGODB_WRITE_MODE, batch_size=MONGODB_BATCH_SIZE)
+if MONGODB_CREATE_INDEX:
+    sink.create_index()
+
+# Batches that fail are spooled to disk and retried in the background.
+spool = spool_from_env('tb_to_mongodb', lambda rows: sink.write(rows) == len(rows))
+
+# Watermark store shared by the transfer scripts (SQLite by default, or a *.json file).
+checkpoint = open_checkpoint('tb_to_mongodb', os.getenv('CHECKPOINT_PATH'))
+
+# Keys of the reports delivered near the watermark, so polls can refetch a small overlap
+# without writing anything twice.
+dedup = open_dedup('tb_to_mongodb')
+
 # Some initial values... 
 end_time = datetime.now()
 start_time = '2024-09-01 00:00:00'  
-last_timestamp = None
+last_timestamp = checkpoint.load()  # Resume where the last run left off, if it committed anything.
+
+@metrics.timed_write('mongodb')
+def write_batch(rows):
+    """Writes reports to the collection and returns True if all of them are in, or spooled."""
+    written = sink.write(rows)
+    if written == len(rows) or spool.add(rows):
+        dedup.add(rows)
+        return True
+    return False
+
+def commit_watermark(timestamp):
+    global last_timestamp
+    last_timestamp = timestamp
+    metrics.watermark_committed(timestamp, 'mongodb')
+    # Save the index first: after a crash it may list rows past the watermark, never fewer.
+    dedup.save(timestamp)
+    checkpoint.commit(timestamp)
+
+def write_reports(data):
+    """Writes reports to the collection and moves the watermark once all of them are in."""
+    if not write_batch(data):
+        return False
+    commit_watermark(max(entry['timestamp'] for entry in data))
+    return True
 
 def fetch_and_post_data():
     global last_timestamp
 
     # Find the most recent timestamp already in the database.
     try:
-        headers_source = {"Authorization": f"Bearer {SOURCE_KEY}", "Content-Type": "application/json"}
-
         if not last_timestamp:
-            # Calculate the timestamp for one month ago
+            # No checkpoint yet. Calculate the timestamp for one month ago
             looking_back = datetime.now() - timedelta(days=1)
             looking_back_str = looking_back.strftime('%Y-%m-%d %H:%M:%S')
 
@@ -75,12 +132,11 @@ def fetch_and_post_data():
         params = {}
         end_time = datetime.utcnow()
         params['end_time'] = end_time.strftime('%Y-%m-%d %H:%M:%S')
-        params['start_time'] = last_timestamp if last_timestamp else start_time
+        params['start_time'] = dedup.overlap_start(last_timestamp) if last_timestamp else start_time
 
+        # Batches are written while the pipe response is still streaming in.
         try:
-            response = requests.get(DATA_SOURCE_URL, params=params, headers=headers_source, timeout=5)
-            response.raise_for_status()
-            data = response.json()['data']
+            ok, written, newest = deliver(dedup.fresh(stream_reports(source_client, params, SOURCE_FORMAT)), write_batch, STREAM_BATCH_SIZE)
         except requests.exceptions.RequestException as e:
             print(f"ERROR: API request error: {e}")
             return
@@ -88,31 +144,39 @@ def fetch_and_post_data():
             print(f"ERROR: Error parsing API response: {e}")
             return
 
-        if data:
-            last_timestamp = max(entry['timestamp'] for entry in data)
-
-            for report in data:
-                try:
-                    # Insert the document into the MongoDB collection
-                    collection.insert_one(report)
-                    print(f"SUCCESS: Item with timestamp {report['timestamp']} for {report['site_name']} added to MongoDB.")
-                except Exception as e:
-                    print(f"ERROR: An unexpected error occurred while inserting document: {e}")
-       
-        else:
+        if not written and ok:
             print("INFO: No new data found.")
+            return 0, None
+
+        # Only move the watermark once every report is in, or spooled.
+        if not ok:
+            return
+        commit_watermark(newest)
 
         print("All data processed...")
+        return written, newest
 
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}")
 
-# Schedule the task to run every minute
-schedule.every(1).minutes.do(fetch_and_post_data)
+parser = argparse.ArgumentParser(description='Copy weather reports from Tinybird to MongoDB.')
+add_backfill_arguments(parser)
+add_spool_arguments(parser)
+args = parser.parse_args()
+
+# Drain the dead-letter queue at full speed and exit, if asked to.
+if replay_from_args(args, spool):
+    sys.exit(0)
+
+# Retry spooled batches in the background while polling.
+spool.start()
+
+# Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+metrics.start('tb_to_mongodb')
 
-# Run any pending tasks now
-schedule.run_all()
+# Catch up on a long range with parallel, time-sharded requests before polling.
+backfill_from_args(args, source_client, write_reports)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+# Poll straight away while there is a backlog, and less often while the source is quiet.
+# Runs never overlap: a slow run just delays the next one.
+poller_from_env().run_forever(fetch_and_post_data)
\ No newline at end of file
@@ -1,13 +1,25 @@
+import argparse
 import requests
-import time
 from datetime import datetime, timedelta
-import schedule
 import os
 import json
+import sys
 import psycopg
 from pathlib import Path
 from dotenv import load_dotenv
 
+from checkpoint import open_checkpoint
+from dedup import open_dedup
+import metrics
+from postgres_sink import PostgresSink
+from poller import poller_from_env
+from reports_source import add_backfill_arguments, backfill_from_args, deliver, stream_reports
+from spool import add_spool_arguments, replay_from_args, spool_from_env
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from postgres_pool import open_pool
+from tinybird_client import TinybirdClient
+
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
 
@@ -24,32 +36,90 @@ DB_CONNECTION_PARAMS = {
     'port': os.getenv("POSTGRES_DATABASE_PORT")  
 }
 
+# Connections are kept between polls and shared with the retry thread and the backfill.
+# Sizes and lifetimes come from the POSTGRES_POOL_* settings.
+db_pool = open_pool(connect_kwargs=DB_CONNECTION_PARAMS, name='tb_to_postgres')
+
 SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
 
-DATA_SOURCE_URL = "https://api.tinybird.co/v0/pipes/reportsv2.json"
+# Pooled keep-alive client, reused by every poll instead of opening a connection per request.
+source_client = TinybirdClient(SOURCE_KEY)
+
+# 'copy' stages each batch with COPY and merges it in one statement, 'row' upserts row by row.
+POSTGRES_WRITE_MODE = os.getenv('POSTGRES_WRITE_MODE', 'copy')
+POSTGRES_BATCH_SIZE = int(os.getenv('POSTGRES_BATCH_SIZE', 5000))
+
+# How reports are read from the pipe: 'ndjson' and 'csv' stream, 'json' loads the whole body.
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'ndjson')
+
+# Watermark store shared by the transfer scripts (SQLite by default, or a *.json file).
+checkpoint = open_checkpoint('tb_to_postgres', os.getenv('CHECKPOINT_PATH'))
+
+# Keys of the reports delivered near the watermark, so polls can refetch a small overlap
+# without writing anything twice.
+dedup = open_dedup('tb_to_postgres')
 
 # Some initial values... 
 end_time = datetime.now()
 start_time = '2024-08-15 21:54:27'
-last_timestamp = None
+last_timestamp = checkpoint.load()  # Resume where the last run left off, if it committed anything.
+
+@metrics.timed_write('postgres')
+def write_batch(sink, rows):
+    """Upserts reports into weather_reports and returns True once every batch is committed, or spooled."""
+    try:
+        sink.write(rows)
+    except psycopg.Error as e:
+        print(f"ERROR: Database error while inserting/updating data: {e}")
+        if not spool.add(rows):
+            return False
+    dedup.add(rows)
+    return True
+
+def retry_batch(rows):
+    """Upserts a spooled batch on its own pooled connection, for the retry thread."""
+    try:
+        with db_pool.connection() as conn:
+            PostgresSink(conn, mode=POSTGRES_WRITE_MODE, batch_size=POSTGRES_BATCH_SIZE).write(rows)
+    except psycopg.Error as e:
+        print(f"ERROR: Database error while retrying a spooled batch: {e}")
+        return False
+    return True
+
+# Batches that fail are spooled to disk and retried in the background.
+spool = spool_from_env('tb_to_postgres', retry_batch)
+
+def commit_watermark(timestamp):
+    global last_timestamp
+    last_timestamp = timestamp
+    metrics.watermark_committed(timestamp, 'postgres')
+    # Save the index first: after a crash it may list rows past the watermark, never fewer.
+    dedup.save(timestamp)
+    checkpoint.commit(timestamp)
+
+def write_reports(sink, data):
+    """Upserts reports and moves the watermark once all batches are committed."""
+    if not write_batch(sink, data):
+        return False
+    commit_watermark(max(entry['timestamp'] for entry in data))
+    return True
 
 def fetch_and_post_data():
     global last_timestamp
 
     try:
-        headers_source = {"Authorization": f"Bearer {SOURCE_KEY}", "Content-Type": "application/json"}
-
-        with psycopg.connect(**DB_CONNECTION_PARAMS) as conn:
+        with db_pool.connection() as conn:
             with conn.cursor() as cur:
 
                 if not last_timestamp:
+                    # No checkpoint yet, so ask the database for its most recent report.
                     try:
-                        query = "SELECT * FROM weather_reports ORDER BY timestamp DESC LIMIT 1;"
+                        query = "SELECT timestamp FROM weather_reports ORDER BY timestamp DESC LIMIT 1;"
                         cur.execute(query)
                         result = cur.fetchone()
                         if result:
-                            value = result[2]
-                            start_time = value.strftime('%Y-%m-%d %H:%M:%S')
+                            value = result[0]
+                            last_timestamp = value.strftime('%Y-%m-%d %H:%M:%S')
                         else:
                             print("WARNING: No rows found in the database. Using default start time.")
                     except psycopg.Error as e:
@@ -59,12 +129,13 @@ def fetch_and_post_data():
                 params = {}
                 end_time = datetime.utcnow()
                 params['end_time'] = end_time.strftime('%Y-%m-%d %H:%M:%S')
-                params['start_time'] = last_timestamp if last_timestamp else start_time
+                params['start_time'] = dedup.overlap_start(last_timestamp) if last_timestamp else start_time
                 
+                # Batches are upserted while the pipe response is still streaming in.
+                sink = PostgresSink(conn, mode=POSTGRES_WRITE_MODE, batch_size=POSTGRES_BATCH_SIZE)
                 try:
-                    response = requests.get(DATA_SOURCE_URL, params=params, headers=headers_source, timeout=5)
-                    response.raise_for_status()  # Raise an exception for bad status codes
-                    data = response.json()['data']
+                    rows = dedup.fresh(stream_reports(source_client, params, SOURCE_FORMAT))
+                    ok, written, newest = deliver(rows, lambda batch: write_batch(sink, batch), POSTGRES_BATCH_SIZE)
                 except requests.exceptions.RequestException as e:
                     print(f"ERROR: API request error: {e}")
                     return  # Exit the function on API error
@@ -72,58 +143,42 @@ def fetch_and_post_data():
                     print(f"ERROR: Error parsing API response: {e}")
                     return
 
-                if data:
-                    last_timestamp = max(entry['timestamp'] for entry in data)
+                if not written and ok:
+                    print("INFO: No new data found.")
+                    return 0, None
 
-                    try:
-                        for report in data:
-                            print(f"INFO: Writing report: {report}")
-                            cur.execute(
-                                """
-                                INSERT INTO weather_reports (timestamp, site_name, temp_f, clouds, description, humidity, precip, pressure, wind_dir, wind_speed)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT ("timestamp", site_name) DO UPDATE 
-                                SET temp_f = EXCLUDED.temp_f, 
-                                    clouds = EXCLUDED.clouds, 
-                                    description = EXCLUDED.description, 
-                                    humidity = EXCLUDED.humidity, 
-                                    precip = EXCLUDED.precip, 
-                                    pressure = EXCLUDED.pressure, 
-                                    wind_dir = EXCLUDED.wind_dir, 
-                                    wind_speed = EXCLUDED.wind_speed;
-                                """,
-                                (
-                                    report['timestamp'],
-                                    report['site_name'],
-                                    report['temp_f'],
-                                    report['clouds'],
-                                    report['description'],
-                                    report['humidity'],
-                                    report['precip'],
-                                    report['pressure'],
-                                    report['wind_dir'],
-                                    report['wind_speed'],
-                                ),
-                                prepare=False  # Disable prepared statements
-                            )
-                        conn.commit()
-                        print("INFO: Processed all data...")
-                    except psycopg.Error as e:
-                        print(f"ERROR: Database error while inserting/updating data: {e}")
-                        conn.rollback()  # Rollback changes on error
+                print(f"INFO: Processed all data: {written} rows...")
 
-                else:
-                    print("INFO: No new data found.")
+                # Every batch is committed or spooled, so the watermark can move forward.
+                if not ok:
+                    return
+                commit_watermark(newest)
+                return written, newest
 
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}")
 
-# Schedule the task to run every minute
-schedule.every(1).minutes.do(fetch_and_post_data)
+parser = argparse.ArgumentParser(description='Copy weather reports from Tinybird to Postgres.')
+add_backfill_arguments(parser)
+add_spool_arguments(parser)
+args = parser.parse_args()
+
+# Drain the dead-letter queue at full speed and exit, if asked to.
+if replay_from_args(args, spool):
+    sys.exit(0)
+
+# Retry spooled batches in the background while polling.
+spool.start()
+
+# Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+metrics.start('tb_to_postgres')
 
-# Run any pending tasks now
-schedule.run_all()
+# Catch up on a long range with parallel, time-sharded requests before polling.
+if args.backfill_start or args.load_backfill_spool:
+    with db_pool.connection() as backfill_conn:
+        backfill_sink = PostgresSink(backfill_conn, mode=POSTGRES_WRITE_MODE, batch_size=POSTGRES_BATCH_SIZE)
+        backfill_from_args(args, source_client, lambda data: write_reports(backfill_sink, data))
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+# Poll straight away while there is a backlog, and less often while the source is quiet.
+# Runs never overlap: a slow run just delays the next one.
+poller_from_env().run_forever(fetch_and_post_data)
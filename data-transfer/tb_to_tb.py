@@ -1,12 +1,22 @@
+import argparse
 import requests
-import time
 from datetime import datetime, timedelta
-import schedule
 import os
 import json
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
+from checkpoint import open_checkpoint
+from dedup import open_dedup
+import metrics
+from events_sink import EventsApiSink
+from poller import poller_from_env
+from reports_source import add_backfill_arguments, backfill_from_args, deliver, stream_reports
+from spool import add_spool_arguments, replay_from_args, spool_from_env
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from tinybird_client import TinybirdClient
 
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
@@ -18,30 +28,83 @@ load_dotenv(dotenv_path=env_path)
 SOURCE_KEY = os.getenv('TINYBIRD_SOURCE_TOKEN')
 TARGET_KEY = os.getenv('TINYBIRD_TARGET_TOKEN')
 
-DATA_SOURCE_URL = "https://api.tinybird.co/v0/pipes/reportsv2.json"
 EVENTS_API_URL = "https://api.us-west-2.aws.tinybird.co/v0/events?name=weather_data_json"
 MOST_RECENT_URL = "https://api.us-west-2.aws.tinybird.co/v0/pipes/most_recent.json" 
 
+# Events API batching. Set EVENTS_BATCH_MAX_ROWS=1 to post one row per request.
+EVENTS_BATCH_MAX_ROWS = int(os.getenv('EVENTS_BATCH_MAX_ROWS', 10000))
+EVENTS_BATCH_MAX_BYTES = int(os.getenv('EVENTS_BATCH_MAX_BYTES', 8 * 1024 * 1024))
+
+# How reports are read from the pipe: 'ndjson' and 'csv' stream, 'json' loads the whole body.
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'ndjson')
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', EVENTS_BATCH_MAX_ROWS))
+
+# Pooled keep-alive clients, reused by every poll instead of opening a connection per request.
+source_client = TinybirdClient(SOURCE_KEY)
+target_client = TinybirdClient(TARGET_KEY)
+
+events_sink = EventsApiSink(EVENTS_API_URL, target_client, max_rows=EVENTS_BATCH_MAX_ROWS,
+                            max_bytes=EVENTS_BATCH_MAX_BYTES)
+
+# Batches the Events API does not take are spooled to disk and retried in the background,
+# through a sink of their own so the retry thread never touches events_sink's buffer.
+retry_sink = EventsApiSink(EVENTS_API_URL, target_client, max_rows=EVENTS_BATCH_MAX_ROWS,
+                           max_bytes=EVENTS_BATCH_MAX_BYTES)
+spool = spool_from_env('tb_to_tb', lambda rows: not (retry_sink.write(rows) + retry_sink.flush()))
+
+# Watermark store shared by the transfer scripts (SQLite by default, or a *.json file).
+checkpoint = open_checkpoint('tb_to_tb', os.getenv('CHECKPOINT_PATH'))
+
+# Keys of the reports delivered near the watermark, so polls can refetch a small overlap
+# without writing anything twice.
+dedup = open_dedup('tb_to_tb')
+
 # Some initial values... 
 end_time = datetime.now()
 start_time = end_time - timedelta(days=7) 
-last_timestamp = None
+last_timestamp = checkpoint.load()  # Resume where the last run left off, if it committed anything.
+
+@metrics.timed_write('tinybird')
+def write_batch(rows):
+    """Posts reports to the Events API and returns True if all of them were taken or spooled."""
+    # Rows are packed into NDJSON batches; anything left over is sent right away, so every
+    # row is posted before the watermark moves. Only the batches that failed are spooled.
+    failed = events_sink.write(rows) + events_sink.flush()
+    if not failed or spool.add(failed):
+        dedup.add(rows)
+        return True
+    return False
+
+def commit_watermark(timestamp):
+    global last_timestamp
+    last_timestamp = timestamp
+    metrics.watermark_committed(timestamp, 'tinybird')
+    # Save the index first: after a crash it may list rows past the watermark, never fewer.
+    dedup.save(timestamp)
+    checkpoint.commit(timestamp)
+
+def write_reports(data):
+    """Posts reports to the Events API and moves the watermark once all of them were taken.
+
+    Backfill shards share their boundary timestamps, so rows already posted are dropped first.
+    """
+    rows = list(dedup.fresh(data))
+    if rows and not write_batch(rows):
+        return False
+    commit_watermark(max(entry['timestamp'] for entry in data))
+    return True
 
 # First pull data from production live system and then write those updates to 
 def fetch_and_post_data():
     global last_timestamp
 
-    # Include the Tinybird token for the data fetch and data posts. 
-    headers_source = {"Authorization": f"Bearer {SOURCE_KEY}", "Content-Type": "application/json"}
-    headers_target = {"Authorization": f"Bearer {TARGET_KEY}", "Content-Type": "application/json"}
-
     if not last_timestamp:
-        # Try to retrieve most recent time. 
+        # No checkpoint yet, so try to retrieve most recent time from the target. 
         try:
-            response = requests.get(MOST_RECENT_URL, headers=headers_target, timeout=5)  # Include headers in the request
+            response = target_client.get(MOST_RECENT_URL, timeout=5)
             if response.status_code == 200:
                 print("API request succeeded.")
-                start_time = response.json()['data'][0]['timestamp']
+                last_timestamp = response.json()['data'][0]['timestamp']
             else:
                 print(f"API request failed with status code: {response.status_code}")
         except requests.exceptions.RequestException as e:
@@ -52,57 +115,52 @@ def fetch_and_post_data():
     end_time = datetime.utcnow() # Always request data up until now?
     params['end_time'] = end_time.strftime('%Y-%m-%d %H:%M:%S')
     
-    if last_timestamp: # then start there.
-        # Parse the string timestamp into a datetime object
-        last_datetime = datetime.fromisoformat(last_timestamp)
-
-        # Add one second
-        new_datetime = last_datetime + timedelta(seconds=1)
-
-        # Convert back to ISO format string
-        params['start_time'] = new_datetime.isoformat()
+    if last_timestamp: # then start a little before it, and drop the rows already posted.
+        params['start_time'] = dedup.overlap_start(last_timestamp)
     else: #otherwise, go back a day.     
         #params['start_time'] = (end_time - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
         params['start_time'] = start_time
     
+    # Rows are posted batch by batch while the pipe response is still streaming in.
     try:
-        response = requests.get(DATA_SOURCE_URL, params=params, headers=headers_source, timeout=5)  # Include headers in the request
-        if response.status_code == 200:
-            print("API request succeeded.")
-        else:
-            print(f"API request failed with status code: {response.status_code}")
+        ok, written, newest = deliver(dedup.fresh(stream_reports(source_client, params, SOURCE_FORMAT)), write_batch, STREAM_BATCH_SIZE)
     except requests.exceptions.RequestException as e:
         print(f"API request error: {e}")
+        return
+    except (json.JSONDecodeError, KeyError) as e:
+        print(f"Error parsing API response: {e}")
+        return
 
-    response.raise_for_status()
+    if not written and ok: #Was there anything new to send? 
+        print("No new data found.")
+        return 0, None
 
-    data = response.json()['data']
-    
-    if data: #Is there anything new to send? 
-        last_timestamp = max(entry['timestamp'] for entry in data)
-
-        for report in data:
-            print(report)
-            payload = json.dumps(report)
-            #payload = json.loads(report.replace("'", '"'))
-            events_response = requests.post(EVENTS_API_URL, data=payload, headers=headers_target)
-            if events_response.status_code == 202:
-                print(f"Data point posted successfully! {report}")
-            else:
-                print(f"Failed to post data point. Status code: {events_response.status_code}")
-                print(f"Response: {events_response.text}")
+    print(f"Processed all data: {written} rows posted, totals so far {events_sink.totals}")
 
-        print("Processed all data")       
+    # Only move the watermark once every batch has been taken by the Events API, or spooled.
+    if not ok:
+        return
+    commit_watermark(newest)
+    return written, newest
 
-    else:
-        print("No new data found.")
+parser = argparse.ArgumentParser(description='Copy weather reports from one Tinybird workspace to another.')
+add_backfill_arguments(parser)
+add_spool_arguments(parser)
+args = parser.parse_args()
+
+# Drain the dead-letter queue at full speed and exit, if asked to.
+if replay_from_args(args, spool):
+    sys.exit(0)
+
+# Retry spooled batches in the background while polling.
+spool.start()
 
-# Schedule the task to run every minute
-schedule.every(1).minutes.do(fetch_and_post_data)
+# Serve /metrics and log a summary line every METRICS_LOG_INTERVAL seconds.
+metrics.start('tb_to_tb')
 
-# Run any pending tasks now
-schedule.run_all()
+# Catch up on a long range with parallel, time-sharded requests before polling.
+backfill_from_args(args, source_client, write_reports)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+# Poll straight away while there is a backlog, and less often while the source is quiet.
+# Runs never overlap: a slow run just delays the next one.
+poller_from_env().run_forever(fetch_and_post_data)
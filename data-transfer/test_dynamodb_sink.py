@@ -0,0 +1,125 @@
+"""Tests for dynamodb_sink.py against moto's in-memory DynamoDB.
+
+Run from this folder with `python -m pytest test_dynamodb_sink.py` (or `python -m unittest`).
+"""
+import os
+import unittest
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from dynamodb_sink import WATERMARK_KEY, DynamoSink
+
+TABLE_NAME = 'weather_reports_test'
+REGION = 'us-east-1'
+
+
+def make_rows(count):
+    return [{'timestamp': f"2024-09-01 00:{i // 60:02d}:{i % 60:02d}", 'site_name': f"site-{i % 7}",
+             'temp_f': 50.5 + i % 10, 'clouds': 'few', 'description': 'clear', 'humidity': 40.0,
+             'precip': 0.0, 'pressure': 1013.2, 'wind_dir': 270.0, 'wind_speed': 5.5} for i in range(count)]
+
+
+class DynamoSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'testing')
+        self.mocked = mock_aws()
+        self.mocked.start()
+        self.addCleanup(self.mocked.stop)
+
+        dynamodb = boto3.resource('dynamodb', region_name=REGION)
+        self.table = dynamodb.create_table(
+            TableName=TABLE_NAME, BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'site_name', 'KeyType': 'HASH'},
+                       {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'site_name', 'AttributeType': 'S'},
+                                  {'AttributeName': 'timestamp', 'AttributeType': 'S'}])
+
+    def sink(self, **kwargs):
+        return DynamoSink(TABLE_NAME, region_name=REGION, **kwargs)
+
+    def item_count(self):
+        return self.table.scan(Select='COUNT')['Count']
+
+    def test_rows_are_cut_into_segments(self):
+        sink = self.sink(segment_size=50)
+        segments = []
+        write_segment = sink._write_segment
+        sink._write_segment = lambda segment: segments.append(len(segment)) or write_segment(segment)
+
+        self.assertEqual(sink.write(make_rows(120)), 120)
+        self.assertEqual(segments, [50, 50, 20])
+        self.assertEqual(self.item_count(), 120)
+
+        item = self.table.get_item(Key={'site_name': 'site-0', 'timestamp': '2024-09-01 00:00:00'})['Item']
+        self.assertEqual(item['temp_f'], Decimal('50.5'))
+
+    def test_parallel_writers_write_every_segment(self):
+        sink = self.sink(segment_size=25, workers=3)
+        self.assertEqual(sink.write(make_rows(110)), 110)
+        self.assertEqual(self.item_count(), 110)
+
+    def test_unprocessed_items_are_resent(self):
+        sink = self.sink(segment_size=500)
+        client = sink.table().meta.client
+        batch_write_item = client.batch_write_item
+        calls = []
+
+        def partly_processed(**kwargs):
+            # Hand half of the first request back as unprocessed, as a throttled table would.
+            calls.append(sum(len(requests) for requests in kwargs['RequestItems'].values()))
+            if len(calls) > 1:
+                return batch_write_item(**kwargs)
+            requests = kwargs['RequestItems'][TABLE_NAME]
+            response = batch_write_item(RequestItems={TABLE_NAME: requests[:10]})
+            response['UnprocessedItems'] = {TABLE_NAME: requests[10:]}
+            return response
+
+        client.batch_write_item = partly_processed
+        self.assertEqual(sink.write(make_rows(25)), 25)
+        self.assertEqual(calls[0], 25)
+        self.assertGreater(len(calls), 1)
+        self.assertEqual(self.item_count(), 25)
+
+    def test_throttled_segment_is_retried(self):
+        sink = self.sink(segment_size=500, max_retries=2)
+        client = sink.table().meta.client
+        batch_write_item = client.batch_write_item
+        attempts = []
+
+        def throttled_once(**kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'BatchWriteItem')
+            return batch_write_item(**kwargs)
+
+        client.batch_write_item = throttled_once
+        sink._wait_for_backoff = lambda: None
+        self.assertEqual(sink.write(make_rows(10)), 10)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.item_count(), 10)
+
+    def test_watermark_round_trip(self):
+        sink = self.sink()
+        self.assertIsNone(sink.read_watermark())
+
+        sink.commit_watermark('2024-09-01 12:00:00')
+        self.assertEqual(sink.read_watermark(), '2024-09-01 12:00:00')
+
+        # The watermark never moves backwards.
+        sink.commit_watermark('2024-09-01 11:00:00')
+        self.assertEqual(sink.read_watermark(), '2024-09-01 12:00:00')
+
+        sink.commit_watermark('2024-09-01 13:00:00')
+        self.assertEqual(self.sink().read_watermark(), '2024-09-01 13:00:00')
+
+        item = self.table.get_item(Key={'site_name': WATERMARK_KEY, 'timestamp': WATERMARK_KEY})['Item']
+        self.assertEqual(set(item), {'site_name', 'timestamp', 'last_timestamp'})
+
+
+if __name__ == '__main__':
+    unittest.main()
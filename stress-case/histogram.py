@@ -0,0 +1,87 @@
+import math
+
+DEFAULT_PRECISION = 0.01
+DEFAULT_LOWEST = 1e-6  # One microsecond, in seconds.
+
+# Percentiles shown in summaries and reports.
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """A log-bucketed latency histogram, in the spirit of HdrHistogram.
+
+    Bucket widths grow with the value, so any latency from `lowest` seconds up to hours is
+    kept within `precision` (1%) of its bucket's upper bound, using a few hundred sparse
+    buckets and no per-sample memory. Histograms with the same settings merge by adding
+    bucket counts, so intervals, query types or worker processes can be combined exactly.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, lowest=DEFAULT_LOWEST):
+        self.precision = precision
+        self.lowest = lowest
+        self.log_base = math.log1p(precision)
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def bucket(self, value):
+        """Bucket i holds values in (lowest * (1 + precision) ** (i - 1), lowest * (1 + precision) ** i]."""
+        if value <= self.lowest:
+            return 0
+        return math.ceil(math.log(value / self.lowest) / self.log_base)
+
+    def upper_bound(self, index):
+        return self.lowest * (1 + self.precision) ** index
+
+    def record(self, value):
+        index = self.bucket(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Adds `other`'s samples to this histogram. Both must use the same settings."""
+        if (other.precision, other.lowest) != (self.precision, self.lowest):
+            raise ValueError("Histograms with different precision or lowest value cannot be merged.")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, percent):
+        """The value `percent` percent of samples are at or below (None if empty)."""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(self.count * percent / 100))
+        running = 0
+        for index in sorted(self.counts):
+            running += self.counts[index]
+            if running >= target:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def to_dict(self):
+        """A JSON-friendly form that from_dict() reads back, for saving or sending between processes."""
+        return {'precision': self.precision, 'lowest': self.lowest, 'count': self.count, 'total': self.total,
+                'min': self.min, 'max': self.max, 'counts': {str(index): count for index, count in self.counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['precision'], data['lowest'])
+        histogram.counts = {int(index): count for index, count in data['counts'].items()}
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
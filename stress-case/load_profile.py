@@ -0,0 +1,124 @@
+import math
+
+import yaml
+
+BACKENDS = ('postgres', 'tinybird')
+
+# Name of the single phase a plain --rps run is made of.
+CONSTANT_PHASE = 'constant'
+
+
+class Phase:
+    """One stretch of a load profile: `duration` seconds, with the rate moving in a straight line
+    from `start_rate` to `end_rate` requests per second.
+
+    `offset` is where the phase starts, in seconds from the start of the profile.
+    """
+
+    def __init__(self, name, duration, start_rate, end_rate=None, offset=0.0):
+        self.name = name
+        self.duration = duration
+        self.start_rate = start_rate
+        self.end_rate = start_rate if end_rate is None else end_rate
+        self.offset = offset
+
+    def rate(self, elapsed):
+        if math.isinf(self.duration):
+            return self.start_rate
+        return self.start_rate + (self.end_rate - self.start_rate) * min(max(elapsed / self.duration, 0.0), 1.0)
+
+    @property
+    def target_rate(self):
+        """The average rate over the phase."""
+        return (self.start_rate + self.end_rate) / 2
+
+    def time_of(self, n):
+        """Seconds into the phase at which its n-th request (from 0) is due, or None if the phase ends first.
+
+        The count of requests due by time t is the integral of the rate, start_rate * t +
+        slope * t ** 2 / 2, so each start time is worked out from n alone and a ramp does
+        not drift.
+        """
+        slope = 0.0 if math.isinf(self.duration) else (self.end_rate - self.start_rate) / self.duration
+        if abs(slope) < 1e-12:
+            if self.start_rate <= 0:
+                return None
+            due = n / self.start_rate
+        else:
+            discriminant = self.start_rate ** 2 + 2 * slope * n
+            if discriminant < 0:
+                return None
+            due = (math.sqrt(discriminant) - self.start_rate) / slope
+        return due if due < self.duration else None
+
+    def scaled(self, factor):
+        return Phase(self.name, self.duration, self.start_rate * factor, self.end_rate * factor, self.offset)
+
+
+def constant_profile(rps, duration=None):
+    """The profile for a plain --rps run: one phase at `rps`, for `duration` seconds or forever."""
+    return [Phase(CONSTANT_PHASE, duration or math.inf, rps)]
+
+
+def scale_profile(phases, factor):
+    """The same profile at `factor` times the rate, for one worker's share of it."""
+    return [phase.scaled(factor) for phase in phases]
+
+
+def peak_rate(phases):
+    return max((max(phase.start_rate, phase.end_rate) for phase in phases), default=0.0)
+
+
+def expand_phase(spec, rates, name):
+    """Turns one phase from the YAML file into Phases, using `rates` (the phase's settings with a
+    backend's overrides applied)."""
+    kind = spec.get('type', 'constant')
+    try:
+        if kind in ('constant', 'soak', 'spike'):
+            return [Phase(name, float(spec['duration']), float(rates['rps']))]
+        if kind == 'ramp':
+            return [Phase(name, float(spec['duration']), float(rates['from']), float(rates['to']))]
+        if kind == 'step':
+            start, stop, by = float(rates['from']), float(rates['to']), float(rates['by'])
+            if by <= 0:
+                raise ValueError(f"Phase {name}: 'by' must be more than 0.")
+            count = int(math.floor((stop - start) / by + 1e-9)) + 1
+            return [Phase(f"{name}-{start + by * i:g}", float(spec['hold']), start + by * i) for i in range(count)]
+    except KeyError as e:
+        raise ValueError(f"Phase {name} ({kind}) needs a value for {e}.")
+    raise ValueError(f"Phase {name} has an unknown type: {kind}.")
+
+
+def load_profile(path):
+    """Reads a YAML load profile. Returns {backend: [Phase, ...]} for the backends it sends requests to.
+
+    Each phase's rates apply to both backends unless the phase has a `postgres:` or
+    `tinybird:` section, whose settings replace them for that backend. A backend with
+    `rps: 0` sits the phase out, but the phase still takes up its time.
+    """
+    with open(path, 'r') as f:
+        profile = yaml.safe_load(f) or {}
+    specs = profile.get('phases') or []
+    if not specs:
+        raise ValueError(f"{path} has no phases.")
+
+    profiles = {}
+    for backend in BACKENDS:
+        phases = []
+        offset = 0.0
+        for index, spec in enumerate(specs):
+            name = str(spec.get('name', f"phase-{index + 1}"))
+            overrides = spec.get(backend) or {}
+            expanded = expand_phase(spec, {**spec, **overrides}, name)
+            if overrides.get('rps') == 0:
+                expanded = [Phase(phase.name, phase.duration, 0.0) for phase in expanded]
+            for phase in expanded:
+                phase.offset = offset
+                offset += phase.duration
+                phases.append(phase)
+        names = [phase.name for phase in phases]
+        if len(set(names)) != len(names):
+            raise ValueError(f"{path} has more than one phase with the same name.")
+        if peak_rate(phases) > 0:
+            profiles[backend] = phases
+    return profiles
@@ -0,0 +1,351 @@
+import asyncio
+import csv
+import json
+import math
+import threading
+import time
+from bisect import bisect_right
+
+from histogram import PERCENTILES, LatencyHistogram
+
+# How often the summary lines are printed, in seconds.
+DEFAULT_REPORT_INTERVAL = 10.0
+
+# Query type recorded when a script does not name one.
+DEFAULT_QUERY = 'reports'
+
+# Longest an async schedule sleeps before checking whether it has been stopped, in seconds.
+STOP_CHECK_INTERVAL = 0.5
+
+# Set by stop_schedules(); every run_schedule() and run_schedule_async() in the process returns once it is.
+stopping = threading.Event()
+
+CSV_FIELDS = (['target', 'query', 'phase', 'target_rate', 'achieved_rate', 'completed', 'completed_rate', 'errors', 'mean_ms']
+              + [f"p{p:g}_ms" for p in PERCENTILES] + ['max_ms'])
+
+
+class Schedule:
+    """Intended start times for requests following a load profile (a list of load_profile.Phase),
+    from `start` (time.monotonic()).
+
+    At a constant rate, the n-th request of a phase is due at its start + n / rate, whatever
+    happened to the ones before it, so a slow request or a late wake-up never pushes later
+    requests back and the rate does not drift below the target.
+    """
+
+    def __init__(self, phases, start=None):
+        self.phases = phases
+        self.start = time.monotonic() if start is None else start
+        self.phase_index = 0
+        self.issued = 0
+
+    def next_start(self):
+        """The next intended start time, or None once the last phase is over."""
+        while self.phase_index < len(self.phases):
+            phase = self.phases[self.phase_index]
+            due = phase.time_of(self.issued)
+            if due is not None:
+                self.issued += 1
+                return self.start + phase.offset + due
+            self.phase_index += 1
+            self.issued = 0
+        return None
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def format_latencies(histogram):
+    """'p50/p90/p99/p99.9/max 12/20/45/80/95 ms' for a histogram, or '-' if it is empty."""
+    if not histogram.count:
+        return '-'
+    values = [histogram.percentile(p) for p in PERCENTILES] + [histogram.max]
+    names = '/'.join(f"p{p:g}" for p in PERCENTILES)
+    return f"{names}/max {'/'.join(f'{value * 1000:.0f}' for value in values)} ms"
+
+
+class LoadStats:
+    """Counts and latency histograms for one backend, safe to update from any thread or event loop.
+
+    `phases` is the backend's load profile and `started` (time.monotonic()) when it starts;
+    run_schedule() and run_schedule_async() follow them. Latency is measured from the
+    request's intended start, not from when it was actually sent, so time spent waiting for
+    a free worker or connection is counted as users would see it (no coordinated omission).
+    Latencies of successful requests are kept per profile phase and query type, in one
+    histogram for the interval and one for the whole run; failed requests are counted as
+    errors.
+    """
+
+    def __init__(self, name, phases, started=None):
+        self.name = name
+        self.phases = phases
+        self.lock = threading.Lock()
+        self.started = time.monotonic() if started is None else started
+        self.phase_starts = [self.started + phase.offset for phase in phases]
+        self.totals = {'issued': 0, 'completed': 0, 'errors': 0}
+        self.issued_by_phase = {}  # phase name -> requests sent, for the whole run
+        self.histograms = {}  # (phase name, query) -> LatencyHistogram, for the whole run
+        self.errors = {}  # (phase name, query) -> error count, for the whole run
+        self.last_completed_by_key = {}  # (phase name, query) -> time.monotonic() of its last completion
+        self.last_issued = self.last_completed = self.started
+        self.reset_interval()
+
+    def reset_interval(self):
+        self.interval_started = time.monotonic()
+        self.interval = {'issued': 0, 'completed': 0, 'errors': 0}
+        self.interval_issued_by_phase = {}
+        self.interval_histograms = {}
+        self.interval_errors = {}
+        self.max_send_lag = 0.0
+
+    def phase_at(self, moment):
+        """The phase running at `moment` (time.monotonic())."""
+        return self.phases[max(bisect_right(self.phase_starts, moment) - 1, 0)]
+
+    @property
+    def target_rate(self):
+        """The profile's average rate."""
+        if any(math.isinf(phase.duration) for phase in self.phases):
+            return self.phases[-1].target_rate
+        duration = sum(phase.duration for phase in self.phases)
+        return sum(phase.target_rate * phase.duration for phase in self.phases) / max(duration, 0.001)
+
+    def issued(self, intended):
+        """Records that a request due at `intended` was sent, and how late the scheduler was."""
+        now = time.monotonic()
+        lag = max(0.0, now - intended)
+        phase = self.phase_at(intended).name
+        with self.lock:
+            self.last_issued = now
+            self.totals['issued'] += 1
+            self.interval['issued'] += 1
+            for issued_by_phase in (self.issued_by_phase, self.interval_issued_by_phase):
+                issued_by_phase[phase] = issued_by_phase.get(phase, 0) + 1
+            self.max_send_lag = max(self.max_send_lag, lag)
+
+    def completed(self, intended, ok, query=DEFAULT_QUERY):
+        now = time.monotonic()
+        latency = now - intended
+        key = (self.phase_at(intended).name, query)
+        with self.lock:
+            self.last_completed = self.last_completed_by_key[key] = now
+            self.totals['completed'] += 1
+            self.interval['completed'] += 1
+            for histograms, errors in ((self.histograms, self.errors), (self.interval_histograms, self.interval_errors)):
+                histogram = histograms.setdefault(key, LatencyHistogram())
+                errors.setdefault(key, 0)
+                if ok:
+                    histogram.record(latency)
+                else:
+                    errors[key] += 1
+            if not ok:
+                self.totals['errors'] += 1
+                self.interval['errors'] += 1
+
+    def snapshot(self):
+        """Returns the interval's counts and histograms as plain data, for merge() in another process.
+
+        Starts a new interval, like summary(), so each request is in exactly one snapshot.
+        """
+        with self.lock:
+            data = {'name': self.name, 'interval': self.interval, 'issued_by_phase': self.interval_issued_by_phase,
+                    'errors': self.interval_errors,
+                    'histograms': {key: histogram.to_dict() for key, histogram in self.interval_histograms.items()},
+                    'max_send_lag': self.max_send_lag, 'last_issued': self.last_issued,
+                    'last_completed': self.last_completed, 'last_completed_by_key': dict(self.last_completed_by_key)}
+            self.reset_interval()
+        return data
+
+    def merge(self, data):
+        """Adds a snapshot() from another LoadStats, such as a worker process's, to this one.
+
+        The time.monotonic() values in the snapshot are comparable because the clock is
+        shared by every process on the machine.
+        """
+        with self.lock:
+            for counter, count in data['interval'].items():
+                self.totals[counter] += count
+                self.interval[counter] += count
+            for phase, count in data['issued_by_phase'].items():
+                for issued_by_phase in (self.issued_by_phase, self.interval_issued_by_phase):
+                    issued_by_phase[phase] = issued_by_phase.get(phase, 0) + count
+            for key, histogram in data['histograms'].items():
+                histogram = LatencyHistogram.from_dict(histogram)
+                for histograms, errors in ((self.histograms, self.errors), (self.interval_histograms, self.interval_errors)):
+                    histograms.setdefault(key, LatencyHistogram()).merge(histogram)
+                    errors[key] = errors.get(key, 0) + data['errors'].get(key, 0)
+            self.max_send_lag = max(self.max_send_lag, data['max_send_lag'])
+            self.last_issued = max(self.last_issued, data['last_issued'])
+            self.last_completed = max(self.last_completed, data['last_completed'])
+            for key, moment in data['last_completed_by_key'].items():
+                self.last_completed_by_key[key] = max(self.last_completed_by_key.get(key, moment), moment)
+
+    def summary(self):
+        """Returns the lines for the interval since the last summary and starts a new interval.
+
+        The first line has the backend's rates and current phase; then there is a latency line
+        per phase and query type.
+        """
+        now = time.monotonic()
+        phase = self.phase_at(now)
+        target = phase.rate(now - self.started - phase.offset) if now >= self.started else 0.0
+        with self.lock:
+            elapsed = max(now - self.interval_started, 0.001)
+            counts, histograms, errors = self.interval, self.interval_histograms, self.interval_errors
+            send_lag = self.max_send_lag
+            in_flight = self.totals['issued'] - self.totals['completed']
+            self.reset_interval()
+
+        lines = [f"{self.name} [{phase.name}]: target {target:.4g}/s, sent {counts['issued'] / elapsed:.1f}/s, "
+                 f"completed {counts['completed'] / elapsed:.1f}/s, {counts['errors']} errors, "
+                 f"{in_flight} in flight, max send lag {send_lag * 1000:.0f} ms"]
+        for key in sorted(histograms, key=self.sort_key):
+            lines.append(f"{self.name} {key[1]} [{key[0]}]: latency {format_latencies(histograms[key])}, "
+                         f"{errors[key]} errors")
+        return lines
+
+    def sort_key(self, key):
+        """Orders (phase name, query) keys by when the phase runs, then by query."""
+        order = {phase.name: index for index, phase in enumerate(self.phases)}
+        return order.get(key[0], len(order)), key[1]
+
+    def final_summary(self):
+        """The achieved send rate against the target, and the rate requests actually completed at."""
+        with self.lock:
+            sending = max(self.last_issued - self.started, 0.001)
+            running = max(self.last_completed - self.started, 0.001)
+            totals = dict(self.totals)
+        return (f"{self.name}: target {self.target_rate:.4g}/s, achieved {totals['issued'] / sending:.1f}/s "
+                f"over {sending:.0f}s, {totals['completed']} completed ({totals['completed'] / running:.1f}/s), "
+                f"{totals['errors']} errors")
+
+    def results(self):
+        """One dict per phase and query type, with latencies in ms and the histogram itself.
+
+        Rates are over the part of the phase that ran, so a step profile shows the rate at
+        which each backend's latency broke. The completed rate runs from the phase's start to
+        its last completion, which can be after the phase ended while a backlog drains.
+        """
+        with self.lock:
+            last_issued = self.last_issued
+            last_completed_by_key = dict(self.last_completed_by_key)
+            issued_by_phase = dict(self.issued_by_phase)
+            histograms = {key: LatencyHistogram().merge(histogram) for key, histogram in self.histograms.items()}
+            errors = dict(self.errors)
+
+        phases = {phase.name: (phase, start) for phase, start in zip(self.phases, self.phase_starts)}
+        results = []
+        for key in sorted(histograms, key=self.sort_key):
+            phase_name, query = key
+            phase, start = phases[phase_name]
+            sending = max(min(last_issued - start, phase.duration), 0.001)
+            running = max(last_completed_by_key.get(key, start) - start, 0.001)
+            histogram = histograms[key]
+            completed = histogram.count + errors[key]
+            result = {'target': self.name, 'query': query, 'phase': phase_name, 'target_rate': round(phase.target_rate, 2),
+                      'achieved_rate': round(issued_by_phase.get(phase_name, 0) / sending, 2), 'completed': completed,
+                      'completed_rate': round(completed / running, 2), 'errors': errors[key],
+                      'mean_ms': ms(histogram.mean())}
+            for p in PERCENTILES:
+                result[f"p{p:g}_ms"] = ms(histogram.percentile(p))
+            result['max_ms'] = ms(histogram.max if histogram.count else None)
+            result['histogram'] = histogram.to_dict()
+            results.append(result)
+        return results
+
+
+def write_report(stats_list, json_path=None, csv_path=None, run=None):
+    """Writes the results of every LoadStats to a JSON report and/or a CSV with a row per target, query and phase.
+
+    The JSON report also has the run's settings (`run`) and each latency histogram, so
+    reports from separate runs can be compared or merged.
+    """
+    results = [result for stats in stats_list for result in stats.results()]
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'run': run or {}, 'results': results}, f, indent=2)
+        print(f"INFO: Wrote latency report to {json_path}.")
+    if csv_path:
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"INFO: Wrote latency report to {csv_path}.")
+
+
+def stop_schedules():
+    """Stops every schedule in this process early, e.g. on Ctrl-C, so the final report can be written."""
+    stopping.set()
+
+
+def wait_for_threads(threads):
+    """Waits for `threads` to finish, in a way Ctrl-C can interrupt and the wait be started again.
+
+    Polls rather than joining: a join() interrupted by KeyboardInterrupt can leave the thread
+    marked as finished while it is still running, so a second join() returns straight away.
+    """
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.1)
+
+
+def run_schedule(submit, stats):
+    """Calls `submit(intended)` at each intended start time of stats' load profile, from the calling thread.
+
+    `submit` should hand the request to a worker and return straight away; the loop does not
+    wait for requests to finish. Returns when the profile is over or stop_schedules() is called.
+    """
+    schedule = Schedule(stats.phases, stats.started)
+    while not stopping.is_set():
+        intended = schedule.next_start()
+        if intended is None:
+            return
+        delay = intended - time.monotonic()
+        if delay > 0 and stopping.wait(delay):
+            return
+        stats.issued(intended)
+        submit(intended)
+
+
+async def run_schedule_async(request, stats, blocking=False):
+    """Starts `request(intended)` as a task at each intended start time of stats' load profile.
+
+    With `blocking`, each request is awaited before the next one is started, which is a
+    closed loop; intended start times are kept, so the latency still includes the time a
+    request spent waiting behind the one before it. Stops early once stop_schedules() is
+    called, and waits for requests still in flight before returning.
+    """
+    schedule = Schedule(stats.phases, stats.started)
+    tasks = set()
+    while not stopping.is_set():
+        intended = schedule.next_start()
+        if intended is None:
+            break
+        delay = intended - time.monotonic()
+        while delay > 0 and not stopping.is_set():
+            await asyncio.sleep(min(delay, STOP_CHECK_INTERVAL))
+            delay = intended - time.monotonic()
+        if stopping.is_set():
+            break
+        stats.issued(intended)
+        if blocking:
+            await request(intended)
+        else:
+            task = asyncio.create_task(request(intended))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def start_reporting(stats_list, interval=DEFAULT_REPORT_INTERVAL):
+    """Prints the summary lines for each LoadStats every `interval` seconds, from a daemon thread."""
+    def report():
+        while True:
+            time.sleep(interval)
+            for stats in stats_list:
+                for line in stats.summary():
+                    print(f"INFO: {line}")
+
+    if interval:
+        threading.Thread(target=report, name='stress-report', daemon=True).start()
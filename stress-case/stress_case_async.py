@@ -1,15 +1,27 @@
 import threading
 import asyncio
+import multiprocessing
 from datetime import datetime, timedelta
 import os
+import sys
 import time
 import random
+import signal
 import psycopg
 import aiohttp
 import argparse
 from pathlib import Path
+from queue import Empty
 from dotenv import load_dotenv
 
+from load_profile import constant_profile, load_profile, peak_rate, scale_profile
+from scheduler import (DEFAULT_REPORT_INTERVAL, LoadStats, run_schedule_async, start_reporting, stop_schedules,
+                       wait_for_threads, write_report)
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from postgres_pool import AsyncDirectConnections, open_async_pool
+from tinybird_client import AsyncTinybirdClient
+
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
 
@@ -34,6 +46,14 @@ TINYBIRD_REPORTS_ENDPOINT = 'https://api.tinybird.co/v0/pipes/reports.json'
 TINYBIRD_CC_ENDPOINT = 'https://api.tinybird.co/v0/pipes/current_conditions.json'
 TINYBIRD_CITY_NAME_ENDPOINT = 'https://api.tinybird.co/v0/pipes/api_cities.json'
 
+# Keep-alive connections the shared Tinybird session may hold open at once.
+DEFAULT_HTTP_CONNECTIONS = 100
+
+# With --workers, seconds allowed for the worker processes to start before the schedules do,
+# and how often each worker sends its counts and histograms to the coordinator.
+WORKER_STARTUP = 3.0
+SNAPSHOT_INTERVAL = 1.0
+
 
 # Function to generate random start and end times
 def generate_random_times():
@@ -89,10 +109,9 @@ def make_daily_stats_query(site_name, start_time, end_time):
 async def load_city_names():
     """Loads city names from the Tinybird API using aiohttp."""
     data = []
-    headers = {'Authorization': f'Bearer {TINYBIRD_KEY}'}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(TINYBIRD_CITY_NAME_ENDPOINT, headers=headers) as response:
+    async with AsyncTinybirdClient(TINYBIRD_KEY) as client:
+        async with await client.get(TINYBIRD_CITY_NAME_ENDPOINT) as response:
             if response.status == 200:
                 data = await response.json()
                 print("Tinybird responded...")
@@ -105,19 +124,16 @@ async def load_city_names():
     return city_names
 
 # Asynchronous function to make database requests
-async def make_database_request(site_name, start_time, end_time):
-    """Makes an asynchronous database request using psycopg."""
+async def make_database_request(db, site_name, start_time, end_time):
+    """Makes an asynchronous database request on a connection from `db`."""
    
     async def _make_request():
         try:
-            async with await psycopg.AsyncConnection.connect(DATABASE_URL) as conn:
+            async with db.connection() as conn:
                 async with conn.cursor() as cur:
                     sql_query = make_reports_query(site_name, start_time, end_time) 
-                    print(f"Making Postgres query: {sql_query}")
                     await cur.execute(sql_query)
                     results = await cur.fetchall()
-                    print("Postgres responded...")
-                    #print("Postgres response:", results)
                     return results  # Return the results from the database query
         except (psycopg.OperationalError, asyncio.TimeoutError) as e:
             print(f"Database Error: {e}")
@@ -128,9 +144,8 @@ async def make_database_request(site_name, start_time, end_time):
     return await _make_request() 
 
 # Asynchronous function to make Tinybird requests
-async def make_tinybird_request(site_name, start_time, end_time):
-    """Makes an asynchronous Tinybird API request using aiohttp."""
-    headers = {'Authorization': f'Bearer {TINYBIRD_KEY}'}
+async def make_tinybird_request(client, site_name, start_time, end_time):
+    """Makes an asynchronous Tinybird API request on the thread's pooled client. Returns True on a 200."""
   
     # Convert datetime objects to ISO 8601 strings
 
@@ -141,38 +156,38 @@ async def make_tinybird_request(site_name, start_time, end_time):
         end_time=end_time.isoformat()
     )
 
-    # prepare /reports request.
-
-    print(f"Making Tinybird request: {params} ")
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(TINYBIRD_REPORTS_ENDPOINT, params=params, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                print("Tinybird responded...")
-                #print("Tinybird API response:", data)
-            else:
-                print(f"Tinybird API Error: {response.status} - {await response.text()}")
+    async with await client.get(TINYBIRD_REPORTS_ENDPOINT, params=params) as response:
+        if response.status == 200:
+            await response.json()
+            return True
+        print(f"Tinybird API Error: {response.status} - {await response.text()}")
+        return False
 
 # -----------------------------------------------------------------------------------------------
 # --- Thread Functions ---
-def make_database_requests_thread(rps, blocking=False):
-    """Thread function for making continuous database requests at a specified RPS."""
+def make_database_requests_thread(stats, blocking=False, connections='pooled', pool_size=None):
+    """Thread function for making database requests on an open-loop schedule, following stats' load profile."""
 
     async def _make_requests():
-        interval = 1.0 / rps
-        while True:
+        # The pool belongs to this thread's event loop, so it is opened here, once for the
+        # whole run; `pool_size` connections are opened up front. With 'per-request' every
+        # query opens its own connection, as this script used to.
+        if connections == 'pooled':
+            sizes = {'min_size': pool_size, 'max_size': pool_size} if pool_size else {}
+            db = await open_async_pool(DATABASE_URL, name='stress_case_async', **sizes)
+        else:
+            db = AsyncDirectConnections(DATABASE_URL)
+
+        async def request(intended):
             site_name = random.choice(city_names)
             start_time, end_time = generate_random_times()
+            results = await make_database_request(db, site_name, start_time, end_time)
+            stats.completed(intended, results is not None, 'reports')
 
-            if blocking:
-                # Synchronous execution, wait for each request to complete
-                await make_database_request(site_name, start_time, end_time) 
-            else:
-                # Asynchronous execution, fire off requests without waiting
-                asyncio.create_task(make_database_request(site_name, start_time, end_time)) 
-
-            await asyncio.sleep(interval) 
+        # Requests start on fixed intended times (see scheduler.py); with blocking, each one
+        # is awaited before the next starts.
+        await run_schedule_async(request, stats, blocking)
+        await db.close()
 
     # Create and run the event loop within the thread
     loop = asyncio.new_event_loop()
@@ -180,22 +195,137 @@ def make_database_requests_thread(rps, blocking=False):
     loop.run_until_complete(_make_requests()) 
 
 
-async def make_tinybird_requests_thread(rps, blocking=False):
-    """Asynchronous thread function for making continuous Tinybird API requests."""
-    interval = 1.0 / rps
-    while True:
-        site_name = random.choice(city_names)
-        start_time, end_time = generate_random_times()
+async def make_tinybird_requests_thread(stats, blocking=False, connections='pooled',
+                                        http_connections=DEFAULT_HTTP_CONNECTIONS):
+    """Asynchronous thread function for making Tinybird API requests on an open-loop schedule, following stats' load profile."""
 
-        try:
-            if blocking:
-                await make_tinybird_request(site_name, start_time, end_time)
-            else:
-                asyncio.create_task(make_tinybird_request(site_name, start_time, end_time))
-        except aiohttp.ClientError as e:
-            print(f"Tinybird API Error: {e}")
+    # The client's connection pool belongs to this thread's event loop, so it is created here,
+    # once for the whole run, with up to `http_connections` keep-alive connections. Throttled
+    # requests are not retried, so 429s still show up in the results.
+    async with AsyncTinybirdClient(TINYBIRD_KEY, limit=http_connections, max_retries=0) as shared_client:
+
+        async def call(site_name, start_time, end_time):
+            if connections == 'pooled':
+                return await make_tinybird_request(shared_client, site_name, start_time, end_time)
+            # A new session, and so a new connection and TLS handshake, for every request.
+            async with AsyncTinybirdClient(TINYBIRD_KEY, max_retries=0) as own_client:
+                return await make_tinybird_request(own_client, site_name, start_time, end_time)
+
+        async def request(intended):
+            site_name = random.choice(city_names)
+            start_time, end_time = generate_random_times()
+            ok = False
+            try:
+                ok = await call(site_name, start_time, end_time)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Tinybird API Error: {e}")
+            stats.completed(intended, ok, 'reports')
+
+        await run_schedule_async(request, stats, blocking)
+
+def start_request_threads(args, profiles, start=None):
+    """Starts a requests thread for each backend in `profiles`, following its load profile.
+
+    Returns the threads and their LoadStats.
+    """
+    threads = []
+    all_stats = []
 
-        await asyncio.sleep(interval) 
+    if 'postgres' in profiles:
+        print("Starting Postgres requests thread)...")
+        db_stats = LoadStats('postgres', profiles['postgres'], start)
+        all_stats.append(db_stats)
+        db_thread = threading.Thread(target=make_database_requests_thread,
+                                     args=(db_stats, args.block, args.connections, args.db_connections), daemon=True)
+        threads.append(db_thread)
+        db_thread.start()
+
+    if 'tinybird' in profiles:
+        print("Starting Tinybird requests thread)...")
+        tinybird_stats = LoadStats('tinybird', profiles['tinybird'], start)
+        all_stats.append(tinybird_stats)
+        tinybird_thread = threading.Thread(target=asyncio.run,
+                                           args=(make_tinybird_requests_thread(tinybird_stats, args.block, args.connections,
+                                                                             args.http_connections),), daemon=True)
+        threads.append(tinybird_thread)
+        tinybird_thread.start()
+
+    return threads, all_stats
+
+# -----------------------------------------------------------------------------------------------
+# --- Worker Processes ---
+def run_worker(index, args, names, profiles, start, queue, stop):
+    """Runs one worker process's share of the load, sending LoadStats snapshots to the coordinator.
+
+    Each worker follows the profiles at 1 / args.workers of their rates, in its own event
+    loops. Its schedules are offset by index / the peak rate, so the workers' requests
+    interleave rather than arriving together. The coordinator handles Ctrl-C and sets `stop`
+    to end the schedules early.
+    """
+    global city_names
+    city_names = names
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    peak = max(peak_rate(phases) for phases in profiles.values())
+    shares = {backend: scale_profile(phases, 1 / args.workers) for backend, phases in profiles.items()}
+    threads, all_stats = start_request_threads(args, shares, start + index / peak)
+    while any(thread.is_alive() for thread in threads):
+        if stop.wait(SNAPSHOT_INTERVAL):
+            stop_schedules()
+        queue.put((index, [stats.snapshot() for stats in all_stats]))
+    queue.put((index, [stats.snapshot() for stats in all_stats]))
+    queue.put((index, None))
+
+
+def run_workers(args, names, profiles):
+    """Spawns args.workers processes and merges their snapshots into one LoadStats per backend.
+
+    Returns the merged LoadStats, which the summary lines and the final report are made from.
+    Ctrl-C stops the workers' schedules and waits for their last snapshots; a second Ctrl-C
+    stops waiting.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    stop = context.Event()
+    # Workers start their schedules together, once they have had time to start up and connect.
+    start = time.monotonic() + WORKER_STARTUP
+    all_stats = {backend: LoadStats(backend, phases, start) for backend, phases in profiles.items()}
+
+    print(f"INFO: Starting {args.workers} worker processes, each making 1/{args.workers} of the requests...")
+    processes = [context.Process(target=run_worker, args=(index, args, names, profiles, start, queue, stop),
+                                 daemon=True)
+                 for index in range(args.workers)]
+    for process in processes:
+        process.start()
+    start_reporting(list(all_stats.values()), args.report_interval)
+
+    running = len(processes)
+    while running:
+        try:
+            index, snapshots = queue.get(timeout=SNAPSHOT_INTERVAL * 5)
+        except KeyboardInterrupt:
+            if stop.is_set():
+                print("WARNING: Stopped without waiting for the workers' requests in flight.")
+                break
+            print("INFO: Stopping workers. Waiting for requests in flight (Ctrl-C again to stop waiting)...")
+            stop.set()
+            continue
+        except Empty:
+            if not any(process.is_alive() for process in processes):
+                print("ERROR: Worker processes exited without finishing.")
+                break
+            continue
+        if snapshots is None:
+            running -= 1
+            continue
+        for snapshot in snapshots:
+            all_stats[snapshot['name']].merge(snapshot)
+
+    for process in processes:
+        if running:
+            process.terminate()
+        process.join()
+    return list(all_stats.values())
 
 # --- Main Execution ---
 
@@ -203,28 +333,57 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Make requests to s Postgres database and/or Tinybird API Endpoints.')
     parser.add_argument('--mode', choices=['postgres', 'tinybird', 'both'], default='both', help='Request mode')
     #parser.add_argument('--interval', type=float, default=10.0, help='Interval between requests (seconds)')
-    parser.add_argument('--rps', type=int, default=10, help='Requests per second')
+    parser.add_argument('--rps', type=float, default=10, help='Target requests per second, for each backend')
     parser.add_argument('--block', action='store_true', help='Block and wait for each request to complete')
+    parser.add_argument('--duration', type=float, default=0, help='Seconds to run for (default: until stopped)')
+    parser.add_argument('--profile', help='YAML load profile to follow instead of a constant --rps and --duration')
+    parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL,
+                        help='Seconds between summary lines (0 to turn them off)')
+    parser.add_argument('--connections', choices=['pooled', 'per-request'], default='pooled',
+                        help='Share one HTTP session and one Postgres pool, or open a new connection for every request')
+    parser.add_argument('--http-connections', type=int, default=DEFAULT_HTTP_CONNECTIONS,
+                        help='Most keep-alive connections the shared Tinybird session opens')
+    parser.add_argument('--db-connections', type=int, default=None,
+                        help='Postgres pool size (default: POSTGRES_POOL_MIN_SIZE/MAX_SIZE)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes to spread the load over, each with its own event loops and share of --rps')
+    parser.add_argument('--report-json', help='Write a JSON latency report, with histograms, to this file at the end')
+    parser.add_argument('--report-csv', help='Write a CSV latency report, a row per backend and query, to this file at the end')
     args = parser.parse_args()
 
-    args.mode = 'both'
     args.interval = 1
 
-    city_names = asyncio.run(load_city_names())  
-
-    threads = []
+    if args.profile:
+        try:
+            profiles = load_profile(args.profile)
+        except (OSError, ValueError) as e:
+            parser.error(f"Could not load {args.profile}: {e}")
+    else:
+        profiles = {'postgres': constant_profile(args.rps, args.duration), 'tinybird': constant_profile(args.rps, args.duration)}
+    profiles = {backend: phases for backend, phases in profiles.items() if args.mode in (backend, 'both')}
+    if not profiles:
+        parser.error(f"The load profile makes no {args.mode} requests.")
 
-    if args.mode in ['postgres', 'both']:
-        print("Starting Postgres requests thread)...")
-        db_thread = threading.Thread(target=make_database_requests_thread, args=(args.rps, args.block), daemon=True)
-        threads.append(db_thread)
-        db_thread.start()
+    city_names = asyncio.run(load_city_names())  
 
-    if args.mode in ['tinybird', 'both']:
-        print("Starting Tinybird requests thread)...")
-        tinybird_thread = threading.Thread(target=asyncio.run, args=(make_tinybird_requests_thread(args.rps, args.block),))
-        threads.append(tinybird_thread)
-        tinybird_thread.start()
+    if args.workers > 1:
+        all_stats = run_workers(args, city_names, profiles)
+    else:
+        threads, all_stats = start_request_threads(args, profiles)
+        start_reporting(all_stats, args.report_interval)
 
-    for thread in threads:
-        thread.join()
+        # Ctrl-C stops the schedules early; a second Ctrl-C stops waiting for requests in
+        # flight. Either way, the final report is written.
+        try:
+            try:
+                wait_for_threads(threads)
+            except KeyboardInterrupt:
+                print("INFO: Stopping. Waiting for requests in flight (Ctrl-C again to stop waiting)...")
+                stop_schedules()
+                wait_for_threads(threads)
+        except KeyboardInterrupt:
+            print("WARNING: Stopped without waiting for requests in flight.")
+
+    for stats in all_stats:
+        print(f"INFO: {stats.final_summary()}")
+    write_report(all_stats, args.report_json, args.report_csv, run={'script': 'stress_case_async.py', **vars(args)})
@@ -1,15 +1,24 @@
 import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import argparse 
-import time
 import os
+import sys
 import random
-import psycopg
+import time
 from psycopg import OperationalError
 from pathlib import Path
 from dotenv import load_dotenv
 
+from load_profile import constant_profile, load_profile
+from scheduler import (DEFAULT_REPORT_INTERVAL, LoadStats, run_schedule, start_reporting, stop_schedules,
+                       wait_for_threads, write_report)
+
+sys.path.append(str(Path(__file__).parent.parent / 'common'))
+from postgres_pool import DirectConnections, open_pool
+from tinybird_client import TinybirdClient
+
 # Load environment variables from .env.local
 # Get the directory of the current script
 script_dir = Path(__file__).parent 
@@ -20,14 +29,35 @@ load_dotenv(dotenv_path=env_path)
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description='Tinybird and Postgres Stress Tester')
-parser.add_argument('--threads', type=int, default=10, help='Number of threads to use')
+parser.add_argument('--threads', type=int, default=10, help='Number of worker threads that make the requests')
+parser.add_argument('--rps', type=float, default=10, help='Target requests per second, for each of Tinybird and Postgres')
+parser.add_argument('--duration', type=float, default=0, help='Seconds to run for (default: until stopped)')
+parser.add_argument('--profile', help='YAML load profile to follow instead of a constant --rps and --duration')
+parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL,
+                    help='Seconds between summary lines (0 to turn them off)')
+parser.add_argument('--connections', choices=['pooled', 'per-request'], default='pooled',
+                    help='Share a Postgres connection pool, or open a new connection for every query')
+parser.add_argument('--report-json', help='Write a JSON latency report, with histograms, to this file at the end')
+parser.add_argument('--report-csv', help='Write a CSV latency report, a row per backend and query, to this file at the end')
 args = parser.parse_args()
 
+if args.profile:
+    try:
+        profiles = load_profile(args.profile)
+    except (OSError, ValueError) as e:
+        parser.error(f"Could not load {args.profile}: {e}")
+else:
+    profiles = {'tinybird': constant_profile(args.rps, args.duration), 'postgres': constant_profile(args.rps, args.duration)}
+
 # Use the number of threads from the command-line argument
 NUM_THREADS = args.threads
 
 TINYBIRD_KEY = os.getenv("TINYBIRD_KEY")
 
+# One keep-alive connection per thread, shared through a pooled client. Throttled requests
+# are not retried, so 429s still show up in the results.
+tinybird_client = TinybirdClient(TINYBIRD_KEY, pool_size=NUM_THREADS, max_retries=0)
+
 TINYBIRD_REPORTS_URL = 'https://api.tinybird.co/v0/pipes/reports.json'  
 TINYBIRD_CC_ENDPOINT = 'https://api.tinybird.co/v0/pipes/current_conditions.json'
 TINYBIRD_CITY_NAME_ENDPOINT = 'https://api.tinybird.co/v0/pipes/api_cities.json'
@@ -41,6 +71,14 @@ DB_CONNECTION_PARAMS = {
     'port': os.getenv("DATABASE_PORT")  
 }
 
+# A pooled connection per thread keeps connection setup out of the query latency. With
+# --connections per-request every query pays for its own connection, as this script used to.
+if args.connections == 'pooled':
+    db_connections = open_pool(connect_kwargs=DB_CONNECTION_PARAMS, name='stress_case',
+                               min_size=NUM_THREADS, max_size=NUM_THREADS)
+else:
+    db_connections = DirectConnections(connect_kwargs=DB_CONNECTION_PARAMS)
+
 
 
 # Global variable to store city names
@@ -49,9 +87,8 @@ CITY_NAMES = []
 # Function to get available city names from Tinybird (called only once)
 def fetch_city_names():
     global CITY_NAMES 
-    headers = {'Authorization': f'Bearer {TINYBIRD_KEY}'}
     try:
-        response = requests.get(TINYBIRD_CITY_NAME_ENDPOINT, headers=headers)
+        response = tinybird_client.get(TINYBIRD_CITY_NAME_ENDPOINT)
         response.raise_for_status() 
         data = response.json()
         CITY_NAMES = [site['site_name'] for site in data['data']]
@@ -79,11 +116,10 @@ def generate_random_times():
 
 
 def call_tinybird_api():
-    headers = {'Authorization': f'Bearer {TINYBIRD_KEY}'}
-
+    """Makes one /reports request. Returns True if it succeeded."""
     if not CITY_NAMES:
         print("No city names available. Skipping API call.")
-        return
+        return False
 
     # Randomly select a city name
     site_name = random.choice(CITY_NAMES)
@@ -99,19 +135,19 @@ def call_tinybird_api():
     )
 
     try:
-        response = requests.get(TINYBIRD_REPORTS_URL, params=params, headers=headers, timeout=5)  # Include headers in the request
+        response = tinybird_client.get(TINYBIRD_REPORTS_URL, params=params, timeout=5)
         if response.status_code == 200:
-            print("API request succeeded.")
-        else:
-            print(f"API request failed with status code: {response.status_code}")
+            return True
+        print(f"API request failed with status code: {response.status_code}")
     except requests.exceptions.RequestException as e:
         print(f"API request error: {e}")
+    return False
 
 def call_postgres_db():
-
+    """Runs one reports query. Returns True if it succeeded."""
     if not CITY_NAMES:
         print("No city names available. Skipping database call.")
-        return
+        return False
 
     # Randomly select a city name
     site_name = random.choice(CITY_NAMES)
@@ -120,7 +156,7 @@ def call_postgres_db():
     start_time, end_time = generate_random_times()
 
     try:
-        with psycopg.connect(**DB_CONNECTION_PARAMS) as conn:
+        with db_connections.connection() as conn:
             with conn.cursor() as cursor:
 
                 sql_query = f"""
@@ -132,27 +168,54 @@ def call_postgres_db():
                 """ 
                 
                 cursor.execute(sql_query)
-                result = cursor.fetchone()
-                if result:
-                    print("Database request succeeded.")
+                cursor.fetchone()
+                return True
     except OperationalError as e:
         print(f"Database connection error: {e}")
+    return False
+
+def timed_call(call, intended, stats, query='reports'):
+    """Runs `call` and records how it went. An unexpected error counts as a failed request
+    rather than vanishing into the executor's future."""
+    try:
+        ok = call()
+    except Exception as e:
+        print(f"Unexpected request error: {e}")
+        ok = False
+    stats.completed(intended, ok, query)
 
 fetch_city_names()
 
-def worker():
-    while True:
-        call_tinybird_api()
-        call_postgres_db()
-        time.sleep(0.01)  # Slight delay to simulate realistic conditions? A way to throttle. 
+# Open loop: requests are sent on a fixed schedule whether or not earlier ones have finished,
+# so a slow server sees the same load instead of less of it. Requests wait for a free worker
+# when all are busy, and that wait counts in their latency.
+executor = ThreadPoolExecutor(max_workers=NUM_THREADS)
+start = time.monotonic()
+backends = [(LoadStats(name, profiles[name], start), call)
+            for name, call in [('tinybird', call_tinybird_api), ('postgres', call_postgres_db)] if name in profiles]
+start_reporting([stats for stats, _ in backends], args.report_interval)
 
 threads = []
-# Creating threads
-for _ in range(NUM_THREADS):
-    thread = threading.Thread(target=worker)
+for stats, call in backends:
+    submit = lambda intended, call=call, stats=stats: executor.submit(timed_call, call, intended, stats)
+    thread = threading.Thread(target=run_schedule, args=(submit, stats), daemon=True)
     thread.start()
     threads.append(thread)
 
-# Wait for all threads to complete
-for thread in threads:
-    thread.join()
+# Wait for the schedules to finish, then for the requests still in flight. Ctrl-C stops the
+# schedules early; a second Ctrl-C stops waiting. Either way, the final report is written.
+try:
+    try:
+        wait_for_threads(threads)
+    except KeyboardInterrupt:
+        print("INFO: Stopping. Waiting for requests in flight (Ctrl-C again to stop waiting)...")
+        stop_schedules()
+        wait_for_threads(threads)
+        executor.shutdown(wait=False, cancel_futures=True)
+    executor.shutdown(wait=True)
+except KeyboardInterrupt:
+    print("WARNING: Stopped without waiting for requests in flight.")
+for stats, _ in backends:
+    print(f"INFO: {stats.final_summary()}")
+write_report([stats for stats, _ in backends], args.report_json, args.report_csv,
+             run={'script': 'stress_case_threading.py', **vars(args)})